@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+MIDIKEYB = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MIDIKEYB)
+
+
+@pytest.fixture(autouse=True)
+def midikeyb_folder(monkeypatch):
+    # the assets are found relative to the midikeyb folder, as when running zaehmungenkeyb.py
+    monkeypatch.chdir(MIDIKEYB)
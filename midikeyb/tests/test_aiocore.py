@@ -0,0 +1,40 @@
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip("liblo")
+pytest.importorskip("rtmidi2")
+
+from zaehmungen.aiocore import AsyncMidiKeyb
+from zaehmungen.journal import HEADER, RECORD, JOURNAL_DIR, journal_files, read_journal
+from zaehmungen.session import Session
+
+PORTBASE = 17780
+
+
+def test_stop_closes_the_journal(tmp_path):
+    keyb = AsyncMidiKeyb(openmidi=False, session=Session(portbase=PORTBASE, gui=False, folder=str(tmp_path)))
+    journal = keyb._journal
+    assert journal is not None
+    stopped = []
+    keyb.on_stop = lambda: stopped.append(True)
+
+    async def play():
+        task = asyncio.ensure_future(keyb.run())
+        await asyncio.sleep(0.1)
+        keyb.midi_callback([144, 60, 100], 0.0)
+        keyb.midi_callback([128, 60, 0], 0.1)
+        await asyncio.sleep(0.05)
+        keyb.stop()
+        await task
+
+    asyncio.run(play())
+    assert keyb._journal is None
+    assert journal._mm is None
+    assert keyb._probe_handle.cancelled()
+    assert stopped == [True]
+    path, = journal_files(os.path.join(str(tmp_path), JOURNAL_DIR))
+    # cut to its records
+    assert os.path.getsize(path) == HEADER.size + 2 * RECORD.size
+    assert [record[1] for record in read_journal(path)[1]] == [144, 128]
@@ -0,0 +1,39 @@
+import pytest
+
+from zaehmungen.bounce import score_lines, make_csd, TAIL
+
+
+def test_score_lines():
+    events = [
+        (0.0, '/gain', [0.5]),
+        (0.1, '/noteon', [60, 0.25, 0.8]),
+        (0.3, '/noteoff', [60]),
+        (0.4, '/panic', []),
+        (0.5, '/unknown', [1]),
+    ]
+    lines, end = score_lines(events)
+    assert end == pytest.approx(0.5 + TAIL)
+    assert lines == [
+        'i 1 0.000000 1 "gain" 0.5',
+        'i 30 0.100000 1 60 0.25 0.8',
+        'i 31 0.300000 1 60',
+        'i 32 0.400000 1',
+        'f 0 1.500000',
+        'e',
+    ]
+
+
+def test_score_lines_stop():
+    lines, end = score_lines([(0.0, '/noteon', [60, 0.25, 0.8]), (2.0, '/stop', []), (3.0, '/panic', [])])
+    assert end == 2.0
+    assert lines[-2:] == ['f 0 2.000000', 'e']
+    assert len(lines) == 3
+
+
+def test_make_csd():
+    csd = "<CsoundSynthesizer>\n<CsScore>\nf 0 3600\n</CsScore>\n</CsoundSynthesizer>"
+    out = make_csd(csd, ['i 1 0 1', 'e'])
+    assert "<CsScore>\ni 1 0 1\ne\n</CsScore>" in out
+    assert "3600" not in out
+    with pytest.raises(ValueError):
+        make_csd("<CsoundSynthesizer></CsoundSynthesizer>", [])
@@ -0,0 +1,46 @@
+from zaehmungen.coalesce import Coalescer
+
+
+def test_period():
+    coalescer = Coalescer(period=0.1)
+    assert coalescer.feed('gain', 1, 0.0)
+    assert not coalescer.feed('gain', 2, 0.01)
+    assert not coalescer.feed('gain', 3, 0.02)
+    # another key has its own period
+    assert coalescer.feed('speed', 1, 0.02)
+    assert coalescer.next_deadline() == 0.1
+    assert coalescer.due(0.05) == []
+    # the latest value is forwarded once the period is over
+    assert coalescer.due(0.1) == [('gain', 3)]
+    assert coalescer.next_deadline() is None
+    assert coalescer.stats() == {'received': 4, 'forwarded': 3, 'suppressed': 1, 'pending': 0}
+
+
+def test_deadband():
+    coalescer = Coalescer(period=0, deadband=2, always=(0, 127))
+    assert coalescer.feed(7, 64, 0.0)
+    assert not coalescer.feed(7, 64, 1.0)
+    assert not coalescer.feed(7, 66, 1.0)
+    assert not coalescer.feed(7, 62, 1.0)
+    assert coalescer.feed(7, 67, 1.0)
+    # the extremes are reached even within the deadband
+    assert coalescer.feed(7, 126, 1.0)
+    assert coalescer.feed(7, 127, 1.0)
+    assert not coalescer.feed(7, 127, 1.0)
+
+
+def test_deadband_drops_pending():
+    coalescer = Coalescer(period=0.1, deadband=1)
+    assert coalescer.feed('cc', 10, 0.0)
+    assert not coalescer.feed('cc', 20, 0.01)
+    # back to the forwarded value: nothing is left to send
+    assert not coalescer.feed('cc', 10, 0.02)
+    assert coalescer.due(1.0) == []
+
+
+def test_passthrough():
+    coalescer = Coalescer(period=10, passthrough=('/noteon',))
+    assert all(coalescer.feed('/noteon', i, 0.0) for i in range(5))
+    coalescer.configure(passthrough=())
+    assert coalescer.feed('/noteon', 1, 0.0)
+    assert not coalescer.feed('/noteon', 2, 0.0)
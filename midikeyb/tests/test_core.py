@@ -0,0 +1,78 @@
+import logging
+import threading
+
+import pytest
+
+pytest.importorskip("liblo")
+pytest.importorskip("rtmidi2")
+
+from zaehmungen import core
+from zaehmungen.journal import Journal, journal_files, read_journal, replay
+from zaehmungen.logqueue import RateLimitFilter
+from zaehmungen.session import Session
+
+# away from the ports of a running controller
+PORTBASE = 17770
+
+
+@pytest.fixture
+def keyb(tmp_path):
+    keyb = core.MidiKeyb(openmidi=False, session=Session(portbase=PORTBASE, gui=False, folder=str(tmp_path)),
+                         journal=False)
+    sent = []
+    keyb._csound_send = lambda path, *args: sent.append((path, args))
+    keyb.sent = sent
+    yield keyb
+    keyb.stop()
+    keyb.close()
+
+
+def test_dump_state_keeps_gain(keyb):
+    keyb.gain_set(0.5)
+    gain = keyb.gain
+    keyb.sent.clear()
+    keyb.dump_state()
+    keyb.dump_state()
+    gains = [args[0] for path, args in keyb.sent if path == '/gain']
+    assert gains == [gain, gain]
+    assert keyb.gain == gain
+
+
+def test_failed_reload_does_not_pause(keyb):
+    # fails in _setup_controllers
+    keyb._reload_apply({'gui_echo_period_ms': 'fast'}, None)
+    assert not keyb._paused
+    keyb.noteon(60, 100)
+    assert [path for path, args in keyb.sent] == ['/noteon']
+
+
+def test_debug_rate_limited_per_call_site(keyb):
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    handler.addFilter(RateLimitFilter(rate=0.001, burst=1))
+    core.logger.addHandler(handler)
+    try:
+        for i in range(3):
+            keyb.debug("first: %d", i)
+            keyb.debug("second: %d", i)
+    finally:
+        core.logger.removeHandler(handler)
+    assert [record.getMessage() for record in records] == ["first: 0", "second: 0"]
+    assert records[0].pathname == __file__
+    assert records[0].lineno != records[1].lineno
+
+
+def test_fast_replay_drops_nothing(keyb, tmp_path):
+    journal = Journal(str(tmp_path / "journal"))
+    for i in range(5000):
+        journal.midi([176, 1, i % 128], i * 0.001)
+    journal.close()
+    _, records = read_journal(journal_files(str(tmp_path / "journal"))[0])
+    assert replay(keyb, records, speed=0) == 5000
+    done = threading.Event()
+    keyb.run_in_dispatcher(done.set)
+    assert done.wait(10)
+    stats = keyb.dispatch_stats()
+    assert stats['overflows'] == 0
+    assert stats['dispatched'] == 5000
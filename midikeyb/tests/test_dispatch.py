@@ -0,0 +1,58 @@
+import time
+
+from zaehmungen.dispatch import Dispatcher, RingBuffer
+
+
+def test_capacity():
+    assert RingBuffer(1000).capacity == 1024
+    assert RingBuffer(4).capacity == 4
+
+
+def test_overflow():
+    ring = RingBuffer(4)
+    assert all(ring.push(i) for i in range(4))
+    assert not ring.push(4)
+    assert ring.overflows == 1
+    assert len(ring) == 4
+    assert ring.pop() == 0
+    assert ring.push(5)
+    assert [ring.pop() for _ in range(4)] == [1, 2, 3, 5]
+    assert ring.pop() is None
+    assert ring.maxdepth == 4
+
+
+def test_wraps_around():
+    ring = RingBuffer(2)
+    for i in range(10):
+        assert ring.push(i)
+        assert ring.pop() == i
+    assert len(ring) == 0
+    assert ring.overflows == 0
+
+
+def test_overflow_reported_once_per_burst():
+    reported = []
+    dispatcher = Dispatcher(lambda msg, timestamp: None, size=2, on_overflow=reported.append)
+    for i in range(5):
+        dispatcher.push([144, 60, 100], i)
+    assert reported == [1]
+    dispatcher.buffer.pop()
+    assert dispatcher.push([144, 60, 100], 5)
+    dispatcher.push([144, 60, 100], 6)
+    assert reported == [1, 4]
+
+
+def test_push_wait_drops_nothing():
+    handled = []
+    dispatcher = Dispatcher(lambda msg, timestamp: handled.append(timestamp), size=4)
+    dispatcher.start()
+    try:
+        for i in range(2000):
+            assert dispatcher.push_wait([144, 60, 100], i)
+        deadline = time.monotonic() + 5
+        while len(handled) < 2000 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        dispatcher.stop()
+    assert handled == list(range(2000))
+    assert dispatcher.buffer.overflows == 0
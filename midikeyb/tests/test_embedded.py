@@ -0,0 +1,49 @@
+from zaehmungen.embedded import EmbeddedCsound
+
+
+class FakeCsound:
+    """
+    Answers the pings of each k-cycle at its end, as the instrument
+    PINGBACK of midikeyb.csd does
+    """
+    def __init__(self, engine, cycles):
+        self.engine = engine
+        self.cycles = cycles
+        self.pinged = []
+        self.channels = {'pingback': 0, 'rms': 0, 'peak': 0, 'cpu': 0}
+
+    def ksmps(self):
+        return 64
+
+    def sr(self):
+        return 48000
+
+    def controlChannel(self, name):
+        return self.channels[name], 0
+
+    def inputMessage(self, message):
+        self.pinged.append(int(message.split()[-1]))
+
+    def performKsmps(self):
+        if not self.cycles:
+            self.engine._csound = None
+            return 0
+        for seq in self.cycles.pop(0):
+            self.engine.send('/ping', (7771, seq))
+        for seq in self.pinged:
+            self.channels['pingback'] = seq
+        self.pinged.clear()
+        return 0
+
+    def cleanup(self):
+        pass
+
+
+def test_every_ping_is_answered():
+    replies = []
+    engine = EmbeddedCsound("midikeyb.csd",
+                            deliver=lambda path, args: path == '/pingback' and replies.append(args[0]))
+    cs = engine._csound = FakeCsound(engine, [[1], [], [2, 3], [4, 5, 6], [7]])
+    engine._perform(cs)
+    assert replies == [1, 2, 3, 4, 5, 6, 7]
+    assert not engine._pings
@@ -0,0 +1,58 @@
+import os
+
+from zaehmungen.journal import Journal, journal_files, read_journal, replay, OSC_STATUS, OSC_CODES
+
+
+class FakeKeyb:
+    def __init__(self):
+        self.received = []
+
+    def midi_feed(self, msg, timestamp):
+        self.received.append(('midi', msg))
+
+    def osc_command(self, path, args):
+        self.received.append(('osc', path, args))
+
+
+def test_opening_prunes_nothing(tmp_path):
+    folder = str(tmp_path)
+    for i in range(3):
+        journal = Journal(folder, records_per_file=4, keep=2)
+        journal.midi([144, 60 + i, 100], 0.0)
+        journal.close()
+    assert len(journal_files(folder)) == 2
+    before = journal_files(folder)
+    # a journal without records neither removes older files nor leaves an empty one
+    Journal(folder, records_per_file=4, keep=2).close()
+    assert journal_files(folder) == before
+
+
+def test_rotate_and_keep(tmp_path):
+    folder = str(tmp_path)
+    journal = Journal(folder, records_per_file=4, keep=2)
+    for i in range(10):
+        journal.midi([144, i, 100], 0.0)
+    journal.close()
+    files = journal_files(folder)
+    assert len(files) == 2
+    counts = [len(read_journal(path)[1]) for path in files]
+    # 10 records: 4 + 4 + 2, the first file was pruned
+    assert counts == [4, 2]
+    assert os.path.getsize(files[-1]) < os.path.getsize(files[0])
+
+
+def test_replay(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.midi([144, 60, 100], 0.5)
+    journal.command('/gain/set', [0.25])
+    journal.command('/test/noteon', [62, 90])
+    journal.command('/not/journaled', [1])
+    journal.midi([128, 60, 0], 0.6)
+    journal.close()
+    _, records = read_journal(journal_files(str(tmp_path))[0])
+    assert [record[1] for record in records] == [144, OSC_STATUS, OSC_STATUS, 128]
+    assert records[1][2] == OSC_CODES['/gain/set']
+    keyb = FakeKeyb()
+    assert replay(keyb, records, speed=0) == 4
+    assert keyb.received == [('midi', [144, 60, 100]), ('osc', '/gain/set', [0.25]),
+                             ('osc', '/test/noteon', [62, 90]), ('midi', [128, 60, 0])]
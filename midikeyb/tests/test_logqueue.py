@@ -0,0 +1,29 @@
+import logging
+
+from zaehmungen.logqueue import RateLimitFilter
+
+
+def make_record(msg, lineno=10, pathname="core.py", level=logging.WARNING):
+    return logging.LogRecord("zaehmungen", level, pathname, lineno, msg, None, None)
+
+
+def test_rate_limit_per_call_site():
+    ratelimit = RateLimitFilter(rate=0.001, burst=2)
+    # formatted messages from one line are one class
+    passed = [ratelimit.filter(make_record(f"port {i} lost")) for i in range(5)]
+    assert passed == [True, True, False, False, False]
+    assert ratelimit.suppressed == 3
+    assert ratelimit.filter(make_record("other", lineno=11))
+    assert ratelimit.filter(make_record("other", level=logging.ERROR))
+
+
+def test_idle_buckets_are_evicted():
+    ratelimit = RateLimitFilter(rate=0.001, burst=1, maxbuckets=4)
+    for lineno in range(100):
+        ratelimit.filter(make_record("x", lineno=lineno))
+    assert len(ratelimit._buckets) == 4
+    assert list(ratelimit._buckets) == [("core.py", lineno, logging.WARNING) for lineno in range(96, 100)]
+    # a bucket in use stays
+    assert not ratelimit.filter(make_record("x", lineno=96))
+    ratelimit.filter(make_record("x", lineno=100))
+    assert ("core.py", 96, logging.WARNING) in ratelimit._buckets
@@ -0,0 +1,25 @@
+from zaehmungen.mapping import velocity_table, mindb_table, ControlTables, gain_tables, ratefactor_table
+
+
+def make_tables(mindb=-30, maxdb=0):
+    gain, gainrel = gain_tables(-80, 0, 0.4)
+    return ControlTables(velocity_table(mindb, maxdb), gain, gainrel, ratefactor_table(0.5, 5),
+                         mindb_table(maxdb), mindb, maxdb)
+
+
+def test_velocity_table():
+    table = velocity_table(-30, 0)
+    assert len(table) == 128
+    assert table[127] == 1.0
+    assert table[0] < table[64] < table[127]
+
+
+def test_sensibility_sweep_reuses_tables():
+    tables = make_tables()
+    assert tables.with_sensibility(-30, 0) is tables
+    mindbs = tables.mindb
+    first = [tables.with_sensibility(mindbs[cc], 0).velamp for cc in range(128)]
+    again = [tables.with_sensibility(mindbs[cc], 0).velamp for cc in range(128)]
+    # a sweep builds each velocity table once
+    assert all(a is b for a, b in zip(first, again))
+    assert tables.with_sensibility(-40, 0).mindb is mindbs
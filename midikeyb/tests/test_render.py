@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from zaehmungen.render import parse_events, TAIL
+
+
+def test_parse_events():
+    events = [
+        (0.0, '/gain', [0.5]),
+        (0.1, '/noteon', [60, 0.2, 0.8]),
+        (0.2, '/noteon', [62, 0.3, 0.4]),
+        (0.3, '/noteoff', [60]),
+        # a retriggered note releases the one sounding
+        (0.4, '/noteon', [62, 0.5, 0.6]),
+        (0.5, '/rate', [12.0]),
+    ]
+    params, notes, end = parse_events(events)
+    assert end == pytest.approx(0.5 + TAIL)
+    assert [(note.start, note.release) for note in notes] == [(0.1, 0.3), (0.2, 0.4), (0.4, end)]
+    assert params['gain'].at(0.05) < 1
+    assert params['gain'].at(1.0) == pytest.approx(0.5)
+    assert params['rate'].at(0.4) == pytest.approx(8.0)
+    assert params['table'].at(1.0) == 0
+
+
+def test_parse_events_stop_and_panic():
+    events = [
+        (0.0, '/noteon', [60, 0.2, 0.8]),
+        (0.0, '/noteon', [61, 0.2, 0.8]),
+        (0.2, '/panic', []),
+        (0.3, '/noteon', [60, 0.2, 0.8]),
+        (0.5, '/stop', []),
+        (0.9, '/noteon', [61, 0.2, 0.8]),
+    ]
+    params, notes, end = parse_events(events)
+    assert end == 0.5
+    assert [note.release for note in notes] == [0.2, 0.2, 0.5]
+    # duration overrides the end
+    _, notes, end = parse_events(events, duration=0.25)
+    assert end == 0.25
+    assert [note.release for note in notes] == [0.2, 0.2, 0.25]
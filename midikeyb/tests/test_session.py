@@ -0,0 +1,25 @@
+import os
+
+from zaehmungen.session import Session, make_sessions, temporary_session
+from zaehmungen.state import CONFIGFILE_USER
+
+
+def test_temporary_session(tmp_path):
+    base = Session("vc", portbase=7790, gui=False, folder=str(tmp_path))
+    (tmp_path / CONFIGFILE_USER).write_text('{"max_polyphony": 8}')
+    with temporary_session(base, prefix="zaehmungen-test-") as session:
+        folder = session.folder
+        assert folder != base.folder
+        assert (session.name, session.portbase, session.gui) == ("vc", 7790, False)
+        with open(session.path(CONFIGFILE_USER)) as f:
+            assert "max_polyphony" in f.read()
+        with open(session.path("laststate.json"), "w") as f:
+            f.write("{}")
+    assert not os.path.exists(folder)
+    assert os.listdir(tmp_path) == [CONFIGFILE_USER]
+
+
+def test_make_sessions():
+    sessions = make_sessions(["vl", "vla", {'name': "vc", 'gui': True}])
+    assert [session.portbase for session in sessions] == [7770, 7780, 7790]
+    assert [session.gui for session in sessions] == [True, False, True]
@@ -0,0 +1,68 @@
+import threading
+
+from zaehmungen.subscribers import SubscriberRegistry, parse_topics, TOPICS
+
+import pytest
+
+
+def make_registry():
+    sent = []
+    registry = SubscriberRegistry(lambda dest, path, *args: sent.append((dest, path, args)), timeout=5)
+    return registry, sent
+
+
+def test_topics_filter_and_rate():
+    registry, sent = make_registry()
+    registry.subscribe(9000, {'levels'}, 10, now=0)
+    registry.publish('/gain', (0.5,), 0)
+    registry.publish('/soundlevel', (0.1, 0.2), 0)
+    registry.publish('/soundlevel', (0.3, 0.4), 0.01)
+    registry.publish('/soundlevel', (0.5, 0.6), 0.02)
+    assert [(path, args) for _, path, args in sent] == [('/soundlevel', (0.1, 0.2))]
+    # the last value is sent once the period is over
+    assert registry.flush(0.05) == pytest.approx(0.1)
+    registry.flush(0.1)
+    assert sent[-1][1:] == ('/soundlevel', (0.5, 0.6))
+
+
+def test_expiry():
+    registry, sent = make_registry()
+    registry.subscribe(9000, set(TOPICS), 0, now=0)
+    registry.subscribe(7772, set(TOPICS), 0, now=0, permanent=True)
+    assert registry.renew(9000, 4)
+    assert registry.expire(8) == []
+    assert [s.key[1] for s in registry.expire(10)] == [9000]
+    assert not registry.renew(9000, 10)
+    assert len(registry) == 1
+
+
+def test_parse_topics():
+    assert parse_topics("") == set(TOPICS)
+    assert parse_topics("levels, status") == {'levels', 'status'}
+    with pytest.raises(ValueError):
+        parse_topics("levels,colors")
+
+
+def test_publish_from_several_threads():
+    registry, sent = make_registry()
+    registry.subscribe(9000, set(TOPICS), 1000, now=0)
+    errors = []
+
+    def publish(i):
+        try:
+            for n in range(2000):
+                registry.publish(f'/p{n % 7}', (i, n), n * 0.0001)
+                registry.flush(n * 0.0001)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=publish, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    stats = registry.stats()
+    assert stats['received'] == 4 * 2000
+    # every forwarded value was sent
+    assert len(sent) == stats['forwarded']
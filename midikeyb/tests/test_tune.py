@@ -0,0 +1,21 @@
+import pytest
+
+pytest.importorskip("liblo")
+pytest.importorskip("rtmidi2")
+
+from zaehmungen import tune
+from zaehmungen.state import json_dump_atomic
+
+
+def test_load_tuning(tmp_path):
+    path = str(tmp_path / "tuning.json")
+    assert tune.load_tuning(48000, path=path) is None
+    json_dump_atomic({'sr': 48000, 'period': 256, 'ksmps': 64, 'buffer': 256, 'hwbuffer': 512}, path)
+    assert tune.load_tuning(48000, 256, path=path)['ksmps'] == 64
+    assert tune.load_tuning(48000, path=path) is not None
+    messages = []
+    # a tuning is only valid for the sample rate it was found for
+    assert tune.load_tuning(None, path=path, log=messages.append) is None
+    assert tune.load_tuning(44100, 256, path=path, log=messages.append) is None
+    assert tune.load_tuning(48000, 128, path=path, log=messages.append) is None
+    assert len(messages) == 3
@@ -0,0 +1,47 @@
+import pytest
+
+from zaehmungen.voices import VoiceAllocator
+
+
+def test_no_limit():
+    voices = VoiceAllocator()
+    for midinote in range(60, 90):
+        assert voices.start(midinote, 0.5) == []
+    assert len(voices) == 30
+
+
+def test_retrigger_stops_the_note():
+    voices = VoiceAllocator(maxvoices=2)
+    voices.start(60, 0.5)
+    voices.start(62, 0.5)
+    # the note itself is stopped, nothing is stolen
+    assert voices.start(60, 0.8) == [60]
+    assert voices.stolen == 0
+    assert voices.release(60)
+    assert not voices.release(60)
+
+
+@pytest.mark.parametrize("policy, victim", [('oldest', 64), ('quietest', 60), ('lowest', 55)])
+def test_steal(policy, victim):
+    voices = VoiceAllocator(maxvoices=3, policy=policy)
+    voices.start(64, 0.5)
+    voices.start(60, 0.1)
+    voices.start(55, 0.9)
+    assert voices.start(70, 0.5) == [victim]
+    assert voices.stolen == 1
+    assert len(voices) == 3
+    assert 70 in voices and victim not in voices
+
+
+def test_lower_limit_steals_several():
+    voices = VoiceAllocator(maxvoices=4)
+    for midinote in (60, 61, 62, 63):
+        voices.start(midinote, 0.5)
+    voices.configure(maxvoices=2)
+    assert voices.start(64, 0.5) == [60, 61, 62]
+    assert voices.stolen == 3
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        VoiceAllocator(policy='loudest')
@@ -0,0 +1,277 @@
+"""
+asyncio mode for the controller
+
+AsyncMidiKeyb runs everything within one asyncio event loop: OSC is sent
+and received through a datagram protocol (no liblo server), MIDI input is
+bridged from the rtmidi thread with call_soon_threadsafe and the periodic
+jobs (heartbeat check, port scan, state dump, metrics) are tasks
+instead of timer threads. The config watcher is a reader of the loop.
+
+    keyb = AsyncMidiKeyb()
+    keyb.start()                # same as asyncio.run(keyb.run())
+
+Within a larger asyncio service:
+
+    keyb = AsyncMidiKeyb()
+    task = asyncio.create_task(keyb.run())
+    ...
+    keyb.stop()
+    await task
+"""
+import asyncio
+import inspect
+import time
+import traceback
+
+from .core import MidiKeyb, METRICS_WRITE_INTERVAL
+from .osc import encode_message, encode_bundle, decode, OscDecodeError
+
+
+def _callback_num_args(func):
+    """
+    As liblo, a callback gets only as many of (path, args, types, src, user_data)
+    as it accepts
+    """
+    spec = inspect.getfullargspec(func)
+    if spec.varargs:
+        return 5
+    n = len(spec.args)
+    if inspect.ismethod(func):
+        n -= 1
+    return min(n, 5)
+
+
+def _resolve(dest):
+    if isinstance(dest, int):
+        return ("127.0.0.1", dest)
+    return dest
+
+
+class OscProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.dispatch(data, addr)
+
+    def error_received(self, exc):
+        self.server.errors += 1
+
+
+class AsyncOscServer:
+    """
+    An OSC server on an asyncio datagram endpoint, with the methods of
+    liblo.Server used by MidiKeyb (add_method, send, port)
+    """
+    def __init__(self, port):
+        self.port = port
+        self.transport = None
+        self.errors = 0
+        self.dropped = 0
+        self._methods = {}
+
+    def add_method(self, path, types, func, user_data=None):
+        self._methods.setdefault(path, []).append((types, func, user_data, _callback_num_args(func)))
+
+    async def open(self, loop):
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: OscProtocol(self), local_addr=("0.0.0.0", self.port))
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def dispatch(self, data, src):
+        try:
+            messages = decode(data)
+        except OscDecodeError:
+            self.errors += 1
+            return
+        for path, types, args in messages:
+            for methodtypes, func, user_data, numargs in self._methods.get(path, ()):
+                if methodtypes is not None and methodtypes != types:
+                    continue
+                try:
+                    func(*(path, args, types, src, user_data)[:numargs])
+                except Exception:
+                    traceback.print_exc()
+
+    def _sendto(self, dest, data):
+        if self.transport is None:
+            self.dropped += 1
+            return
+        self.transport.sendto(data, _resolve(dest))
+
+    def send(self, dest, path, *args):
+        self._sendto(dest, encode_message(path, *args))
+
+    def send_bundle(self, dest, messages):
+        self._sendto(dest, encode_bundle(messages))
+
+
+class AsyncMidiKeyb(MidiKeyb):
+    def __init__(self, openmidi=True, engine=None, session=None, journal=True):
+        self._loop = None
+        self._stopped = None
+        self._flush_handle = None
+        self._openmidi = openmidi
+        self._tasks = []
+        # MIDI ports are opened in run, once there is a loop to bridge to
+        super().__init__(openmidi=False, engine=engine, session=session, journal=journal)
+
+    def _make_address(self, hostname, port):
+        if hostname == "localhost":
+            hostname = "127.0.0.1"
+        return (hostname, port)
+
+    def _new_oscserver(self, port):
+        return AsyncOscServer(port)
+
+    def _start_threads(self):
+        pass
+
+    def _setup_tasks(self):
+        # periodic jobs are started as tasks in run
+        pass
+
+    def _send_bundle(self, dest, messages):
+        self._oscserver.send_bundle(dest, messages)
+        self._osc_counter(self._m_sent, dest).inc(len(messages))
+
+    def midi_callback(self, msg, timestamp):
+        # journaled in the rtmidi thread, as in MidiKeyb.midi_callback
+        journal = self._journal
+        if journal is not None:
+            journal.midi(msg, timestamp)
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._handle_midi, msg, timestamp)
+
+    def _handle_midi(self, msg, timestamp):
+        with self.oscbatch():
+            self._midi_handle(msg, timestamp)
+        self._schedule_flush()
+
+    def _call(self, func, args):
+        try:
+            func(*args)
+        except Exception:
+            traceback.print_exc()
+        except BaseException as e:
+            # connection errors and restarts end run, as they end start in MidiKeyb
+            self._fail(e)
+        self._schedule_flush()
+
+    def _fail(self, exception):
+        if self._stopped is not None and not self._stopped.done():
+            self._stopped.set_exception(exception)
+
+    def _schedule_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        timeout = self._flush_coalesced()
+        if timeout is not None:
+            self._flush_handle = self._loop.call_later(timeout, self._schedule_flush)
+
+    def run_in_dispatcher(self, func, args=()):
+        if self._loop is None:
+            func(*args)
+        else:
+            self._loop.call_soon_threadsafe(self._call, func, args)
+
+    def run_in_mainthread(self, func, args=()):
+        self.run_in_dispatcher(func, args)
+
+    def run_in_background(self, func, args=()):
+        self._loop.call_soon_threadsafe(self._loop.run_in_executor, None, func, *args)
+
+    def _add_reader(self, fd, callback):
+        self._loop.add_reader(fd, callback)
+
+    def _remove_reader(self, fd):
+        self._loop.remove_reader(fd)
+
+    def _call_later(self, delay, func, args=()):
+        return self._loop.call_later(delay, self._call, func, args)
+
+    async def _periodic(self, interval, func, blocking=False):
+        """
+        blocking: run func in the default executor (for file io)
+        """
+        await asyncio.sleep(interval)
+        while True:
+            if blocking:
+                await self._loop.run_in_executor(None, func)
+            else:
+                self._call(func, ())
+            await asyncio.sleep(interval)
+
+    async def run(self):
+        self._loop = loop = asyncio.get_running_loop()
+        self._stopped = loop.create_future()
+        await self._oscserver.open(loop)
+        self.debug("OSC server listening on port: " + str(self._oscserver.port))
+        self._running = True
+        self._starttime = time.time()
+        if self._openmidi:
+            self.midi_restart()
+        self._tasks = [
+            loop.create_task(self._periodic(1.0, self.background_task)),
+            loop.create_task(self._periodic(1.9, self.midi_check_new_ports)),
+            loop.create_task(self._periodic(METRICS_WRITE_INTERVAL, self.metrics_write, blocking=True)),
+        ]
+        self._probe_tick()
+        if not self._watch_config():
+            self._tasks.append(loop.create_task(self._periodic(1.7, self.userconfig_watcher.tick, blocking=True)))
+        try:
+            await self._stopped
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+            self._unwatch_config()
+            if self._midiin is not None:
+                self._midiin.close_ports()
+            self._oscserver.close()
+            self._loop = None
+            self.debug("stopped")
+
+    def start(self):
+        asyncio.run(self.run())
+
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def stop(self):
+        """
+        Can be called from any thread. The teardown of MidiKeyb.stop, the
+        tasks are cancelled when run ends
+        """
+        if self._loop is not None and not self._in_loop():
+            self._loop.call_soon_threadsafe(self.stop)
+            return
+        self.debug("stopping csound...")
+        self._running = False
+        self.stopped = True
+        self.state_save()
+        self._csound_send('/stop', 1.0)
+        if self._probe_handle is not None:
+            self._probe_handle.cancel()
+        if self._config_reload_handle is not None:
+            self._config_reload_handle.cancel()
+        self.journal_stop()
+        if self._stopped is not None and not self._stopped.done():
+            self._stopped.set_result(None)
+        stats = self.coalesce_stats()
+        self.debug(f"coalescing: suppressed {stats['cc']['suppressed']} of {stats['cc']['received']} CC messages, "
+                   f"{stats['gui']['suppressed']} of {stats['gui']['received']} gui echoes")
+        stats = self.state_stats()
+        self.debug(f"state: {stats['writes']} writes for {stats['updates']} changes")
+        if self.on_stop is not None:
+            self.on_stop()
@@ -0,0 +1,343 @@
+"""
+MIDI-to-OSC latency benchmark
+
+Feeds MIDI (a Standard MIDI File or generated stress patterns) directly
+into MidiKeyb.midi_callback and captures every outgoing OSC packet on
+stand-in listeners bound to the ports of the engine (CSD_OSCPORT) and the
+gui (INFO_OSCPORT). No csound, puredata or jack is needed.
+
+Reported latency is the time between entering midi_callback and the
+arrival of each packet caused by that message at the stand-in listener.
+This includes the hop through the MIDI dispatcher thread. Messages handled
+together are sent together (as OSC bundles), their packets are attributed
+to the oldest of them.
+
+Fed as fast as possible, each message waits for room in the dispatcher
+(MidiKeyb.midi_feed) instead of being dropped, the callback duration then
+includes that wait. With --realtime the messages go through midi_callback,
+as from a keyboard. A run which lost messages to an overflow of the
+dispatcher is reported as invalid, without latencies.
+
+Run from the midikeyb folder:
+
+    $ python3 -m zaehmungen.bench
+    $ python3 -m zaehmungen.bench --pattern chords --repeat 5
+    $ python3 -m zaehmungen.bench --midifile performance.mid --realtime
+"""
+import argparse
+import socket
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+
+from . import core
+from .midifile import read_midifile
+from .session import temporary_session
+
+
+NOTEON = 144
+NOTEOFF = 128
+CC = 176
+
+
+def chord_bursts(numchords=100, chordsize=8, dur=0.25, sustain=64):
+    """
+    Chords of `chordsize` notes, every second chord with the sustain
+    pedal pressed. Returns a list of (time, msg)
+    """
+    events = []
+    now = 0
+    for i in range(numchords):
+        notes = [core.C3 + (i * 5 + j * 4) % 48 for j in range(chordsize)]
+        notes = sorted(set(notes))
+        pedal = i % 2 == 1
+        if pedal:
+            events.append((now, [CC, sustain, 127]))
+        for j, note in enumerate(notes):
+            events.append((now + j * 0.001, [NOTEON, note, 40 + (i * 7 + j * 13) % 87]))
+        for note in notes:
+            events.append((now + dur, [NOTEOFF, note, 0]))
+        if pedal:
+            events.append((now + dur + 0.01, [CC, sustain, 0]))
+        now += dur * 1.2
+    return events
+
+
+def pedal_sweeps(cc, numsweeps=10, step=0.002):
+    """
+    Sweep the expression pedal all the way up and down, one message
+    per midi value
+    """
+    events = []
+    now = 0
+    values = list(range(128)) + list(range(127, -1, -1))
+    for _ in range(numsweeps):
+        for value in values:
+            events.append((now, [CC, cc, value]))
+            now += step
+    return events
+
+
+def cc_floods(ccs, numvalues=2000, step=0.0005):
+    """
+    Interleave a fast stream of values over the given controllers
+    """
+    events = []
+    for i in range(numvalues):
+        cc = ccs[i % len(ccs)]
+        value = (i * 37) % 128
+        events.append((i * step, [CC, cc, value]))
+    return events
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+class StandInListener:
+    """
+    Receives UDP packets on the given port and stamps their arrival time
+    """
+    def __init__(self, port):
+        self.port = port
+        self.arrivals = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.sock.bind(("127.0.0.1", port))
+        self.sock.settimeout(0.1)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        clock = time.perf_counter
+        arrivals = self.arrivals
+        while self._running:
+            try:
+                self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            arrivals.append(clock())
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        self.sock.close()
+
+
+class SendRecorder:
+    """
+    Stands in for the liblo server of MidiKeyb. Every send is forwarded
+    to the real server and the index of the event being handled by the
+    dispatcher is recorded per destination port
+    """
+    def __init__(self, server):
+        self._server = server
+        self._lock = threading.Lock()
+        self.current_event = None
+        self.sent = {}
+
+    def __getattr__(self, attr):
+        return getattr(self._server, attr)
+
+    def send(self, dest, *args):
+        port = dest if isinstance(dest, int) else dest.port
+        with self._lock:
+            self.sent.setdefault(port, []).append(self.current_event)
+            self._server.send(dest, *args)
+
+
+class Bench:
+    """
+    The keyboard runs in a temporary session folder, with a copy of the
+    user config: the bench leaves the state and the journal of the user alone
+    """
+    def __init__(self, ports=(core.CSD_OSCPORT, core.INFO_OSCPORT)):
+        self.listeners = {port: StandInListener(port) for port in ports}
+        self._cleanup = ExitStack()
+        session = self._cleanup.enter_context(temporary_session(prefix="zaehmungen-bench-"))
+        self.keyb = core.MidiKeyb(openmidi=False, session=session, journal=False)
+        self.recorder = SendRecorder(self.keyb._oscserver)
+        self.keyb._oscserver = self.recorder
+        self._eventindex = {}
+        dispatcher = self.keyb._dispatcher
+        dispatcher.handler = self._make_handler(dispatcher.handler)
+        dispatcher.drain_context = self._make_drain_context(dispatcher.drain_context)
+
+    def _make_handler(self, handler):
+        recorder = self.recorder
+        eventindex = self._eventindex
+
+        def wrapped(msg, timestamp):
+            # each fed message is a distinct list, its identity tells which
+            # event is being handled. Packets are attributed to the oldest
+            # message handled within the same drain of the dispatcher
+            # queue, since messages handled together are sent together
+            if recorder.current_event is None:
+                recorder.current_event = eventindex.get(id(msg))
+            handler(msg, timestamp)
+        return wrapped
+
+    def _make_drain_context(self, context):
+        recorder = self.recorder
+
+        @contextmanager
+        def wrapped():
+            with context():
+                yield
+            recorder.current_event = None
+        return wrapped
+
+    def run(self, events, realtime=False):
+        """
+        Feed events (a list of (time, msg)) into midi_callback
+
+        realtime: if True, events are fed at their timestamps, otherwise
+                  as fast as possible, waiting for room in the dispatcher
+        """
+        for listener in self.listeners.values():
+            listener.arrivals.clear()
+        self.recorder.sent.clear()
+        self._eventindex.clear()
+        self._eventindex.update((id(msg), i) for i, (t, msg) in enumerate(events))
+        dispatcher = self.keyb._dispatcher
+        coalesce0 = self.keyb.coalesce_stats()
+        overflows0 = dispatcher.buffer.overflows
+        dispatcher.buffer.maxdepth = 0
+        callback = self.keyb.midi_callback if realtime else self.keyb.midi_feed
+        clock = time.perf_counter
+        starts = []
+        durations = []
+        lasttime = 0
+        t_start = clock()
+        for i, (t, msg) in enumerate(events):
+            if realtime:
+                delay = t_start + t - clock()
+                if delay > 0:
+                    time.sleep(delay)
+            t0 = clock()
+            callback(msg, t - lasttime)
+            durations.append(clock() - t0)
+            starts.append(t0)
+            lasttime = t
+        self._wait_for_dispatcher()
+        t_end = clock()
+        self._wait_for_arrivals()
+        report = self._report(starts, durations, t_end - t_start)
+        report['overflows'] = dispatcher.buffer.overflows - overflows0
+        # the latencies of the messages which survived an overflow mean nothing
+        report['valid'] = report['overflows'] == 0
+        report['maxdepth'] = dispatcher.buffer.maxdepth
+        coalesce = self.keyb.coalesce_stats()
+        for kind in ('cc', 'gui'):
+            report[kind + '_suppressed'] = coalesce[kind]['suppressed'] - coalesce0[kind]['suppressed']
+        return report
+
+    def _wait_for_dispatcher(self, timeout=5):
+        # wait until the queue is drained and the last message handled
+        done = threading.Event()
+        self.keyb.run_in_dispatcher(done.set)
+        done.wait(timeout)
+
+    def _wait_for_arrivals(self, timeout=1):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if all(len(self.listeners[port].arrivals) >= len(sent)
+                   for port, sent in self.recorder.sent.items() if port in self.listeners):
+                return
+            time.sleep(0.01)
+
+    def _report(self, starts, durations, elapsed):
+        latencies = []
+        numpackets = 0
+        lost = 0
+        for port, listener in self.listeners.items():
+            sent = self.recorder.sent.get(port, [])
+            arrivals = listener.arrivals
+            numpackets += len(arrivals)
+            lost += max(0, len(sent) - len(arrivals))
+            # UDP on localhost preserves order, so the n-th packet arriving
+            # at a port is the n-th packet sent to it
+            for eventidx, arrival in zip(sent, arrivals):
+                if eventidx is not None:
+                    latencies.append(arrival - starts[eventidx])
+        return {
+            'events': len(starts),
+            'packets': numpackets,
+            'lost': lost,
+            'elapsed': elapsed,
+            'events_per_sec': len(starts) / elapsed if elapsed > 0 else 0,
+            'msgs_per_sec': numpackets / elapsed if elapsed > 0 else 0,
+            'latency_p50': percentile(latencies, 50),
+            'latency_p99': percentile(latencies, 99),
+            'latency_max': max(latencies) if latencies else 0,
+            'callback_p50': percentile(durations, 50),
+            'callback_p99': percentile(durations, 99),
+            'callback_max': max(durations) if durations else 0,
+        }
+
+    def close(self):
+        # the dispatcher is stopped before the server it sends with is freed.
+        # The scheduler is a daemon thread, it dies with the process
+        self.keyb.stop()
+        self.keyb.close()
+        for listener in self.listeners.values():
+            listener.close()
+        self._cleanup.close()
+
+
+def print_report(name, report):
+    ms = 1000
+    print(f"--- {name}")
+    print(f"    events: {report['events']}, packets: {report['packets']}, lost: {report['lost']}, "
+          f"elapsed: {report['elapsed']:.3f} s")
+    print(f"    events/s: {report['events_per_sec']:.0f}, msgs/s: {report['msgs_per_sec']:.0f}")
+    print(f"    dispatcher max. depth: {report['maxdepth']}, overflows: {report['overflows']}")
+    print(f"    suppressed CC messages: {report['cc_suppressed']}, gui echoes: {report['gui_suppressed']}")
+    if not report['valid']:
+        print(f"    INVALID: {report['overflows']} messages were dropped by the dispatcher, no latencies reported")
+        return
+    print(f"    callback-to-send latency (ms)  p50: {report['latency_p50']*ms:.3f}  "
+          f"p99: {report['latency_p99']*ms:.3f}  max: {report['latency_max']*ms:.3f}")
+    print(f"    callback duration (ms)         p50: {report['callback_p50']*ms:.3f}  "
+          f"p99: {report['callback_p99']*ms:.3f}  max: {report['callback_max']*ms:.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MIDI-to-OSC latency benchmark for MidiKeyb")
+    parser.add_argument("--pattern", default="all", choices=["all", "chords", "pedal", "cc"])
+    parser.add_argument("--midifile", help="replay a Standard MIDI File instead of the generated patterns")
+    parser.add_argument("--realtime", action="store_true",
+                        help="feed events at their timestamps instead of as fast as possible")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    bench = Bench()
+    config = bench.keyb.config
+    scenarios = []
+    if args.midifile:
+        scenarios.append((args.midifile, read_midifile(args.midifile)))
+    else:
+        if args.pattern in ("all", "chords"):
+            scenarios.append(("chord bursts", chord_bursts(sustain=config['CC_sustain'])))
+        if args.pattern in ("all", "pedal"):
+            scenarios.append(("pedal sweeps", pedal_sweeps(config['CC_gainchange'])))
+        if args.pattern in ("all", "cc"):
+            ccs = [config[key] for key in ('CC_gainchange', 'CC_sensibility', 'CC_compressor', 'CC_randomness',
+                                             'CC_ratefactor')]
+            scenarios.append(("cc floods", cc_floods(ccs)))
+    try:
+        for name, events in scenarios:
+            for i in range(args.repeat):
+                report = bench.run(events, realtime=args.realtime)
+                print_report(name if args.repeat == 1 else f"{name} #{i+1}", report)
+    finally:
+        bench.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Bouncing recordings to audio with csound
+
+Each recording (see recorder.py) is turned into a score for midikeyb.csd
+and rendered by csound in non realtime (-o file.wav, no jack), one csound
+process per core. The csd is run as when embedded (the EMBEDDED macro):
+there is no OSC listener, so that several engines can run at once, and
+the parameters are score events writing the control channels (instr
+SETCHN). Notes are the events of instr NOTEON, NOTEOFF and PANIC.
+
+Run from the midikeyb folder:
+
+    $ python3 -m zaehmungen.bounce                  # all of ~/.zaehmungen/recordings
+    $ python3 -m zaehmungen.bounce rec1.jsonl rec2.jsonl --outdir bounces --jobs 4
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import re
+import subprocess
+import tempfile
+import time
+
+from . import csoundtools
+from .recorder import RECORDINGS_FOLDER, load_events
+
+
+CSDPATH = "assets/midikeyb.csd"
+
+# instrument numbers of midikeyb.csd
+INSTR_SETCHN = 1
+INSTR_NOTEON = 30
+INSTR_NOTEOFF = 31
+INSTR_PANIC = 32
+
+# the parameter messages and the channels they set
+CHANNELS = {'/rate': 'rate', '/speed': 'speed', '/dur': 'dur', '/gain': 'gain', '/table': 'table',
+            '/compress': 'compress', '/random': 'random'}
+
+# time rendered after the last event, in seconds
+TAIL = 1.0
+
+
+def score_lines(events):
+    """
+    Converts the messages of a recording to score statements. Returns
+    (lines, duration)
+    """
+    lines = []
+    end = None
+    for t, path, args in events:
+        channel = CHANNELS.get(path)
+        if channel is not None:
+            lines.append(f'i {INSTR_SETCHN} {t:.6f} 1 "{channel}" {float(args[0])}')
+        elif path == '/noteon':
+            midinote, pos, gain = args
+            lines.append(f'i {INSTR_NOTEON} {t:.6f} 1 {int(midinote)} {float(pos)} {float(gain)}')
+        elif path == '/noteoff':
+            lines.append(f'i {INSTR_NOTEOFF} {t:.6f} 1 {int(args[0])}')
+        elif path == '/panic':
+            lines.append(f'i {INSTR_PANIC} {t:.6f} 1')
+        elif path == '/stop':
+            end = t
+            break
+    if end is None:
+        end = (events[-1][0] if events else 0) + TAIL
+    lines.append(f'f 0 {end:.6f}')
+    lines.append('e')
+    return lines, end
+
+
+def make_csd(csdtext, lines):
+    """
+    Returns the text of the csd with its score replaced by lines
+    """
+    score = "<CsScore>\n" + "\n".join(lines) + "\n</CsScore>"
+    out, count = re.subn(r"<CsScore>.*</CsScore>", lambda m: score, csdtext, flags=re.DOTALL)
+    if count != 1:
+        raise ValueError("the csd has no score section")
+    return out
+
+
+def bounce_one(job):
+    """
+    Renders one recording. Runs in a worker process. job is a dict with
+    recording, output, csdtext and options. Returns a dict with the
+    duration rendered and the time it took
+    """
+    recording, output = job['recording'], job['output']
+    t0 = time.perf_counter()
+    lines, duration = score_lines(load_events(recording))
+    fd, csdpath = tempfile.mkstemp(suffix=".csd", prefix="bounce-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(make_csd(job['csdtext'], lines))
+        args = ["csound", "--omacro:EMBEDDED=1", "-o", output, "-W", "-f", "-d", "--messagelevel=0"]
+        args += job['options'] + [csdpath]
+        proc = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    finally:
+        os.remove(csdpath)
+    error = None
+    if proc.returncode != 0:
+        error = proc.stderr.strip().splitlines()[-1:] or [f"exit code {proc.returncode}"]
+        error = error[0]
+    return {'recording': recording, 'output': output, 'duration': duration,
+            'elapsed': time.perf_counter() - t0, 'error': error}
+
+
+def csound_options(sr, ksmps, csdpath=CSDPATH, log=print):
+    """
+    The options for bounce_one: the rate, the sound files and where to find them
+    """
+    options = [f"--sample-rate={sr}", f"--ksmps={ksmps}"]
+    try:
+        from . import sndfiles
+    except ImportError:
+        log("numpy not found, using the sndfiles in assets/sndfiles48")
+    else:
+        options += sndfiles.csound_macros(sndfiles.prepare_sndfiles(sr, log=log))
+    # the default sound files are relative to the midikeyb folder
+    options.append(f"--env:SSDIR={os.path.dirname(os.path.dirname(os.path.abspath(csdpath)))}")
+    return options
+
+
+def bounce(recordings, outdir, sr=44100, ksmps=64, jobs=None, csdpath=CSDPATH, log=print):
+    """
+    Bounce the recordings to outdir, in parallel. Returns the results of
+    bounce_one, in the order they finished
+    """
+    if not csoundtools.find_csound():
+        raise RuntimeError("csound was not found")
+    os.makedirs(outdir, exist_ok=True)
+    with open(csdpath) as f:
+        csdtext = f.read()
+    options = csound_options(sr, ksmps, csdpath, log=log)
+    joblist = [{'recording': path, 'output': os.path.join(outdir, os.path.splitext(os.path.basename(path))[0] + ".wav"),
+                'csdtext': csdtext, 'options': options}
+               for path in recordings]
+    jobs = min(jobs or os.cpu_count() or 1, max(len(joblist), 1))
+    log(f"bouncing {len(joblist)} recordings with {jobs} processes")
+    results = []
+    t0 = time.perf_counter()
+    audio = 0.0
+    with multiprocessing.Pool(jobs) as pool:
+        for result in pool.imap_unordered(bounce_one, joblist):
+            results.append(result)
+            wall = time.perf_counter() - t0
+            name = os.path.basename(result['recording'])
+            if result['error']:
+                log(f"[{len(results)}/{len(joblist)}] {name}: FAILED: {result['error']}")
+                continue
+            audio += result['duration']
+            log(f"[{len(results)}/{len(joblist)}] {name}: {result['duration']:.1f} s in {result['elapsed']:.1f} s "
+                f"({result['duration'] / max(result['elapsed'], 1e-9):.1f}x), "
+                f"total {audio / max(wall, 1e-9):.1f}x realtime")
+    failed = sum(1 for result in results if result['error'])
+    wall = time.perf_counter() - t0
+    log(f"done: {len(results) - failed} bounced, {failed} failed, {audio:.1f} s of audio in {wall:.1f} s "
+        f"({audio / max(wall, 1e-9):.1f}x realtime)")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bounce recordings to audio with csound, in parallel")
+    parser.add_argument("recordings", nargs="*", help=f"recordings (.jsonl), default: all in {RECORDINGS_FOLDER}")
+    parser.add_argument("--outdir", default="bounces")
+    parser.add_argument("--sr", type=int, default=44100)
+    parser.add_argument("--ksmps", type=int, default=64)
+    parser.add_argument("--jobs", type=int, help="number of csound processes (default: one per core)")
+    args = parser.parse_args()
+    recordings = args.recordings or sorted(glob.glob(os.path.join(RECORDINGS_FOLDER, "*.jsonl")))
+    if not recordings:
+        parser.error("no recordings found")
+    results = bounce(recordings, args.outdir, sr=args.sr, ksmps=args.ksmps, jobs=args.jobs)
+    if any(result['error'] for result in results):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
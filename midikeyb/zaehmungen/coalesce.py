@@ -0,0 +1,100 @@
+"""
+Coalescing of fast streams of values (CC sweeps, gui echoes)
+
+For each key at most one value is forwarded per period. Values arriving
+within the period replace each other, the latest one is forwarded when
+the period is over (see Coalescer.due). A deadband drops values which
+differ too little from the last forwarded value.
+"""
+
+
+class Coalescer:
+    """
+    period: min. time between two forwarded values of the same key, in seconds
+    deadband: values which differ from the last forwarded value by this
+              amount or less are dropped (only for numbers)
+    always: values which are always forwarded if they differ from the last
+            forwarded value, even if within the deadband (for example the
+            extremes of a midi controller, so that a pedal can always reach them)
+    passthrough: keys which are never coalesced
+    """
+    def __init__(self, period=0.02, deadband=0, always=(), passthrough=()):
+        self.period = period
+        self.deadband = deadband
+        self.always = set(always)
+        self.passthrough = set(passthrough)
+        self.received = 0
+        self.forwarded = 0
+        self._last = {}       # key -> (time, value) of the last forwarded value
+        self._pending = {}    # key -> latest value not yet forwarded
+
+    def configure(self, period=None, deadband=None, passthrough=None):
+        if period is not None:
+            self.period = period
+        if deadband is not None:
+            self.deadband = deadband
+        if passthrough is not None:
+            self.passthrough = set(passthrough)
+
+    @property
+    def suppressed(self):
+        return self.received - self.forwarded - len(self._pending)
+
+    def _in_deadband(self, oldvalue, value):
+        if value == oldvalue:
+            return True
+        if value in self.always:
+            return False
+        return self.deadband > 0 and abs(value - oldvalue) <= self.deadband
+
+    def feed(self, key, value, now):
+        """
+        Returns True if the value should be forwarded now. Otherwise it
+        is either dropped or kept as pending, to be returned by `due`
+        """
+        self.received += 1
+        if key in self.passthrough:
+            self.forwarded += 1
+            return True
+        last = self._last.get(key)
+        if last is not None and self._in_deadband(last[1], value):
+            self._pending.pop(key, None)
+            return False
+        if last is None or now - last[0] >= self.period:
+            self._last[key] = (now, value)
+            self._pending.pop(key, None)
+            self.forwarded += 1
+            return True
+        self._pending[key] = value
+        return False
+
+    def due(self, now):
+        """
+        Returns a list of (key, value) of pending values whose period is over.
+        These are considered forwarded
+        """
+        if not self._pending:
+            return []
+        out = []
+        period = self.period
+        last = self._last
+        for key, value in list(self._pending.items()):
+            if now - last[key][0] >= period:
+                del self._pending[key]
+                last[key] = (now, value)
+                self.forwarded += 1
+                out.append((key, value))
+        return out
+
+    def next_deadline(self):
+        """
+        Returns the time at which the next pending value is due, or None
+        """
+        if not self._pending:
+            return None
+        last = self._last
+        return min(last[key][0] for key in self._pending) + self.period
+
+    def stats(self):
+        return {'received': self.received, 'forwarded': self.forwarded,
+                'suppressed': self.suppressed, 'pending': len(self._pending)}
@@ -3,25 +3,94 @@ import os
 
 import operator
 import time
+import threading
 from numbers import Number
 import liblo
 import rtmidi2
 import timer3
-from queue import Queue
 
 from .utils import *
 from .state import *
 from .error import *
+from .dispatch import Dispatcher
+from .coalesce import Coalescer
+from .oscbatch import OscBatcher
+from .mapping import compile_tables, export_tables, gain_curve
+from .mainloop import MainLoop
+from .persist import StateWriter
+from .watch import FileModificationWatcher, InotifyWatcher, config_diff, config_subsystems
+from .metrics import Metrics
+from .voices import VoiceAllocator
+from .governor import Governor
+from .probe import LatencyProbe, GRADES
+from .oscbatch import destination_key
+from .recorder import EventRecorder, RECORDINGS_DIR
+from .journal import Journal, OSC_CODES, JOURNAL_DIR
+from .session import Session, DEFAULT_PORTBASE, PORT_CSD, PORT_CORE, PORT_INFO
+from .subscribers import SubscriberRegistry, TOPICS, parse_topics
 
 logger = get_logger()
 
+
+def timed(handler):
+    """
+    Decorator, records the execution time of a method of MidiKeyb
+    in the handler_seconds histogram
+    """
+    def decorator(method):
+        def wrapper(self, *args):
+            t0 = time.perf_counter()
+            try:
+                return method(self, *args)
+            finally:
+                self._m_handler_time[handler].observe(time.perf_counter() - t0)
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+    return decorator
+
 DEBUG_TO_CONSOLE = True
 
+# Size of the ring buffer between the rtmidi callback and the dispatcher
+MIDI_BUFFER_SIZE = 1024
+
+# messages to the puredata gui which are throttled (see config key gui_echo_period_ms)
+GUI_THROTTLED = {'/gain', '/gainrel', '/mindb', '/maxdb', '/compress', '/random', '/rate', '/throttle'}
+
+# changes of the state are written after this time (in seconds), to write a sweep at once
+STATE_SAVE_DELAY = 1.0
+
+# a changed config is reloaded once no more changes arrive within this time (in seconds)
+CONFIG_DEBOUNCE = 0.05
+
+# period of the csound heartbeat (HEARTFREQ in midikeyb.csd), in seconds
+HEARTBEAT_PERIOD = 0.5
+
+# period of /info (INFOSENDFREQ in midikeyb.csd), in seconds
+INFO_PERIOD = 1 / 18
+
+# interval of the round-trip probe (/ping to csound), in seconds
+PROBE_INTERVAL = 0.25
+
+# a supervised csound which sends no heartbeat for this time after being
+# started is restarted, in seconds (see supervisor.py)
+ENGINE_START_TIMEOUT = 5
+
+# the throttle factor of the governor is sent again when it changes by more than this
+THROTTLE_RESOLUTION = 0.01
+
+# the metrics are written to this file (in the Prometheus text format) periodically,
+# within the folder of the session (see session.py)
+METRICS_FILE = "metrics.prom"
+METRICS_PATH = os.path.join(USERFOLDER, METRICS_FILE)
+METRICS_WRITE_INTERVAL = 10
+
 # Internal Constants
-# OSC port where Csound is listening, this must match the port given in the CSD file
-CSD_OSCPORT = 7770      
-CORE_OSCPORT = 7771
-INFO_OSCPORT = 7772
+# The ports of the default session. OSC port where Csound is listening, this must
+# match the port given in the CSD file. Other sessions pass theirs to csound
+CSD_OSCPORT = DEFAULT_PORTBASE + PORT_CSD
+CORE_OSCPORT = DEFAULT_PORTBASE + PORT_CORE
+INFO_OSCPORT = DEFAULT_PORTBASE + PORT_INFO
 
 # these should match the order in gi_sndfiles in midikeyb.csd
 TABLE_VL = 0       
@@ -55,77 +124,286 @@ SPEEDVALUES = [
     6.3496042078727957,  7.9999999999999973,   10.079368399158982,  12.699208415745593, 15.999999999999993
 ]
 
-class FileModificationWatcher(object):
-    def __init__(self, path, callback, time_threshold=0.5):
+class MidiKeyb:
+    def __init__(self, openmidi=True, engine=None, session=None, mainloop=None, scheduler=None, journal=True):
         """
-        time_threshold: the difference in time that will trigger a callback
+        openmidi: if False, no MIDI ports are opened. MIDI can still be fed
+                  by calling midi_callback directly (see bench.py)
+        engine: an EngineSupervisor owning the csound process, or an
+                EmbeddedCsound performing it in-process. If given, a csound
+                which dies or hangs is restarted, otherwise the controller
+                stops (see supervisor.py, embedded.py)
+        session: the ports, MIDI ports and folder of this keyboard (see
+                 session.py). Default: the single keyboard, ports 7770-7772
+                 and ~/.zaehmungen
+        mainloop, scheduler: a MainLoop and a timer3.Timer shared with other
+                 sessions (see host.py). The owner runs and stops them,
+                 start and stop only concern this session
+        journal: if False, nothing is journaled, whatever the config says
+                 (for the tools: bench, regress, replay)
         """
-        self.path = path
-        self.callback = callback
-        self.last_modified = os.stat(path).st_mtime
-        self.threshold = time_threshold
-        
-    def tick(self):
-        mtime = os.stat(self.path).st_mtime
-        if mtime - self.last_modified > self.threshold:
-            self.callback()
-            self.last_modified = mtime
-
-
-class MidiKeyb:
-    def __init__(self):
+        self.session = session = session if session is not None else Session()
+        self._logprefix = f"[{session.name}] " if session.name else ""
+        log_to_console(DEBUG_TO_CONSOLE)
         self.debug("-" * 20)
         self.debug('STARTING MidiKeyb'.center(20))
         self.debug("-" * 20)
         
         self._running = False
         self._paused = False
+        self.stopped = False
+        # called at the end of stop (see host.py)
+        self.on_stop = None
         self._midiin = None
         self._midi_enabled_channels = [1 for i in range(16)]
         self._midi_inports = []
+        self._midi_connected_ports = []
+        self._midi_available_ports = set()
         self._csd_connected = False
         self._gui_connected = False
-        self._csound_addr = liblo.Address("127.0.0.1", CSD_OSCPORT)
-
-        # Support for running funtions on the main thread
-        self._tasks = Queue()
-        self._tasks_lastcheck = 0
+        self._csound_addr = self._make_address(session.engine_host, session.csd_port)
+
+        self._mainloop = mainloop
+        self._scheduler = scheduler
+        self._shared_loop = mainloop is not None
+        # the periodic tasks, cancelled on stop when the scheduler is shared
+        self._scheduled = []
+        self._probe_handle = None
         self.background_task_lasttime = 0
         self._background_tast_enabled = True
         self._lastheartbeat = 0
         self._gui_lastheartbeat = 0
-        self._scheduler = timer3.Timer(precision=0.05)
-
-        result = config_load()
+        self._heart_lasttime = None
+        self._throttle_sent = 1.0
+        self._setup_metrics()
+        # All MIDI handling and state changes happen in the dispatcher thread
+        self._dispatcher = Dispatcher(self._midi_handle, size=MIDI_BUFFER_SIZE,
+                                      on_error=lambda e: self.error(f"dispatcher: {e!r}"),
+                                      on_idle=self._flush_coalesced,
+                                      drain_context=self.oscbatch,
+                                      on_overflow=self._midi_overflow)
+        # CC sweeps are coalesced, see _setup_config_dependencies
+        self._ccfilter = Coalescer(always=(0, 127))
+        # the gui and other clients subscribe to what info sends, each
+        # at its own rate (see subscribers.py)
+        self.subscribers = SubscriberRegistry(self._send)
+        self._gui_subscriber = None
+        self._batcher = OscBatcher(self._send_message, self._send_bundle)
+        # the sounding notes, see config keys max_polyphony and voice_steal_policy
+        self.voices = VoiceAllocator()
+        # scales down the grain rate and duration when csound is overloaded
+        self.governor = Governor()
+        self._grainscale = 1.0
+        # measures the round-trip time to csound, warns when it is getting slow
+        self.probe = LatencyProbe(self._send_ping, interval=PROBE_INTERVAL)
+        # set when the peers are up, see _mark_ready and startup.py
+        self.ready = {name: threading.Event()
+                      for name in ('engine', 'gui', 'roundtrip') if name != 'gui' or session.gui}
+        self.ready_times = {}
+        self.engine = engine
+        self._recorder = None
+        self._recording_path = None
+        # an embedded csound is controlled through channels instead of OSC
+        self._embedded = engine is not None and engine.embedded
+        self._engine_restart_time = None
+
+        result = config_load(session.folder)
         if result['error']:
             self.error("Error loading configfile: %s" % result['error'])
         self.config = result['config']
+        # the config as loaded, without runtime changes. A reload applies the keys which differ from it
+        self._loaded_config = dict(self.config)
+        if session.gui:
+            self._gui_subscribe()
         
         self._userconfig_path = result['userconfig']
+        # every MIDI message and OSC command is journaled, see journal.py
+        self._journal = None
+        self._journal_allowed = journal
+        self._osc_commands = {}
+        self._setup_journal()
         self.userconfig_watcher = FileModificationWatcher(self._userconfig_path, self.reload)
+        self._config_inotify = None
+        self._config_reload_handle = None
+        # the last state is written in the background, whenever it changes
+        self._statewriter = StateWriter(state_path(session.folder), delay=STATE_SAVE_DELAY,
+                                        written=state_load(session.folder))
+        self._statewriter.start()
 
         self.reset()
         self._create_oscserver()
-        
-        time.sleep(0.5)
-        self.midi_restart()
+        self._start_threads()
+        if engine is not None:
+            engine.on_exit = lambda returncode: self.run_in_mainthread(self._engine_exited, (returncode,))
+            if self._embedded:
+                engine.deliver = lambda path, args: self.run_in_mainthread(self._engine_message, (path, args))
+        if openmidi:
+            self.midi_restart()
+        self._setup_tasks()
+
+    def _start_threads(self):
+        # Support for running funtions on the main thread
+        if self._mainloop is None:
+            self._mainloop = MainLoop()
+        self._mainloop.add_reader(self._oscserver.fileno(), self._osc_recv)
+        if self._scheduler is None:
+            self._scheduler = timer3.Timer(precision=0.05)
+        self._dispatcher.start()
+
+    def _setup_tasks(self):
         self.debug("setting up tasks")
         scheduler = self._scheduler
-        scheduler.apply_after(3100, self.dump_state)
-        time.sleep(0.1)
-        scheduler.apply_interval(1000, self.background_task)
-        time.sleep(0.1)
-        scheduler.apply_interval(1700, self.userconfig_watcher.tick)
-        time.sleep(0.1)
-        scheduler.apply_interval(3700, self.state_save)
+        scheduled = self._scheduled
+        scheduled.append(scheduler.apply_interval(1000, self.background_task))
+        if not self._watch_config():
+            scheduled.append(scheduler.apply_interval(1700, self.userconfig_watcher.tick))
         # this needs to be run in the main thread to detect new devices
-        scheduler.apply_interval(1900, lambda:self.run_in_mainthread(self.midi_check_new_ports))
+        scheduled.append(scheduler.apply_interval(1900, lambda:self.run_in_mainthread(self.midi_check_new_ports)))
+        scheduled.append(scheduler.apply_interval(METRICS_WRITE_INTERVAL * 1000, self.metrics_write))
+        self.run_in_mainthread(self._probe_tick)
         # scheduler.apply_after(500, self.midi_restart)
         self.debug("finished setting tasks")
 
+    def _setup_metrics(self):
+        self.metrics = metrics = Metrics()
+        events = metrics.counter("midi_events_total", "MIDI messages handled, by kind", ("kind",))
+        self._m_events = {kind: events.labels(kind) for kind in ('noteon', 'noteoff', 'cc', 'other')}
+        handler_time = metrics.histogram("handler_seconds", "Execution time of the handlers", ("handler",))
+        self._m_handler_time = {handler: handler_time.labels(handler)
+                                for handler in ('noteon', 'cc', 'gain_set', 'dump_state')}
+        self._m_sent = metrics.counter("osc_sent_total", "OSC messages sent, by destination", ("dest",))
+        self._m_send_errors = metrics.counter("osc_send_errors_total", "OSC send errors, by destination", ("dest",))
+        self._m_heart_jitter = metrics.histogram("heartbeat_jitter_seconds",
+                                                 "Deviation of the interval between csound heartbeats from its period")
+        metrics.gauge("dispatch_queue_depth", "MIDI messages waiting in the dispatcher",
+                      lambda: len(self._dispatcher.buffer))
+        metrics.gauge("dispatch_queue_maxdepth", "Max. number of MIDI messages waiting in the dispatcher",
+                      lambda: self._dispatcher.buffer.maxdepth)
+        metrics.gauge("dispatch_overflows", "MIDI messages dropped because the dispatcher queue was full",
+                      lambda: self._dispatcher.buffer.overflows)
+        metrics.gauge("mainloop_pending", "Tasks waiting in the main loop",
+                      lambda: self._mainloop.pending() if self._mainloop is not None else 0)
+        metrics.gauge("active_notes", "Notes sounding (held by a key or by the pedal)", lambda: len(self.voices))
+        metrics.gauge("engine_load", "Load of csound estimated by the governor (0-1)", lambda: self.governor.load())
+        metrics.gauge("throttle_factor", "Grain density factor of the governor (1: not throttled)",
+                      lambda: self.governor.factor)
+        self._m_engine_rtt = metrics.histogram("engine_rtt_seconds", "Round-trip time of /ping to csound")
+        metrics.gauge("engine_pings_sent", "Pings sent to csound", lambda: self.probe.sent)
+        metrics.gauge("engine_pings_lost", "Pings to csound not answered in time", lambda: self.probe.lost)
+        metrics.gauge("engine_grade", "State of csound: 0=ok, 1=degraded, 2=overloaded, 3=dead",
+                      lambda: GRADES.index(self.probe.grade))
+        metrics.gauge("subscribers", "Clients subscribed to the information sent by the controller",
+                      lambda: len(self.subscribers))
+        metrics.gauge("voices_stolen", "Notes stopped to stay within max_polyphony", lambda: self.voices.stolen)
+        self._m_engine_restarts = metrics.counter("engine_restarts_total", "Restarts of the supervised csound")
+        self._m_engine_recovery = metrics.histogram("engine_recovery_seconds",
+                                                    "Time from a restart of csound to its first heartbeat",
+                                                    buckets=(0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0))
+
+    def _heart_received(self):
+        now = time.perf_counter()
+        if self._heart_lasttime is not None:
+            self._m_heart_jitter.observe(abs(now - self._heart_lasttime - HEARTBEAT_PERIOD))
+        self._heart_lasttime = now
+
+    def _send_ping(self, seq):
+        self._csound_send('/ping', self.session.core_port, seq)
+
+    def _probe_tick(self):
+        """
+        Runs in the main loop, every PROBE_INTERVAL
+        """
+        if self._running and self._csd_connected:
+            probe = self.probe
+            oldgrade = probe.grade
+            grade = probe.ping(time.perf_counter())
+            if grade != oldgrade:
+                self._engine_grade_changed(oldgrade, grade)
+        self._probe_handle = self._call_later(PROBE_INTERVAL, self._probe_tick)
+
+    def _mark_ready(self, name):
+        event = self.ready[name]
+        if not event.is_set():
+            self.ready_times[name] = time.perf_counter()
+            event.set()
+            self.debug("ready: %s", name)
+
+    def _engine_connected(self):
+        """
+        Called in the dispatcher when csound sends its first heartbeat. Sends
+        the state and restarts the notes which were sounding, so that a
+        restarted engine picks up where the last one stopped
+        """
+        self._grainscale = self.governor.factor ** 0.5
+        with self.oscbatch():
+            self.dump_state()
+            for voice in list(self.voices.voices.values()):
+                pos = (voice.midinote - C3) / 48
+                self._csound_send('/noteon', voice.midinote, pos, voice.amp)
+
+    def _csound_send(self, path, *args):
+        if self._recorder is not None:
+            self._recorder.record(path, args)
+        if self._embedded:
+            self.engine.send(path, args)
+        else:
+            self._send(self._csound_addr, path, *args)
+
+    def _engine_message(self, path, args):
+        """
+        Called in the main thread with a message from an embedded csound
+        """
+        self._engine_handlers[path](path, args, None, None, self)
+
+    def _engine_exited(self, returncode):
+        """
+        Called in the main thread when the supervised csound exits by itself
+        """
+        if not self._running:
+            return
+        self.error("csound exited with returncode %s, restarting", returncode)
+        self._engine_restart()
+
+    def _engine_restart(self):
+        """
+        Runs in the main thread. Restarts the supervised csound, everything
+        else keeps running. The state is sent again once the new engine is up
+        """
+        self.debug("restarting csound")
+        self._csd_connected = False
+        self.info("/status", "restarting")
+        self._engine_restart_time = time.perf_counter()
+        self._lastheartbeat = time.time()
+        self._heart_lasttime = None
+        self.probe.reset()
+        self.governor.reset()
+        self._throttle_sent = 1.0
+        try:
+            self.engine.restart()
+        except (OSError, RuntimeError) as e:
+            self.error("could not restart csound: %s", e)
+            raise CsoundConnectionError(str(e))
+        self._m_engine_restarts.inc()
+
+    def _engine_grade_changed(self, oldgrade, grade):
+        stats = self.probe.stats()
+        rtt = stats['rtt_p90']
+        self.debug("engine %s -> %s (rtt p90: %s ms, lost: %d)", oldgrade, grade,
+                   f"{rtt*1000:.1f}" if rtt is not None else "-", stats['lost'])
+        self.info("/status", "connected" if grade == 'ok' else grade)
+
+    def metrics_write(self, path=None):
+        """
+        Write the metrics in the Prometheus text format (default: metrics.prom
+        in the folder of the session)
+        """
+        if path is None:
+            path = self.session.path(METRICS_FILE)
+        write_atomic(path, self.metrics.render())
+
     def reset(self):
         self.last_octave = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-        self.notesdown = 0
+        self.voices.clear()
         self.sustainpedal = False
         self.notesheld = [False for i in range(127)]
         self.notesheld_by_pedal = set()
@@ -134,7 +412,9 @@ class MidiKeyb:
         self.ratefactor = 1
         self.rate = 12
         self.speed = 1
+        # the amplitude sent to csound and the curved position of the pedal
         self.gain = 1
+        self.gainrel = 1
         self.table = "VL"
         self.tableindex = 0  
         self.midichannel = 'ALL'
@@ -154,49 +434,196 @@ class MidiKeyb:
     def reload(self):
         if not self._running or self._paused:
             return
-        self.debug("RELOADING")
-        self._paused = True
-        config = config_load()
+        config = config_load(self.session.folder)
         if config['error']:
             self.error(f"Error loading configfile: {config['error']}. Using last version")
         newconfig = config['config']
+        changes = config_diff(self._loaded_config, newconfig)
+        self._loaded_config = dict(newconfig)
+        if not changes:
+            self.debug("config reloaded, nothing changed")
+            return
+        self.debug("RELOADING")
+        # parsing and compiling happen here, the changes are applied in the dispatcher
+        tables = None
+        if {'tables', 'all'} & config_subsystems(changes):
+            try:
+                tables = compile_tables(dict(self.config, **changes))
+            except (ValueError, TypeError, KeyError) as e:
+                self.error(f"config reload: could not compile the tables: {e!r}. Keeping the current config")
+                return
+        self._paused = True
+        self.run_in_dispatcher(self._reload_apply, (changes, tables))
+
+    def _reload_apply(self, changes, tables):
+        """
+        Apply the changed keys of the config, re-applying only the parts
+        of the state which depend on them (see watch.CONFIG_SUBSYSTEMS)
+        """
         oldconfig = self.config
-        for key, newvalue in newconfig.items():
-            oldvalue = oldconfig.get(key)
-            if newvalue != oldvalue:
-                self.debug(f"{key}: {oldvalue} -> {newvalue}")
-        self.config = newconfig
-        self._setup_config_dependencies()
-        self.dump_state()
-        self._paused = False
+        # values restored from the last state may already be the current ones
+        changes = {key: value for key, value in changes.items() if oldconfig.get(key) != value}
+        for key, newvalue in changes.items():
+            self.debug(f"{key}: {oldconfig.get(key)} -> {newvalue}")
+        oldconfig.update(changes)
+        subsystems = config_subsystems(changes)
+        try:
+            with self.oscbatch():
+                if 'all' in subsystems:
+                    self._setup_config_dependencies(tables)
+                    self.dump_state()
+                else:
+                    self._config_apply(subsystems, tables)
+            self._state_changed()
+        except Exception as e:
+            # a bad value must not leave the keyboard paused: the parts applied so far stay
+            self.error(f"config reload: could not apply {sorted(changes)}: {e!r}")
+        finally:
+            self._paused = False
+
+    def _config_apply(self, subsystems, tables):
+        config = self.config
+        if 'midichannel' in subsystems:
+            self.midi_channel_set(config['midichannel'])
+        if 'midiports' in subsystems:
+            self.run_in_mainthread(self.midi_restart)
+        if 'controllers' in subsystems:
+            self._setup_controllers()
+        if 'tables' in subsystems and tables is not None:
+            self.tables = tables.with_sensibility(self.noteon_min_db, self.noteon_max_db)
+        if 'sensibility' in subsystems:
+            self.sensibility_change(config['noteon_min_db'], config['noteon_max_db'])
+        if 'compression' in subsystems:
+            self.compress_change(config['compression'])
+        if 'randomness' in subsystems:
+            self.randomness_set(config['randomness'])
+        if 'voices' in subsystems:
+            self._setup_voices()
+        if 'governor' in subsystems:
+            self._setup_governor()
+        if 'journal' in subsystems:
+            self._setup_journal()
+        if 'flags' in subsystems:
+            self.allow_kbd_rate_factor_change = config['allow_kbd_rate_factor_change']
+
+    def _watch_config(self):
+        """
+        Watch the user config with inotify. Returns False if inotify is
+        not available, in which case the config has to be polled
+        """
+        try:
+            self._config_inotify = InotifyWatcher(self._userconfig_path)
+        except OSError as e:
+            self.debug(f"inotify not available ({e}), polling the user config")
+            return False
+        self._add_reader(self._config_inotify.fileno(), self._config_changed)
+        return True
+
+    def _unwatch_config(self):
+        if self._config_inotify is not None:
+            self._remove_reader(self._config_inotify.fileno())
+            self._config_inotify.close()
+            self._config_inotify = None
+
+    def _config_changed(self):
+        # editors save in several steps (write, rename, chmod...): reload once they settle
+        if not self._config_inotify.read():
+            return
+        if self._config_reload_handle is not None:
+            self._config_reload_handle.cancel()
+        self._config_reload_handle = self._call_later(CONFIG_DEBOUNCE, self._config_settled)
+
+    def _config_settled(self):
+        self._config_reload_handle = None
+        self.reload()
 
-    def debug(self, msg):
-        if DEBUG_TO_CONSOLE:
-            print(msg)
-        logger.debug(msg)
+    def debug(self, msg, *args):
+        """
+        msg is formatted with args (as msg % args) in the logging thread.
+        The record tells the line of the caller, where the rate limit of
+        the log applies (see logqueue.RateLimitFilter)
+        """
+        if self._logprefix:
+            msg = self._logprefix + str(msg)
+        logger.debug(msg, *args, stacklevel=2)
 
-    def error(self, msg):
-        logger.error(msg)
+    def error(self, msg, *args):
+        if self._logprefix:
+            msg = self._logprefix + str(msg)
+        logger.error(msg, *args, stacklevel=2)
 
     def info(self, label, msg=""):
         if isinstance(msg, float):
             msg = ('f', msg)
-        if label.startswith("/"):
-            self._oscserver.send(INFO_OSCPORT, label, msg)
+        if not label.startswith("/"):
+            label, msg = '/print', "%s %s" % (label, msg)
+        self.subscribers.publish(label, (msg,), time.time())
+
+    def _gui_subscribe(self):
+        """
+        (Re)subscribe the puredata gui of the session. It gets everything,
+        only the parameters in GUI_THROTTLED are coalesced
+        """
+        period = self.config['gui_echo_period_ms'] / 1000
+        self._gui_subscriber = self.subscribers.subscribe(
+            self.session.info_port, TOPICS, 1 / period if period > 0 else 0, time.time(),
+            throttled=GUI_THROTTLED, permanent=True)
+
+    def _send(self, dest, path, *args):
+        """
+        Send an OSC message, or add it to the open batch of this thread
+        """
+        batch = self._batcher.current()
+        if batch is None:
+            self._send_message(dest, path, *args)
         else:
-            self._oscserver.send(INFO_OSCPORT, '/print', "%s %s" % (label, msg))
+            batch.add(dest, path, args)
+
+    def _send_message(self, dest, path, *args):
+        try:
+            self._oscserver.send(dest, path, *args)
+        except IOError:
+            self._osc_counter(self._m_send_errors, dest).inc()
+            raise
+        self._osc_counter(self._m_sent, dest).inc()
+
+    def _send_bundle(self, dest, messages):
+        bundle = liblo.Bundle(*[liblo.Message(path, *args) for path, args in messages])
+        try:
+            self._oscserver.send(dest, bundle)
+        except IOError:
+            self._osc_counter(self._m_send_errors, dest).inc()
+            raise
+        self._osc_counter(self._m_sent, dest).inc(len(messages))
+
+    def _osc_counter(self, counter, dest):
+        host, port = destination_key(dest)
+        return counter.labels(f"{host}:{port}")
+
+    def oscbatch(self):
+        """
+        Context manager. Everything sent within it from the calling thread
+        goes out as one OSC bundle per destination when it is closed.
+        Batches can be nested, only the outermost one sends
+
+        with keyb.oscbatch():
+            keyb.gain_set(0.5)
+            keyb.speed_set(1)
+        """
+        return self._batcher.batch()
 
     def midi_restart(self, ports=None):
         """
-        ports: a list of patterns
+        ports: a list of patterns. Default: the MIDI ports of the session,
+               if it has its own, or midiports of the config
         """
         if ports is None:
-            ports = self.config['midiports']
+            ports = self.session.midiports or self.config['midiports']
         self.debug("midi_openports: %s" % str(ports))
         assert isinstance(ports, list)
         if self._midiin is not None:
             self._midiin.close_ports()
-        self._midiin = rtmidi2.MidiInMulti()
+        self._midiin = rtmidi2.MidiInMulti(self.session.clientname)
         self._midiin.callback = self.midi_callback
         self._midiin.open_ports(*ports)
         self._midi_connected_ports = [self._midiin.get_port_name(i) for i in self._midiin.get_open_ports()]
@@ -205,6 +632,8 @@ class MidiKeyb:
         self.info("/connectedports", ":".join(self._midi_connected_ports))
 
     def midi_check_new_ports(self):
+        if self._midiin is None:
+            return
         ports_now = set(self._midiin.ports)
         if ports_now != self._midi_available_ports:
             self.debug("midi devices changed")
@@ -215,13 +644,22 @@ class MidiKeyb:
             if hasattr(self, key):
                 setattr(self, key, value)
 
-    def _setup_config_dependencies(self):
+    def _setup_config_dependencies(self, tables=None):
+        """
+        tables: the ControlTables compiled from self.config, or None to compile them here
+        """
         self.midi_channel_set(self.config['midichannel'])
         self.compression = self.config['compression']
         self.randomness = self.config['randomness']
         self.noteon_min_db = self.config['noteon_min_db']
         self.noteon_max_db = self.config['noteon_max_db']
+        self.tables = tables if tables is not None else compile_tables(self.config)
         self.allow_kbd_rate_factor_change = self.config['allow_kbd_rate_factor_change']
+        self._setup_controllers()
+        self._setup_voices()
+        self._setup_governor()
+
+    def _setup_controllers(self):
         self.controllers = {
             self.config['CC_gainchange']: self.cc_gainchange,
             self.config['CC_ratefactor']: self.cc_ratefactor_set,
@@ -231,6 +669,55 @@ class MidiKeyb:
             self.config['CC_sustain']: self.sustainpedal_handler
         }
         self.debug("registered CC: %s" % str(list(self.controllers.keys())))
+        self._ccfilter.configure(period=self.config['cc_control_period_ms'] / 1000,
+                                 deadband=self.config['cc_deadband'],
+                                 passthrough=[self.config['CC_sustain']])
+        if self._gui_subscriber is not None:
+            period = self.config['gui_echo_period_ms'] / 1000
+            self._gui_subscriber.configure(1 / period if period > 0 else 0)
+
+    def _setup_voices(self):
+        maxvoices = self.config['max_polyphony']
+        try:
+            self.voices.configure(maxvoices, self.config['voice_steal_policy'])
+        except ValueError as e:
+            self.error("voice_steal_policy: %s", e)
+            self.voices.configure(maxvoices, 'oldest')
+
+    def _setup_governor(self):
+        config = self.config
+        self.governor.configure(high=config['governor_high_load'],
+                                low=config['governor_low_load'],
+                                minfactor=config['governor_min_factor'])
+        if not config['governor_enabled'] and self.governor.factor < 1:
+            self.governor.reset()
+            self._throttle_sent = 1.0
+            self.run_in_dispatcher(self._throttle_apply, (1.0,))
+
+    def _engine_load_update(self):
+        """
+        Called in the main thread for each /info
+        """
+        governor = self.governor
+        if not self.config['governor_enabled']:
+            return
+        factor = governor.update(time.perf_counter())
+        if abs(factor - self._throttle_sent) > THROTTLE_RESOLUTION or (factor == 1 and self._throttle_sent < 1):
+            self._throttle_sent = factor
+            self.run_in_dispatcher(self._throttle_apply, (factor,))
+
+    def _throttle_apply(self, factor):
+        self._grainscale = factor ** 0.5
+        with self.oscbatch():
+            self._csound_send('/rate', self._effective_rate())
+            self._csound_send('/dur', self._effective_graindur())
+            self.info("/throttle", float(factor))
+
+    def _effective_rate(self):
+        return self.rate * self.ratefactor * self._grainscale
+
+    def _effective_graindur(self):
+        return max(1, int(round(self.graindur * self._grainscale)))
 
     def midi_channel_set(self, channel):
         if isinstance(channel, int):
@@ -248,11 +735,17 @@ class MidiKeyb:
         self.midichannel = channel
         return True
 
-    def _create_oscserver(self):
+    def _make_address(self, hostname, port):
+        return liblo.Address(hostname, port)
+
+    def _new_oscserver(self, port):
         try:
-            s = liblo.Server(CORE_OSCPORT)
+            return liblo.Server(port)
         except liblo.ServerError:
             raise OscError
+
+    def _create_oscserver(self):
+        s = self._new_oscserver(self.session.core_port)
         self.debug("creating server on port: " + str(s.port))
         
         def parse_reply_addr(args, src):
@@ -267,7 +760,7 @@ class MidiKeyb:
             else:
                 self.error("could not parse address: %s", str(addr))
                 return None
-            return liblo.Address(hostname, port)
+            return self._make_address(hostname, int(port))
 
         self._oscapi = set()
 
@@ -281,22 +774,32 @@ class MidiKeyb:
         def midichannel_get(path, args, types, src, self):
             addr = parse_reply_addr(args, src) 
             channels = [channel for channel in range(0, 15) if self._midi_enabled_channels[channel]]
-            self._oscserver.send(addr, '/midichannel', *channels)
+            self._send(addr, '/midichannel', *channels)
 
         def connectedports_get(path, args, types, src, self):
             addr = parse_reply_addr(args, src)
             ports = ":".join(self._midi_connected_ports)
-            self._oscserver.send(addr, '/connectedports', ports)
+            self._send(addr, '/connectedports', ports)
 
         def stop(path, args, types, src, self):
             self.stop()
 
         def heart(path, args, types, src, self):
             self._lastheartbeat = time.time()
-            self._csd_connected = True
+            self._heart_received()
+            self.governor.feed_arrival('heart', HEARTBEAT_PERIOD, time.perf_counter())
             if not self._csd_connected:
+                # csound is up (or came back): send it the state
                 self.debug("csd connected!")
                 self.info("/status", 'connected')
+                if self._engine_restart_time is not None:
+                    recovery = time.perf_counter() - self._engine_restart_time
+                    self._engine_restart_time = None
+                    self._m_engine_recovery.observe(recovery)
+                    self.debug("csound recovered in %.0f ms", recovery * 1000)
+                self.run_in_dispatcher(self._engine_connected)
+                self._mark_ready('engine')
+            self._csd_connected = True
 
         def status_get(path, args, types, src, self):
             # addr = parse_reply_addr(args, src)
@@ -318,76 +821,182 @@ class MidiKeyb:
         def rate_set(path, args, types, src, self):
             self.grainrate_change(args[0])
 
+        def journaled(func):
+            def wrapper(path, args, types, src, extra):
+                journal = self._journal
+                if journal is not None:
+                    journal.command(path, args)
+                return func(path, args, types, src, extra)
+            return wrapper
+
         def add_method(path, types, func, extra=None):
+            if path in OSC_CODES:
+                # commands changing the state are journaled and can be replayed
+                self._osc_commands[path] = (func, extra)
+                func = journaled(func)
             s.add_method(path, types, func, extra)
 
         # called by csound to broadcast information
         def info(path, args, types, sr, self):
-            rms, peak = args
-            self._oscserver.send(INFO_OSCPORT, '/soundlevel', ('f', rms), ('f', peak))
+            rms, peak = args[:2]
+            # relayed only to those who subscribed to the levels
+            self.subscribers.publish('/soundlevel', (('f', rms), ('f', peak)), time.time())
+            governor = self.governor
+            governor.feed_arrival('info', INFO_PERIOD, time.perf_counter())
+            if len(args) > 2:
+                # cpu usage, reported by csounds built with cpumeter
+                governor.feed_cpu(args[2])
+            self._engine_load_update()
             
         def ping(path, args, types, src, self):
             try:
                 port = int(args[0])
             except TypeError:
                 raise TypeError("ping: malformed message")    
-            self._oscserver.send(port, '/pingback')
+            self._send(port, '/pingback')
+
+        def pingback(path, args, types, src, self):
+            if not args:
+                return
+            rtt = self.probe.reply(args[0], time.perf_counter())
+            if rtt is not None:
+                self._m_engine_rtt.observe(rtt)
+                self._mark_ready('roundtrip')
 
         def gui_heart(path, args, types, src, self):
             self._gui_lastheartbeat = time.time()
             if not self._gui_connected:
                 self._gui_connected = True
-                self.run_in_background(self.dump_state)
-                
+                # a new gui gets every value again
+                self._gui_subscribe()
+                self.run_in_dispatcher(self.dump_state)
+                self._mark_ready('gui')
+
+        def subscriber_addr(args, src):
+            # the address is optional, 0 or "" also mean: reply to the sender
+            return parse_reply_addr(args[:1] if args and args[0] not in (0, "") else [], src)
+
+        def subscribe(path, args, types, src, self):
+            addr = subscriber_addr(args, src)
+            if addr is None:
+                return
+            try:
+                topics = parse_topics(args[1] if len(args) > 1 else "")
+                maxrate = float(args[2]) if len(args) > 2 else 0.0
+                if maxrate < 0:
+                    raise ValueError("maxrate must be positive")
+                self.subscribers.subscribe(addr, topics, maxrate, time.time())
+            except (ValueError, TypeError) as e:
+                self.error("subscribe: %s", e)
+                self._send(addr, '/subscribe/error', str(e))
+                return
+            self.debug("subscribed: %s:%s, topics: %s, maxrate: %s", *destination_key(addr), sorted(topics), maxrate)
+            self._send(addr, '/subscribed', ",".join(sorted(topics)), ('f', maxrate),
+                       ('f', self.subscribers.timeout))
+            # a new subscriber gets the current values
+            self.run_in_dispatcher(self.dump_state)
+
+        def unsubscribe(path, args, types, src, self):
+            addr = subscriber_addr(args, src)
+            if addr is not None and self.subscribers.unsubscribe(addr) is not None:
+                self.debug("unsubscribed: %s:%s", *destination_key(addr))
+
+        def subscriber_heart(path, args, types, src, self):
+            addr = subscriber_addr(args, src)
+            if addr is not None and not self.subscribers.renew(addr, time.time()):
+                # expired (or never subscribed): it has to subscribe again
+                self._send(addr, '/subscribe/expired')
+
+        def subscribers_get(path, args, types, src, self):
+            addr = parse_reply_addr(args, src)
+            msg = []
+            for subscriber in self.subscribers.subscribers():
+                host, port = subscriber.key
+                msg += [f"{host}:{port}", ",".join(sorted(subscriber.topics)), ('f', subscriber.maxrate)]
+            self._send(addr, '/subscribers', *msg)
+
+        def dispatch_stats_get(path, args, types, src, self):
+            addr = parse_reply_addr(args, src)
+            stats = self._dispatcher.stats()
+            self._send(addr, '/dispatch/stats', stats['depth'], stats['maxdepth'], stats['overflows'])
+
+        def metrics_get(path, args, types, src, self):
+            addr = parse_reply_addr(args, src)
+            msg = []
+            for name, value in self.metrics.samples():
+                msg.append(name)
+                msg.append(('f', value))
+            self._send(addr, '/metrics', *msg)
+
+        def dispatched(func):
+            # state changes requested via OSC are applied in the dispatcher thread
+            return lambda path, args, types, src, extra: self.run_in_dispatcher(func, (path, args, types, src, extra))
+
         # Sound Engine API
         add_method('/heart', None, heart, self)
         add_method('/info', None, info, self)
+        # an embedded csound delivers these without OSC
+        self._engine_handlers = {'/heart': heart, '/info': info, '/pingback': pingback}
 
         # GUI API
         add_method('/connectedports/get', None, connectedports_get, self)
-        add_method('/midichannel/set', 'i', midichannel_set_int, self)
+        add_method('/midichannel/set', 'i', dispatched(midichannel_set_int), self)
         add_method('/stop', None, stop, self)
         add_method('/midichannel/get', None, midichannel_get, self)
         add_method('/status/get', None, status_get, self)
-        add_method('/test/noteon', None, test_noteon, self)
+        add_method('/dispatch/stats/get', None, dispatch_stats_get, self)
+        add_method('/metrics/get', None, metrics_get, self)
+        add_method('/test/noteon', None, dispatched(test_noteon), self)
         add_method('/openlog', None, self.openlog)
         add_method('/openconfig', None, lambda *args, **kws: self.openconfig())
-        add_method('/dumpstate', None, lambda *args, **kws: self.dump_state())
-        add_method('/rate/set', None, rate_set, self)
+        add_method('/dumpstate', None, lambda *args, **kws: self.run_in_dispatcher(self.dump_state))
+        add_method('/tables/export', None, lambda *args, **kws: self.tables_export())
+        add_method('/record/start', None, lambda *args, **kws: self.run_in_dispatcher(self.record_start))
+        add_method('/record/stop', None, lambda *args, **kws: self.run_in_dispatcher(self.record_stop))
+        add_method('/rate/set', None, dispatched(rate_set), self)
         add_method('/ping', None, ping, self)
+        add_method('/pingback', None, pingback, self)
         add_method('/gui/heart', None, gui_heart, self)
+        add_method('/subscribe', None, subscribe, self)
+        add_method('/unsubscribe', None, unsubscribe, self)
+        add_method('/subscriber/heart', None, subscriber_heart, self)
+        add_method('/subscribers/get', None, subscribers_get, self)
         add_method("/restartaudio", None, extra=self, func=self._csound_restart)
-        add_method('/graindur/set', None, extra=self, 
-                   func=lambda path, args, types, src, self:self.graindur_change(args[0]))
-        add_method('/gain/set', None, extra=self, func=
-                   lambda path, args, types, src, self: self.gain_set(clip(args[0], 0, 1)))
-        add_method('/random/set', None, extra=self, 
-                   func=lambda path, args, types, src, self: 
-                   self.randomness_set(clip(args[0], 0, 1)))
-        add_method('/compress/set', None, extra=self, 
-                   func=lambda path, args, types, src, self: 
-                   self.compress_change(clip(args[0], 0, 1)))
-        add_method('/mindb/set', None, extra=self, func=
+        add_method('/graindur/set', None, extra=self, func=dispatched(
+                   lambda path, args, types, src, self:self.graindur_change(args[0])))
+        add_method('/gain/set', None, extra=self, func=dispatched(
+                   lambda path, args, types, src, self: self.gain_set(clip(args[0], 0, 1))))
+        add_method('/random/set', None, extra=self, func=dispatched(
+                   lambda path, args, types, src, self: 
+                   self.randomness_set(clip(args[0], 0, 1))))
+        add_method('/compress/set', None, extra=self, func=dispatched(
                    lambda path, args, types, src, self: 
-                   self.sensibility_change(clip(args[0], -120, 12), self.noteon_max_db))
-        add_method('/maxdb/set', None, extra=self, func=
+                   self.compress_change(clip(args[0], 0, 1))))
+        add_method('/mindb/set', None, extra=self, func=dispatched(
                    lambda path, args, types, src, self: 
-                   self.sensibility_change(self.noteon_min_db, clip(args[0], -120, 12)))
+                   self.sensibility_change(clip(args[0], -120, 12), self.noteon_max_db)))
+        add_method('/maxdb/set', None, extra=self, func=dispatched(
+                   lambda path, args, types, src, self: 
+                   self.sensibility_change(self.noteon_min_db, clip(args[0], -120, 12))))
         self._oscserver = s
 
+    @timed('dump_state')
     def dump_state(self):
-        print("dump_state")
-        self.gain_set(self.gain)
-        self.speed_set(self.speed)
-        self.table_change_raw(self.tableindex)
-        self.graindur_change_index(self.graindurindex)
-        self.grainrate_change(self.rate)  
-        self.compress_change()
-        self.randomness_set()
-        self.info("/mindb", self.noteon_min_db)
-        self.info("/maxdb", self.noteon_max_db)
-        self.info("/status", ("offline", "connected")[self._csd_connected])
+        self.debug("dump_state")
+        with self.oscbatch():
+            # the amplitude is sent as is: gain_set would apply the curve again
+            self._gain_apply(self.gain, self.gainrel)
+            self.speed_set(self.speed)
+            self.table_change_raw(self.tableindex)
+            self.graindur_change_index(self.graindurindex)
+            self.grainrate_change(self.rate)  
+            self.compress_change()
+            self.randomness_set()
+            self.info("/mindb", self.noteon_min_db)
+            self.info("/maxdb", self.noteon_max_db)
+            self.info("/status", ("offline", "connected")[self._csd_connected])
         
+    @timed('noteon')
     def noteon(self, midinote, velocity):
         if self.notesheld[midinote]:
             return
@@ -396,7 +1005,7 @@ class MidiKeyb:
         self.notesheld[midinote] = True
         if self.sustainpedal:
             self.notesheld_by_pedal.add(midinote)
-            print("holding notes: %d" % len(self.notesheld_by_pedal))
+            self.debug("holding notes: %d", len(self.notesheld_by_pedal))
         if midinote >= C3:
             # check if Cx2 is beeing held down. if it is, it is a change of speed
             if self.last_octave[1] == 1:
@@ -440,7 +1049,7 @@ class MidiKeyb:
             return
         self.notesheld[midinote] = False
         if self.sustainpedal:
-            print("note held by pedal")
+            self.debug("note held by pedal")
             return
         self._release_note(midinote)
 
@@ -448,48 +1057,50 @@ class MidiKeyb:
         if midinote < C2:
             return
         if midinote >= C3:
-            self.notesdown -= 1
-            self._oscserver.send(self._csound_addr, '/noteoff', midinote)
+            if self.voices.release(midinote):
+                self._csound_send('/noteoff', midinote)
         else:
             self.last_octave[midinote - C2] = 0
 
+    @timed('cc')
     def cc(self, cc, value):
         func = self.controllers.get(cc)
         if func:
-            func(value)
+            if self._ccfilter.feed(cc, value, time.time()):
+                func(value)
         else:
-            s = "CC {cc}: {value}".format(cc=cc, value=value)
-            self.info(s)
-            self.debug(s)
+            self.info("CC %d: %d" % (cc, value))
+            self.debug("CC %d: %d", cc, value)
 
+    @timed('gain_set')
     def gain_set(self, factor):
         """amp is a float between 0-1"""
-        mingain = self.config['mingain_db']
-        maxgain = self.config['maxgain_db']
-        curve = self.config['volpedal_curve']
-        factor = factor ** curve
-        gain_db = mingain + (maxgain - mingain) * factor
-        amp = db2amp(gain_db)
-        self._oscserver.send(self._csound_addr, '/gain', amp)
+        config = self.config
+        amp, factor = gain_curve(factor, config['mingain_db'], config['maxgain_db'], config['volpedal_curve'])
+        self._gain_apply(amp, factor)
+
+    def _gain_apply(self, amp, factor):
+        self._csound_send('/gain', amp)
         self.info("/gain", amp)
         self.info("/gainrel", factor)
         self.gain = amp
+        self.gainrel = factor
 
     def cc_gainchange(self, midivalue):
-        gain_factor = midivalue / 127
-        self.gain_set(gain_factor)
+        tables = self.tables
+        self._gain_apply(tables.gain[midivalue], tables.gainrel[midivalue])
 
     def sustainpedal_handler(self, midivalue):
         self.sustainpedal = sustainpedal = midivalue > 0
-        print("pedal: %s" % ("ON" if sustainpedal else "OFF"))
+        self.debug("pedal: %s", "ON" if sustainpedal else "OFF")
         if not sustainpedal:
-            print("sustain pedal up, notes to release: %d" % len(self.notesheld_by_pedal))
+            self.debug("sustain pedal up, notes to release: %d", len(self.notesheld_by_pedal))
             for midinote in self.notesheld_by_pedal:
                 if not self.notesheld[midinote]:
-                    print("releasing note: %d" % midinote)
+                    self.debug("releasing note: %d", midinote)
                     self._release_note(midinote)
                 else:
-                    print("note is held by key")
+                    self.debug("note is held by key")
             self.notesheld_by_pedal = set()
         else:
             # pedal pressed, hold all notes that are down
@@ -499,12 +1110,14 @@ class MidiKeyb:
                     self.notesheld_by_pedal.add(midinote)
 
     def panic(self):
-        self._oscserver.send(self._csound_addr, '/panic', 1)
-        self.notesheld = [False for i in range(len(self.notesheld))]
-        self.notesheld_by_pedal = set()
-        self.sustainpedal = False
-        self.last_octave = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-        self.info('RESET')
+        with self.oscbatch():
+            self._csound_send('/panic', 1)
+            self.voices.clear()
+            self.notesheld = [False for i in range(len(self.notesheld))]
+            self.notesheld_by_pedal = set()
+            self.sustainpedal = False
+            self.last_octave = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+            self.info('RESET')
 
     def cc_speed_set(self, midinote):
         index = midinote - C3
@@ -516,27 +1129,24 @@ class MidiKeyb:
 
     def speed_set(self, speed):
         self.speed = speed
-        self._oscserver.send(self._csound_addr, '/speed', speed)
+        self._csound_send('/speed', speed)
         self.info("/speed", speed)
 
     def table_change_raw(self, tableindex):
-        self._oscserver.send(self._csound_addr, '/table', tableindex)
+        self._csound_send('/table', tableindex)
         self.info("/table", tableindex)
 
     def table_change(self, table):
         """
         table: an int identifying the table
         """
-        self._oscserver.send(self._csound_addr, '/table', table)
+        self._csound_send('/table', table)
         self.table = INSTRS[table]
         self.tableindex = table
         self.info('INSTR', self.table)
 
     def cc_sensibility_change(self, midivalue):
-        maxdb = self.noteon_max_db
-        mindb = linlin(midivalue, 0, 127, -60, maxdb)
-        # mindb = -60 + ((127 - midivalue) / 127) * (maxdb - -60)
-        self.sensibility_change(mindb, maxdb)
+        self.sensibility_change(self.tables.mindb[midivalue], self.noteon_max_db)
 
     def sensibility_change(self, mindb=None, maxdb=None):
         if maxdb is not None:
@@ -545,6 +1155,8 @@ class MidiKeyb:
         if mindb is not None:
             self.config['noteon_min_db'] = self.noteon_min_db = mindb
             self.info("/mindb", mindb)
+        self._state_changed()
+        self.tables = self.tables.with_sensibility(self.noteon_min_db, self.noteon_max_db)
 
     def cc_compress_change(self, midivalue):
         self.compress_change(midivalue/127.0)
@@ -552,7 +1164,8 @@ class MidiKeyb:
     def compress_change(self, v=None):
         if v is not None:
             self.config['compression'] = self.compression = v
-        self._oscserver.send(self._csound_addr, '/compress', self.compression)
+            self._state_changed()
+        self._csound_send('/compress', self.compression)
         self.info("/compress", self.compression)
 
     def cc_randomness_change(self, midivalue):
@@ -561,14 +1174,12 @@ class MidiKeyb:
     def randomness_set(self, r=None):
         if r is not None:
             self.config['randomness'] = self.randomness = r
-        self._oscserver.send(self._csound_addr, '/random', self.randomness)
+            self._state_changed()
+        self._csound_send('/random', self.randomness)
         self.info("/random", self.randomness)
 
     def cc_ratefactor_set(self, midivalue):
-        ratefactor_min = self.config['ratefactor_min']
-        ratefactor_max = self.config['ratefactor_max']
-        factor = ratefactor_min + (ratefactor_max - ratefactor_min) * (midivalue / 127)
-        self.ratefactor_set(factor)
+        self.ratefactor_set(self.tables.ratefactor[midivalue])
 
     def ratefactor_set(self, factor):
         self.ratefactor = factor
@@ -589,45 +1200,168 @@ class MidiKeyb:
         self.graindur_change(graindur)
 
     def graindur_change(self, graindur):
-        self._oscserver.send(self._csound_addr, '/dur', graindur)
-        self.info("/graindur", graindur)
         self.graindur = graindur
+        self._csound_send('/dur', self._effective_graindur())
+        self.info("/graindur", graindur)
 
     def grainrate_change(self, rate):
         self.rate = rate
-        self._oscserver.send(self._csound_addr, '/rate', rate * self.ratefactor)
+        self._csound_send('/rate', self._effective_rate())
         self.info('/rate', rate)
 
     def play_with_velocity(self, midinote, velocity):
         pos = (midinote - C3) / 48
-        mindb = self.noteon_min_db
-        amp_db = mindb + (self.noteon_max_db - mindb) * (velocity / 127)
-        amp = db2amp(amp_db)
-        send = self._oscserver.send
-        addr = self._csound_addr
-        send(addr, '/noteon', midinote, pos, amp)
+        amp = self.tables.velamp[velocity]
+        # a note still sounding (held by the pedal) is restarted, other notes may be stolen
+        for stopped in self.voices.start(midinote, amp):
+            self._csound_send('/noteoff', stopped)
+            if stopped != midinote:
+                self.debug("voice stolen: %d", stopped)
+                self.notesheld_by_pedal.discard(stopped)
+        self._csound_send('/noteon', midinote, pos, amp)
+
+    def record_start(self, path=None):
+        """
+        Start recording the messages sent to csound. They are written to
+        path (default: a new file in the recordings folder of the session,
+        ~/.zaehmungen/recordings for the default one) by record_stop
+        """
+        if path is None:
+            path = os.path.join(self.session.path(RECORDINGS_DIR), time.strftime("%Y%m%d-%H%M%S") + ".jsonl")
+        # the recording starts with the current state and the sounding notes
+        recorder = self._recorder = EventRecorder()
+        self.dump_state()
+        for voice in list(self.voices.voices.values()):
+            recorder.record('/noteon', (voice.midinote, (voice.midinote - C3) / 48, voice.amp))
+        self._recording_path = path
+        self.debug("recording to %s", path)
+
+    def record_stop(self):
+        """
+        Stop recording and write the recording. Returns its path, or None
+        if nothing was being recorded
+        """
+        recorder, path = self._recorder, self._recording_path
+        if recorder is None:
+            return None
+        self._recorder = self._recording_path = None
+        recorder.save(path)
+        self.debug("recording stopped, %d messages written to %s", len(recorder), path)
+        return path
+
+    def tables_export(self, path=None):
+        """
+        Write the current control tables as CSV (default: tables.csv in
+        the folder of the session)
+        """
+        if path is None:
+            path = self.session.path("tables.csv")
+        export_tables(self.tables, path)
+        self.debug(f"control tables written to {path}")
+        return path
         
+    def _flush_coalesced(self):
+        """
+        Called by the dispatcher when idle. Forwards coalesced values whose
+        period is over and returns the time until the next one is due
+        """
+        now = time.time()
+        with self.oscbatch():
+            for cc, value in self._ccfilter.due(now):
+                func = self.controllers.get(cc)
+                if func:
+                    func(value)
+            subscribers_deadline = self.subscribers.flush(now)
+        deadlines = [t for t in (self._ccfilter.next_deadline(), subscribers_deadline)
+                     if t is not None]
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.time())
+
+    def coalesce_stats(self):
+        """
+        Returns the counters of the CC coalescing layer (engine side)
+        and of the throttling of the subscribers (the gui and others), as a
+        dict {'cc': {...}, 'gui': {...}}, where each has the keys received,
+        forwarded, suppressed, pending. 'gui' also has subscribers and expired
+        """
+        return {'cc': self._ccfilter.stats(), 'gui': self.subscribers.stats()}
+
     def openconfig(self):
-        userconfig = os.path.abspath(os.path.join(USERFOLDER, "userconfig.json"))
+        userconfig = os.path.abspath(self._userconfig_path)
         print(">>>>>>>>>>>>>>>>>>>>>> opening userconfig")
         open_in_editor(userconfig)
         
     def midi_callback(self, msg, timestamp):
+        """
+        Called by rtmidi in its own thread. The message is only journaled
+        and queued, it is handled in the dispatcher thread (see _midi_handle)
+        """
+        journal = self._journal
+        if journal is not None:
+            journal.midi(msg, timestamp)
+        self._dispatcher.push(msg, timestamp)
+
+    def midi_feed(self, msg, timestamp):
+        """
+        As midi_callback, but waits while the dispatcher is full instead
+        of dropping the message. For the tools which feed MIDI faster than
+        real time (the replay of the journal, the bench)
+        """
+        journal = self._journal
+        if journal is not None:
+            journal.midi(msg, timestamp)
+        self._dispatcher.push_wait(msg, timestamp)
+
+    def _midi_overflow(self, overflows):
+        # called in the rtmidi thread, the log is rate limited
+        self.error("midi buffer full, dropping messages (%d dropped so far)", overflows)
+
+    def osc_command(self, path, args):
+        """
+        Apply an OSC command as if received (used to replay the journal)
+        """
+        func, extra = self._osc_commands[path]
+        func(path, args, None, None, extra)
+
+    def _setup_journal(self):
+        self.journal_stop()
+        if self._journal_allowed and self.config['journal_enabled']:
+            try:
+                self._journal = Journal(self.session.path(JOURNAL_DIR), keep=self.config['journal_files'])
+            except OSError as e:
+                self.error(f"could not open the journal: {e}")
+            else:
+                self.debug(f"journal: {self._journal.path}")
+
+    def journal_stop(self):
+        journal, self._journal = self._journal, None
+        if journal is not None:
+            journal.close()
+
+    def _midi_handle(self, msg, timestamp):
         msg0 = msg[0]
         channel = msg0 & 0b00001111
         if self._midi_enabled_channels[channel]:
             kind = msg0 & 0b11110000
+            events = self._m_events
             if kind == 144:
                 vel = msg[2]
                 if vel > 0:
+                    events['noteon'].inc()
                     self.noteon(msg[1], vel)
                 else:
+                    events['noteoff'].inc()
                     self.noteoff(msg[1])
             elif kind == 176:  # CC
+                events['cc'].inc()
                 self.cc(msg[1], msg[2])
-            if kind == 128:
+            elif kind == 128:
                 # dont need the velocity
+                events['noteoff'].inc()
                 self.noteoff(msg[1])
+            else:
+                events['other'].inc()
 
     def openlog(self):
         open_in_editor(LOGPATH)
@@ -637,66 +1371,174 @@ class MidiKeyb:
         run function in the main thread.
         This should be called from a callback running in a different thread
         """
-        self._tasks.put((func, args))
+        self._mainloop.post(func, args)
+
+    def run_in_dispatcher(self, func, args=()):
+        """
+        run function in the dispatcher thread, in order with incoming
+        MIDI messages. Use this for anything that modifies the state
+        """
+        self._dispatcher.call(func, args)
+
+    def dispatch_stats(self):
+        """
+        Returns a dict with the counters of the MIDI dispatcher:
+        depth, maxdepth, overflows, dispatched, capacity
+        """
+        return self._dispatcher.stats()
 
     def run_in_background(self, func, args=()):
         self._scheduler.apply_after(0, func, args)
 
-    def tick(self):
-        self._oscserver.recv(10)
-        now = time.time()
-        if now - self._tasks_lastcheck > 0.5:
-            while not self._tasks.empty():
-                func, args = self._tasks.get()
-                func(*args)
-            self._tasks_lastcheck = now
+    def _add_reader(self, fd, callback):
+        self._mainloop.add_reader(fd, callback)
+
+    def _remove_reader(self, fd):
+        self._mainloop.remove_reader(fd)
+
+    def _call_later(self, delay, func, args=()):
+        """
+        Call func in the main loop after delay seconds. Must be called
+        from the main loop. Returns a handle with a cancel method
+        """
+        return self._mainloop.call_later(delay, func, args)
+
+    def mainloop_stats(self):
+        """
+        Returns a dict with the counters of the main loop: wakeups,
+        tasks (number of tasks run), pending, task_latency_avg, task_latency_max
+        """
+        return self._mainloop.stats()
+
+    def _osc_recv(self):
+        recv = self._oscserver.recv
+        while recv(0):
+            pass
+
+    def tick(self, timeout=0.01):
+        """
+        Handle pending OSC messages and tasks, waiting at most timeout
+        seconds for them. Use this instead of start to embed the
+        controller in another loop
+        """
+        self._mainloop.run_once(timeout)
 
     def background_task(self):
         if self._running:
             now = time.time()
-            if now - self._lastheartbeat > 2 and now - self._starttime > 5:
+            for subscriber in self.subscribers.expire(now):
+                self.debug("subscriber expired: %s:%s", *subscriber.key)
+            silent = now - self._lastheartbeat
+            if self.engine is not None:
+                # a hung engine is restarted, a dead one was already reported by the supervisor
+                if (self._csd_connected and silent > 2) or silent > ENGINE_START_TIMEOUT:
+                    self.debug("csd is not responding")
+                    self.info("/status", "disconnected")
+                    self._csd_connected = False
+                    self.run_in_mainthread(self._engine_restart)
+            elif silent > 2 and now - self._starttime > 5:
                 self.debug("csd is not connected")
                 self._lastheartbeat = now
                 self.info("/status", "disconnected")
                 self._csd_connected = False
-                print("background_task: csound connection error, throwing exception (CsoundConnectionError)")
+                self.debug("background_task: csound connection error, throwing exception (CsoundConnectionError)")
                 self.run_in_mainthread(raise_exception, [CsoundConnectionError])
-            if now - self._gui_lastheartbeat > 2 and now - self._starttime > 5:
+            if self.session.gui and now - self._gui_lastheartbeat > 2 and now - self._starttime > 5:
                 self.debug("gui is not connected")
                 self._gui_connected = False
                 self._gui_lastheartbeat = now
                 self.run_in_mainthread(raise_exception, [GuiConnectionError])
 
     def _csound_restart(self):
+        if self.engine is not None:
+            self.run_in_mainthread(self._engine_restart)
+            return
         self._background_tast_enabled = False
         self.run_in_mainthread(raise_exception, [CsoundRestart])
     
     def start(self):
+        self.activate()
+        try:
+            self._mainloop.run()
+        finally:
+            stats = self._mainloop.stats()
+            self.debug(f"main loop: {stats['wakeups']} wakeups, {stats['tasks']} tasks, "
+                       f"task latency avg: {stats['task_latency_avg']*1000:.2f} ms, "
+                       f"max: {stats['task_latency_max']*1000:.2f} ms")
+        self.debug("exiting mainloop")
+        self.close()
+
+    def activate(self):
+        """
+        Start watching the peers. start does this before running the main
+        loop, a host sharing the loop (see host.py) calls it for each session
+        """
         self._running = True
         self._starttime = time.time()
-        recv = self._oscserver.recv
-        tasks = self._tasks
-        while self._running:
-            for _ in range(20):
-                recv(20)
-            while not tasks.empty():
-                func, args = self._tasks.get()
-                func(*args)
-        self.debug("exiting mainloop, closing oscserver")
+
+    def close(self):
+        """
+        Release the OSC server and the config watcher, once the main loop
+        does not run anymore
+        """
+        self.debug("closing oscserver")
+        self._unwatch_config()
+        if self._midiin is not None:
+            self._midiin.close_ports()
+        self._mainloop.remove_reader(self._oscserver.fileno())
         self._oscserver.free()
         self.debug("stopped")
 
+    def _state_changed(self):
+        if self.config.get('save_last_state', True):
+            self._statewriter.update(state_snapshot(self.config))
+
     def state_save(self):
-        state_save(self.config)
+        """
+        Write the state now, if it changed since the last write
+        """
+        self._state_changed()
+        self._statewriter.flush()
+
+    def state_stats(self):
+        """
+        Returns a dict with the counters of the state writer: updates,
+        writes, errors, write_time_avg, write_time_max
+        """
+        return self._statewriter.stats()
 
     def stop(self):
         self.debug("stopping csound...")
+        # not running anymore: csound exiting after /stop is not restarted
+        self._running = False
+        self.stopped = True
         self.state_save()
-        self._oscserver.send(self._csound_addr, '/stop', 1.0)
+        self._csound_send('/stop', 1.0)
         
-        self.debug("stopping mainloop")
-        self._running = False
+        for tref in self._scheduled:
+            tref.cancel()
+        self._scheduled = []
+        if self._probe_handle is not None:
+            self._probe_handle.cancel()
+        if self._config_reload_handle is not None:
+            self._config_reload_handle.cancel()
+        if not self._shared_loop:
+            self.debug("stopping mainloop")
+            self._mainloop.stop()
+        self._dispatcher.stop()
+        self.journal_stop()
+        stats = self._dispatcher.stats()
+        self.debug(f"midi dispatcher: {stats['dispatched']} messages, max. depth: {stats['maxdepth']}, "
+                   f"overflows: {stats['overflows']}")
+        stats = self.coalesce_stats()
+        self.debug(f"coalescing: suppressed {stats['cc']['suppressed']} of {stats['cc']['received']} CC messages, "
+                   f"{stats['gui']['suppressed']} of {stats['gui']['received']} gui echoes")
+        stats = self.state_stats()
+        self.debug(f"state: {stats['writes']} writes for {stats['updates']} changes, "
+                   f"write time avg: {stats['write_time_avg']*1000:.2f} ms, max: {stats['write_time_max']*1000:.2f} ms")
         time.sleep(0.2)
+        if self.on_stop is not None:
+            self.on_stop()
 
 
 def open_in_editor(userconfig):
@@ -16,7 +16,7 @@ class CsoundVersionError(BaseException): pass
 
 def find_csound():
     path = shutil.which("csound")
-    if os.path.exists(path):
+    if path and os.path.exists(path):
         return path
     return None
   
@@ -32,9 +32,9 @@ def get_version():
     if not csound:
         raise IOError("Csound not found")
     cmd = '{csound} --help'.format(csound=csound).split()
-    proc = subprocess.Popen(cmd, stderr=subprocess.PIPE)
-    proc.wait()
+    proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, universal_newlines=True)
     lines = proc.stderr.readlines()
+    proc.wait()
     if not lines:
         raise IOError("Could not read csounds output")
     for line in lines:
@@ -69,7 +69,7 @@ def call_csound(*args, **kws):
     print("calling csound with cmd: %s" % " ".join(cmd))
     pipestderr = kws.get("pipe_stderr", False)
     if pipestderr:
-        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE)
+        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, universal_newlines=True)
     else:
         proc = subprocess.Popen(cmd)
     return proc
@@ -146,10 +146,48 @@ def get_audiodevices(backend=None):
     return indevices, outdevices
 
 
+def _jack_tool(*args):
+    """
+    Returns the output of a jack command line tool, or None if it is not
+    installed or fails
+    """
+    if shutil.which(args[0]) is None:
+        return None
+    try:
+        return subprocess.check_output(args, stderr=subprocess.DEVNULL, universal_newlines=True, timeout=5)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return None
+
+
+def _first_int(text):
+    matches = re.findall(r"\d+", text or "")
+    return int(matches[0]) if matches else None
+
+
 def detect_jack():
-    raise RuntimeError("Use jack_control status")
-    proc = call_csound('-+rtaudio=jack', '--devices', pipe_stderr=True)
-    return 'JACK module enabled' in proc.stderr.read()
+    """
+    Returns True if the jack server is running
+    """
+    if shutil.which("jack_control") is not None:
+        return subprocess.call(["jack_control", "status"], stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL) == 0
+    return _jack_tool("pgrep", "-x", "jackd") is not None
+
+
+def jack_period():
+    """
+    Returns the period (buffer size) of the running jack server in frames,
+    or None if it can't be determined
+    """
+    return _first_int(_jack_tool("jack_bufsize"))
+
+
+def jack_samplerate():
+    """
+    Returns the sample rate of the running jack server, or None if it
+    can't be determined
+    """
+    return _first_int(_jack_tool("jack_samplerate"))
 
 
 def get_system_samplerate(device=None, backend=None):
@@ -164,7 +202,7 @@ def get_system_samplerate(device=None, backend=None):
         if detect_jack():
             # Jack is present, assume the user wants to use it
             return _jack_get_samplerate()
-    args.appeng('--get-system-sr')
+    args.append('--get-system-sr')
     proc = call_csound(*args, pipe_stderr=True)
     proc.wait()
     for line in proc.stderr.readlines():
@@ -176,7 +214,9 @@ def get_system_samplerate(device=None, backend=None):
 
 
 def _jack_get_samplerate():
-    raise RuntimeError("Use jack_samplerate")
+    sr = jack_samplerate()
+    if sr:
+        return sr
     proc = call_csound('-odac', '-+rtaudio=jack', '--get-system-sr', pipe_stderr=True)
     proc.wait()
     for line in proc.stderr.readlines():
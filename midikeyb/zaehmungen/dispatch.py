@@ -0,0 +1,199 @@
+"""
+Dispatching of MIDI events away from the rtmidi callback thread
+
+The rtmidi callback only pushes (msg, timestamp) into a preallocated
+ring buffer. A single consumer thread pops the messages and applies them,
+together with any other state changes posted via Dispatcher.call, so that
+all mutations of the keyboard state happen in one thread
+
+The push never blocks: when the buffer is full the message is dropped
+and counted as an overflow. This is right for a keyboard, which can not
+be slowed down. Producers feeding faster than real time (the replay of
+the journal, the bench) must apply their own backpressure, see
+Dispatcher.push_wait
+"""
+import threading
+import time
+import traceback
+from collections import deque
+
+
+class RingBuffer:
+    """
+    A preallocated single-producer / single-consumer ring buffer
+
+    size: the capacity, rounded up to a power of two
+    """
+    def __init__(self, size=1024):
+        capacity = 1
+        while capacity < size:
+            capacity *= 2
+        self.capacity = capacity
+        self._mask = capacity - 1
+        self._slots = [None] * capacity
+        self._head = 0     # total number of items written (only the producer writes this)
+        self._tail = 0     # total number of items read (only the consumer writes this)
+        self.overflows = 0
+        self.maxdepth = 0
+
+    def push(self, item):
+        """
+        Returns False (and counts an overflow) if the buffer is full
+        """
+        head = self._head
+        depth = head - self._tail
+        if depth >= self.capacity:
+            self.overflows += 1
+            return False
+        self._slots[head & self._mask] = item
+        self._head = head + 1
+        if depth >= self.maxdepth:
+            self.maxdepth = depth + 1
+        return True
+
+    def pop(self):
+        """
+        Returns None if the buffer is empty
+        """
+        tail = self._tail
+        if tail == self._head:
+            return None
+        idx = tail & self._mask
+        item = self._slots[idx]
+        self._slots[idx] = None
+        self._tail = tail + 1
+        return item
+
+    def __len__(self):
+        return self._head - self._tail
+
+
+class Dispatcher:
+    """
+    Consumer thread for MIDI events
+
+    handler: a function (msg, timestamp), called in the consumer thread
+             for each pushed message
+    on_error: a function (exception), called when the handler or a posted
+              call raises. The consumer keeps running
+    on_idle: a function called in the consumer thread whenever the queue
+             has been drained. It returns the time in seconds after which
+             it wants to be called again, or None to wait for the next message
+    drain_context: a function returning a context manager, entered around
+                   each drain of the queue (used to batch the OSC messages
+                   caused by messages arriving together, like a chord)
+    on_overflow: a function (overflows), called in the producer thread
+                 when a message is dropped because the buffer is full.
+                 Only the first message dropped of each burst is reported
+    """
+    def __init__(self, handler, size=1024, on_error=None, on_idle=None, drain_context=None, on_overflow=None):
+        self.handler = handler
+        self.on_error = on_error
+        self.on_idle = on_idle
+        self.drain_context = drain_context
+        self.on_overflow = on_overflow
+        self.buffer = RingBuffer(size)
+        self.dispatched = 0
+        self._overflowing = False
+        self._calls = deque()
+        self._wakeup = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="MidiDispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=1):
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def push(self, msg, timestamp):
+        """
+        Called from the rtmidi callback. Never blocks: if the buffer is
+        full the message is dropped. Returns False if it was
+        """
+        if self.buffer.push((msg, timestamp)):
+            self._overflowing = False
+            self._wakeup.set()
+            return True
+        if not self._overflowing:
+            self._overflowing = True
+            if self.on_overflow is not None:
+                self.on_overflow(self.buffer.overflows)
+        return False
+
+    def push_wait(self, msg, timestamp, poll=0.0005):
+        """
+        As push, but waits while the buffer is full, for producers feeding
+        faster than real time. Returns False if the dispatcher was stopped
+        meanwhile (the message is dropped)
+        """
+        buffer = self.buffer
+        while len(buffer) >= buffer.capacity:
+            if not self._running:
+                return False
+            self._wakeup.set()
+            time.sleep(poll)
+        return self.push(msg, timestamp)
+
+    def call(self, func, args=()):
+        """
+        Run func(*args) in the consumer thread, after the MIDI
+        messages pushed so far
+        """
+        self._calls.append((self.buffer._head, func, args))
+        self._wakeup.set()
+
+    def stats(self):
+        return {
+            'depth': len(self.buffer),
+            'maxdepth': self.buffer.maxdepth,
+            'overflows': self.buffer.overflows,
+            'dispatched': self.dispatched,
+            'capacity': self.buffer.capacity
+        }
+
+    def _drain(self):
+        buffer = self.buffer
+        pop = buffer.pop
+        calls = self._calls
+        handler = self.handler
+        n = 0
+        while True:
+            # a call runs once all messages pushed before it have been handled
+            while calls and calls[0][0] <= buffer._tail:
+                _, func, args = calls.popleft()
+                func(*args)
+            item = pop()
+            if item is None:
+                break
+            handler(item[0], item[1])
+            n += 1
+        self.dispatched += n
+        return n
+
+    def _run(self):
+        wakeup = self._wakeup
+        while self._running:
+            wakeup.clear()
+            timeout = None
+            try:
+                if self.drain_context is not None:
+                    with self.drain_context():
+                        self._drain()
+                else:
+                    self._drain()
+                if self.on_idle is not None:
+                    timeout = self.on_idle()
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(e)
+                else:
+                    traceback.print_exc()
+                continue
+            if self._running:
+                wakeup.wait(timeout)
@@ -0,0 +1,187 @@
+"""
+csound embedded in the controller
+
+Instead of running csound as a separate process listening to OSC, the
+engine is hosted in-process through the csound API (ctcsound) and
+performed in a thread of its own. midikeyb.csd is compiled with the macro
+EMBEDDED, which replaces the OSC listeners by control channels:
+
+    parameters (/rate, /speed, /dur, /gain, /table, /compress, /random)
+        are written to the channel of the same name
+    notes (/noteon, /noteoff, /panic, /ping, /stop)
+        are sent as score events to the instruments which handle them
+
+What csound sends to the controller via OSC (/heart, /info, /pingback) is
+read from channels after each k-cycle and delivered as the same messages,
+so that the controller handles both modes alike.
+
+EmbeddedCsound has the interface of EngineSupervisor, so it is passed to
+MidiKeyb as engine. ctcsound is only needed for this mode.
+"""
+import collections
+import threading
+import time
+
+
+# instrument numbers, as in midikeyb.csd
+INSTR_NOTEON = 30
+INSTR_NOTEOFF = 31
+INSTR_PANIC = 32
+INSTR_PINGBACK = 100
+INSTR_EXIT = 999
+
+# OSC path -> control channel
+CHANNELS = {
+    '/rate': 'rate',
+    '/speed': 'speed',
+    '/dur': 'dur',
+    '/gain': 'gain',
+    '/table': 'table',
+    '/compress': 'compress',
+    '/random': 'random',
+}
+
+# period of the messages delivered to the controller, in seconds of
+# engine time (HEARTFREQ and INFOSENDFREQ in midikeyb.csd)
+HEART_PERIOD = 0.5
+INFO_PERIOD = 1 / 18
+
+
+class EmbeddedCsound:
+    """
+    csdpath: the csd to perform
+    options: a list of command line options, added to the CsOptions of the csd
+    deliver: a function (path, args), called from the performance thread
+             with the messages which csound would send via OSC
+    on_exit: a function (returncode), called when the performance ends by
+             itself (not by restart or stop)
+    """
+    embedded = True
+
+    def __init__(self, csdpath, options=(), deliver=None, on_exit=None):
+        self.csdpath = csdpath
+        self.options = list(options)
+        self.deliver = deliver
+        self.on_exit = on_exit
+        self.restarts = 0
+        self.last_start = None
+        self.pid = None
+        self._csound = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = False
+        # the seqs of the pings not answered yet, in the order sent
+        self._pings = collections.deque()
+
+    def running(self):
+        thread = self._thread
+        return thread is not None and thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            self._stopping = False
+            self._spawn()
+
+    def _spawn(self):
+        import ctcsound
+        cs = ctcsound.Csound()
+        for option in self.options + ["--omacro:EMBEDDED=1"]:
+            cs.setOption(option)
+        if cs.compileCsd(self.csdpath) != 0:
+            raise RuntimeError(f"could not compile {self.csdpath}")
+        if cs.start() != 0:
+            raise RuntimeError("could not start csound")
+        self._pings.clear()
+        self._csound = cs
+        self.last_start = time.perf_counter()
+        self._thread = threading.Thread(target=self._perform, args=(cs,),
+                                        name="EmbeddedCsound", daemon=True)
+        self._thread.start()
+
+    def _perform(self, cs):
+        """
+        The performance thread. Reads the channels csound writes to after
+        each k-cycle and delivers them as messages
+        """
+        def deliver(path, args):
+            # the controller may be created after the engine was started
+            if self.deliver is not None:
+                self.deliver(path, args)
+
+        kdur = cs.ksmps() / cs.sr()
+        enginetime = 0
+        nextheart = nextinfo = 0
+        pings = self._pings
+        returncode = 0
+        channel = cs.controlChannel
+        while cs is self._csound:
+            returncode = cs.performKsmps()
+            if returncode != 0:
+                break
+            enginetime += kdur
+            if pings:
+                # the channel holds the last seq answered. Pings answered
+                # within the same k-cycle overwrite each other, every seq
+                # up to it was answered
+                seq = int(channel("pingback")[0])
+                while pings and pings[0] <= seq:
+                    deliver('/pingback', (pings.popleft(),))
+            if enginetime >= nextheart:
+                nextheart += HEART_PERIOD
+                deliver('/heart', (1,))
+            if enginetime >= nextinfo:
+                nextinfo += INFO_PERIOD
+                deliver('/info', (channel("rms")[0], channel("peak")[0], channel("cpu")[0]))
+        cs.cleanup()
+        # restart and stop replace the instance before stopping it
+        expected = cs is not self._csound or self._stopping
+        if not expected and self.on_exit is not None:
+            self.on_exit(returncode)
+
+    def send(self, path, args):
+        """
+        The embedded counterpart of sending an OSC message to csound
+        """
+        cs = self._csound
+        if cs is None:
+            return
+        chan = CHANNELS.get(path)
+        if chan is not None:
+            cs.setControlChannel(chan, args[0])
+        elif path == '/noteon':
+            midinote, pos, amp = args
+            cs.inputMessage(f"i {INSTR_NOTEON} 0 1 {midinote} {pos} {amp}")
+        elif path == '/noteoff':
+            cs.inputMessage(f"i {INSTR_NOTEOFF} 0 1 {args[0]}")
+        elif path == '/panic':
+            cs.inputMessage(f"i {INSTR_PANIC} 0 1")
+        elif path == '/ping':
+            port, seq = args
+            self._pings.append(seq)
+            cs.inputMessage(f"i {INSTR_PINGBACK} 0 1 {port} {seq}")
+        elif path == '/stop':
+            cs.inputMessage(f"i {INSTR_EXIT} 0 1")
+        else:
+            raise ValueError(f"no channel or instrument for {path}")
+
+    def _halt(self, timeout):
+        cs, thread = self._csound, self._thread
+        self._csound = None
+        if cs is not None:
+            cs.stop()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+            if thread.is_alive():
+                raise RuntimeError("csound performance did not stop")
+
+    def restart(self):
+        with self._lock:
+            self._halt(1.0)
+            self._stopping = False
+            self._spawn()
+            self.restarts += 1
+
+    def stop(self, timeout=2.0):
+        with self._lock:
+            self._stopping = True
+            self._halt(timeout)
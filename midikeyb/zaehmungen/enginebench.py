@@ -0,0 +1,141 @@
+"""
+Latency comparison of the engine modes
+
+Runs midikeyb.csd with the controller once per mode
+
+    osc:      csound as a separate process, controlled via OSC
+    embedded: csound in-process via ctcsound, controlled via channels
+
+and measures the round-trip time of pings: the controller sends /ping,
+csound answers with /pingback from a score event, which is the path a note
+takes into the engine and the path of the messages coming back. The time
+spent sending (the cost of a message for the controller) is measured too.
+
+csound (and ctcsound for the embedded mode) and jack are needed. The gui
+is not: the benchmark stands in for its heartbeat.
+
+Run from the midikeyb folder:
+
+    $ python3 -m zaehmungen.enginebench
+    $ python3 -m zaehmungen.enginebench --mode embedded --pings 1000
+"""
+import argparse
+import os
+import time
+
+from . import core
+from .bench import percentile
+from .session import temporary_session
+from .supervisor import EngineSupervisor
+
+
+CSDPATH = "assets/midikeyb.csd"
+
+
+def new_engine(mode, options):
+    csdpath = os.path.abspath(CSDPATH)
+    if mode == 'embedded':
+        from .embedded import EmbeddedCsound
+        return EmbeddedCsound(csdpath, options)
+    return EngineSupervisor(["csound"] + options + [csdpath])
+
+
+def measure(mode, options, numpings=500, interval=0.01, timeout=15):
+    """
+    Returns a dict with the round-trip times and send durations, in seconds
+    """
+    # the state and the metrics of the user are left alone
+    with temporary_session(prefix="zaehmungen-enginebench-") as session:
+        engine = new_engine(mode, options)
+        engine.start()
+        keyb = core.MidiKeyb(openmidi=False, engine=engine, session=session, journal=False)
+        probe = keyb.probe
+        rtts = []
+        sendtimes = []
+        reply = probe.reply
+        send = probe.send
+
+        def recording_reply(seq, now):
+            rtt = reply(seq, now)
+            if rtt is not None:
+                rtts.append(rtt)
+            return rtt
+
+        def timed_send(seq):
+            t0 = time.perf_counter()
+            send(seq)
+            sendtimes.append(time.perf_counter() - t0)
+
+        probe.reply = recording_reply
+        probe.send = timed_send
+        keyb._running = True
+        keyb._starttime = time.time()
+        clock = time.perf_counter
+        try:
+            deadline = clock() + timeout
+            while not keyb.ready['engine'].is_set():
+                if clock() > deadline:
+                    raise RuntimeError(f"{mode}: csound did not start within {timeout} s")
+                keyb._gui_lastheartbeat = time.time()
+                keyb.tick(0.05)
+            # let the engine settle before measuring
+            settle = clock() + 1
+            while clock() < settle:
+                keyb.tick(0.05)
+            rtts.clear()
+            sendtimes.clear()
+            sent = 0
+            nextping = clock()
+            while sent < numpings:
+                now = clock()
+                if now >= nextping:
+                    probe.ping(now)
+                    sent += 1
+                    nextping += interval
+                    keyb._gui_lastheartbeat = time.time()
+                keyb.tick(max(0, nextping - clock()))
+            lastping = clock()
+            while clock() - lastping < probe.timeout:
+                keyb.tick(0.05)
+        finally:
+            keyb.stop()
+            engine.stop()
+            keyb._oscserver.free()
+    return {
+        'pings': len(sendtimes),
+        'received': len(rtts),
+        'rtt_p50': percentile(rtts, 50),
+        'rtt_p90': percentile(rtts, 90),
+        'rtt_p99': percentile(rtts, 99),
+        'rtt_max': max(rtts) if rtts else 0,
+        'send_p50': percentile(sendtimes, 50),
+        'send_p99': percentile(sendtimes, 99),
+    }
+
+
+def print_report(mode, report):
+    ms = 1000
+    print(f"--- {mode}")
+    print(f"    pings: {report['pings']}, answered: {report['received']}")
+    print(f"    round-trip (ms)  p50: {report['rtt_p50']*ms:.3f}  p90: {report['rtt_p90']*ms:.3f}  "
+          f"p99: {report['rtt_p99']*ms:.3f}  max: {report['rtt_max']*ms:.3f}")
+    print(f"    send (ms)        p50: {report['send_p50']*ms:.4f}  p99: {report['send_p99']*ms:.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Round-trip latency of the OSC and the embedded engine")
+    parser.add_argument("--mode", default="both", choices=["both", "osc", "embedded"])
+    parser.add_argument("--pings", type=int, default=500)
+    parser.add_argument("--interval", type=float, default=0.01, help="time between pings, in seconds")
+    parser.add_argument("--sr", type=int, default=44100)
+    parser.add_argument("--ksmps", type=int, default=64)
+    args = parser.parse_args()
+    options = ["-+rtaudio=jack", "-odac", f"--sample-rate={args.sr}", f"--ksmps={args.ksmps}",
+               "--messagelevel=0"]
+    modes = ["osc", "embedded"] if args.mode == "both" else [args.mode]
+    for mode in modes:
+        print_report(mode, measure(mode, options, numpings=args.pings, interval=args.interval))
+
+
+if __name__ == '__main__':
+    main()
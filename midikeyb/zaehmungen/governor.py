@@ -0,0 +1,92 @@
+"""
+Grain density governor
+
+The load of csound is roughly proportional to grain rate x grain duration
+x sounding notes. The governor estimates the load of the engine from
+
+    * the cpu usage reported by csound in /info (0-100)
+    * the jitter of the messages csound sends periodically (/heart, /info):
+      an engine which misses its deadlines delivers them late and in bursts
+
+and derives a throttle factor (1 = no throttling). Above high the factor
+is reduced at every update; below low it recovers linearly, reaching 1
+after release seconds. In between it holds. The controller scales the
+grain rate and the grain duration sent to csound by sqrt(factor) each,
+so that the grain density is scaled by factor.
+"""
+
+
+class Governor:
+    """
+    high, low: load thresholds (0-1) to throttle and to recover
+    minfactor: the lowest throttle factor
+    step: factor applied to the throttle factor at each update while overloaded
+    release: time in seconds to recover from minfactor to 1
+    jitter_full: relative jitter (deviation of an interval from its period,
+                 divided by the period) which counts as full load
+    smoothing: coefficient of the running average of the jitter (0-1, higher is slower)
+    """
+    def __init__(self, high=0.85, low=0.6, minfactor=0.25, step=0.9, release=2.0,
+                 jitter_full=0.5, smoothing=0.9):
+        self.high = high
+        self.low = low
+        self.minfactor = minfactor
+        self.step = step
+        self.release = release
+        self.jitter_full = jitter_full
+        self.smoothing = smoothing
+        self.factor = 1.0
+        self.cpu = 0.0
+        self.jitter = 0.0
+        self.throttled_updates = 0
+        self._lasttimes = {}
+        self._lastupdate = None
+
+    def configure(self, high=None, low=None, minfactor=None, release=None):
+        if high is not None:
+            self.high = high
+        if low is not None:
+            self.low = low
+        if minfactor is not None:
+            self.minfactor = minfactor
+        if release is not None:
+            self.release = release
+
+    def feed_cpu(self, percent):
+        self.cpu = percent / 100
+
+    def feed_arrival(self, key, period, now):
+        """
+        A message expected every period seconds arrived at time now
+        """
+        last = self._lasttimes.get(key)
+        self._lasttimes[key] = now
+        if last is None:
+            return
+        deviation = abs(now - last - period) / period
+        self.jitter = self.smoothing * self.jitter + (1 - self.smoothing) * deviation
+
+    def load(self):
+        return max(self.cpu, min(1.0, self.jitter / self.jitter_full))
+
+    def update(self, now):
+        """
+        Returns the new throttle factor
+        """
+        dt = 0 if self._lastupdate is None else now - self._lastupdate
+        self._lastupdate = now
+        load = self.load()
+        factor = self.factor
+        if load > self.high:
+            factor = max(self.minfactor, factor * self.step)
+            self.throttled_updates += 1
+        elif load < self.low and factor < 1:
+            factor = min(1.0, factor + dt * (1 - self.minfactor) / self.release)
+        self.factor = factor
+        return factor
+
+    def reset(self):
+        self.factor = 1.0
+        self.jitter = 0.0
+        self._lasttimes.clear()
+        self._lastupdate = None
@@ -0,0 +1,102 @@
+"""
+Several keyboards in one controller
+
+KeyboardHost runs one MidiKeyb per session (see session.py) within one
+process. The sessions share the main loop, which waits on the OSC server
+of every session, and the scheduler of the periodic tasks. Each session
+keeps its own MIDI input, dispatcher thread, config, state and engine.
+
+    sessions = make_sessions(["vl", "vla", "vc"])
+    host = KeyboardHost(sessions, engines=[...])
+    host.start()                # until stop or a connection error
+
+A /stop sent to one session stops only that one, the others keep playing.
+Once all sessions are stopped, start returns.
+The asyncio mode (aiocore.py) runs one keyboard per event loop and can
+not be hosted.
+"""
+import timer3
+
+from .core import MidiKeyb
+from .mainloop import MainLoop
+
+
+class KeyboardHost:
+    """
+    sessions: a list of Session
+    engines: the engine of each session (see MidiKeyb), or None
+    openmidi: as in MidiKeyb
+    """
+    def __init__(self, sessions, engines=None, openmidi=True):
+        if engines is None:
+            engines = [None] * len(sessions)
+        if len(engines) != len(sessions):
+            raise ValueError("there must be one engine per session")
+        self.mainloop = MainLoop()
+        self.scheduler = timer3.Timer(precision=0.05)
+        self.keybs = []
+        try:
+            for session, engine in zip(sessions, engines):
+                keyb = MidiKeyb(openmidi=openmidi, engine=engine, session=session,
+                                mainloop=self.mainloop, scheduler=self.scheduler)
+                keyb.on_stop = self._session_stopped
+                self.keybs.append(keyb)
+        except BaseException:
+            # the sessions created so far hold their ports
+            self.stop()
+            self.close()
+            raise
+
+    def __iter__(self):
+        return iter(self.keybs)
+
+    def __len__(self):
+        return len(self.keybs)
+
+    def __getitem__(self, name):
+        """
+        The keyboard of the session called name
+        """
+        for keyb in self.keybs:
+            if keyb.session.name == name:
+                return keyb
+        raise KeyError(name)
+
+    def tick(self, timeout=0.01):
+        """
+        As MidiKeyb.tick, for all sessions
+        """
+        self.mainloop.run_once(timeout)
+
+    def start(self):
+        """
+        Run the main loop until stop is called. Exceptions raised in the
+        loop (a connection error of any session) end it
+        """
+        for keyb in self.keybs:
+            keyb.activate()
+        try:
+            self.mainloop.run()
+        finally:
+            self.close()
+
+    def stop(self):
+        """
+        Stop all sessions, then the main loop. The tasks of the sessions
+        are removed from the scheduler
+        """
+        for keyb in self.keybs:
+            if not keyb.stopped:
+                keyb.stop()
+        self.mainloop.stop()
+
+    def _session_stopped(self):
+        # once every session was stopped (by /stop or by stop) the loop ends
+        if all(keyb.stopped for keyb in self.keybs):
+            self.mainloop.stop()
+
+    def close(self):
+        for keyb in self.keybs:
+            if keyb._oscserver is not None:
+                keyb.close()
+                keyb._oscserver = None
@@ -0,0 +1,289 @@
+"""
+Session journal
+
+Every MIDI message received and every OSC command applied is appended to
+a binary journal, so that what happened in a concert (a glitch, a crash,
+an overload) can be replayed later. The journal is always on (config key
+journal_enabled) and cheap enough to run in the rtmidi callback: a record
+is packed into a memory mapped file, nothing else.
+
+A record has a fixed size (RECORD, 12 bytes):
+
+    delta_us   time since the previous record, in microseconds
+    status     the MIDI status byte, or OSC_STATUS for an OSC command
+    d1, d2     the MIDI data bytes. For an OSC command d1 is the index
+               of its path in OSC_COMMANDS, d2 its second argument
+    flags      unused
+    value      the timestamp passed by rtmidi (MIDI), or the first
+               argument of the OSC command
+
+A journal file is preallocated for RECORDS_PER_FILE records. The
+unwritten part is zeros (no status byte is 0), on close the file is cut
+to its records (a file without records is removed). When a file is full the journal continues in a new one,
+only the last `keep` files are kept. Old files are removed once the new
+one has its first record, so that opening a journal alone removes nothing.
+
+    $ python3 -m zaehmungen.journal list
+    $ python3 -m zaehmungen.journal dump ~/.zaehmungen/journal/journal-20240501-201503-0000.zjl
+    $ python3 -m zaehmungen.journal replay --speed 0        # as fast as possible
+    $ python3 -m zaehmungen.journal list --session vc       # a session of a KeyboardHost
+"""
+import argparse
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .state import USERFOLDER
+
+
+JOURNAL_DIR = "journal"
+JOURNAL_FOLDER = os.path.join(USERFOLDER, JOURNAL_DIR)
+MAGIC = b'ZJNL'
+VERSION = 1
+# magic, version, record size, start time (epoch)
+HEADER = struct.Struct('<4sHHd')
+RECORD = struct.Struct('<IBBBBf')
+RECORDS_PER_FILE = 1 << 20
+KEEP_FILES = 8
+
+MAX_DELTA_US = 0xFFFFFFFF
+# undefined in MIDI, marks OSC commands
+OSC_STATUS = 0xF4
+
+# the OSC commands journaled and their number of arguments. Append only:
+# the index is stored
+OSC_COMMANDS = (
+    ('/midichannel/set', 1),
+    ('/test/noteon', 2),
+    ('/rate/set', 1),
+    ('/graindur/set', 1),
+    ('/gain/set', 1),
+    ('/random/set', 1),
+    ('/compress/set', 1),
+    ('/mindb/set', 1),
+    ('/maxdb/set', 1),
+    ('/dumpstate', 0),
+)
+OSC_CODES = {path: code for code, (path, _) in enumerate(OSC_COMMANDS)}
+
+
+class Journal:
+    """
+    Appends records to rotating, memory mapped journal files. append can
+    be called from any thread
+    """
+    def __init__(self, folder=JOURNAL_FOLDER, records_per_file=RECORDS_PER_FILE, keep=KEEP_FILES):
+        self.folder = folder
+        self.records_per_file = records_per_file
+        self.keep = keep
+        self.written = 0
+        self.path = None
+        self._lock = threading.Lock()
+        self._file = None
+        self._mm = None
+        self._count = 0
+        self._last = None
+        # the files of a session are named after its start, then numbered
+        self._stamp = time.strftime("%Y%m%d-%H%M%S")
+        self._seq = 0
+        os.makedirs(folder, exist_ok=True)
+        self._open()
+
+    def _open(self):
+        while True:
+            path = os.path.join(self.folder, f"journal-{self._stamp}-{self._seq:04d}.zjl")
+            self._seq += 1
+            if not os.path.exists(path):
+                break
+        f = open(path, 'w+b')
+        f.truncate(HEADER.size + self.records_per_file * RECORD.size)
+        self._mm = mmap.mmap(f.fileno(), 0)
+        HEADER.pack_into(self._mm, 0, MAGIC, VERSION, RECORD.size, time.time())
+        self._file = f
+        self._count = 0
+        self.path = path
+
+    def _prune(self):
+        files = journal_files(self.folder)
+        for path in files[:max(0, len(files) - self.keep)]:
+            if path != self.path:
+                os.remove(path)
+
+    def _close_file(self):
+        mm, f = self._mm, self._file
+        if mm is None:
+            return
+        self._mm = self._file = None
+        mm.flush()
+        mm.close()
+        f.truncate(HEADER.size + self._count * RECORD.size)
+        f.close()
+        if self._count == 0:
+            # nothing happened, a file without records would only push out older ones
+            os.remove(self.path)
+
+    def append(self, status, d1=0, d2=0, value=0.0):
+        now = time.perf_counter()
+        with self._lock:
+            if self._mm is None:
+                return
+            last, self._last = self._last, now
+            delta = 0 if last is None else min(int((now - last) * 1e6), MAX_DELTA_US)
+            if self._count == self.records_per_file:
+                self._close_file()
+                self._open()
+            RECORD.pack_into(self._mm, HEADER.size + self._count * RECORD.size, delta, status, d1, d2, 0, value)
+            self._count += 1
+            self.written += 1
+            if self._count == 1:
+                # older files give way only to a file with records
+                self._prune()
+
+    def midi(self, msg, timestamp):
+        self.append(msg[0], msg[1] if len(msg) > 1 else 0, msg[2] if len(msg) > 2 else 0, timestamp or 0.0)
+
+    def command(self, path, args):
+        code = OSC_CODES.get(path)
+        if code is None:
+            return
+        value = args[0] if args and isinstance(args[0], (int, float)) else 0.0
+        d2 = args[1] if len(args) > 1 and isinstance(args[1], int) and 0 <= args[1] < 256 else 0
+        self.append(OSC_STATUS, code, d2, value)
+
+    def flush(self):
+        with self._lock:
+            if self._mm is not None:
+                self._mm.flush()
+
+    def close(self):
+        with self._lock:
+            self._close_file()
+
+
+def journal_files(folder=JOURNAL_FOLDER):
+    """
+    The journal files in folder, oldest first
+    """
+    return sorted(glob.glob(os.path.join(folder, "journal-*.zjl")))
+
+
+def read_journal(path):
+    """
+    Returns (starttime, records), each record a tuple (delta, status, d1,
+    d2, value), delta in seconds
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, recordsize, starttime = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION or recordsize != RECORD.size:
+        raise ValueError(f"{path} is not a journal (version {VERSION})")
+    records = []
+    end = HEADER.size + (len(data) - HEADER.size) // RECORD.size * RECORD.size
+    for delta, status, d1, d2, _, value in RECORD.iter_unpack(data[HEADER.size:end]):
+        if status == 0:
+            break
+        records.append((delta / 1e6, status, d1, d2, value))
+    return starttime, records
+
+
+def command_args(d2, value, nargs):
+    """
+    The arguments of a journaled OSC command
+    """
+    if value == int(value):
+        value = int(value)
+    return [value, d2][:nargs]
+
+
+def replay(keyb, records, speed=1.0):
+    """
+    Feeds the records to keyb as they arrived: MIDI into midi_feed (no
+    message is dropped, however fast the replay), OSC commands into their
+    handlers. speed: 1 is the original speed, 2 twice as fast, 0 as fast
+    as possible. Returns the number of records replayed
+    """
+    clock = time.perf_counter
+    t0 = clock()
+    elapsed = 0.0
+    count = 0
+    for delta, status, d1, d2, value in records:
+        elapsed += delta
+        if speed > 0:
+            wait = t0 + elapsed / speed - clock()
+            if wait > 0:
+                time.sleep(wait)
+        if status == OSC_STATUS:
+            if d1 < len(OSC_COMMANDS):
+                path, nargs = OSC_COMMANDS[d1]
+                keyb.osc_command(path, command_args(d2, value, nargs))
+        else:
+            keyb.midi_feed([status, d1, d2], value)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List, dump and replay the session journal")
+    parser.add_argument("action", choices=["list", "dump", "replay"])
+    parser.add_argument("files", nargs="*", help="journal files (default: all, oldest first)")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 0: as fast as possible")
+    parser.add_argument("--session", help="the keyboard session (see session.py), default: the single keyboard")
+    parser.add_argument("--folder", help=f"the journal folder, default: that of the session ({JOURNAL_FOLDER})")
+    args = parser.parse_args()
+    from .session import Session
+    session = Session(args.session)
+    files = args.files or journal_files(args.folder or session.path(JOURNAL_DIR))
+    if args.action == "list":
+        for path in files:
+            starttime, records = read_journal(path)
+            duration = sum(record[0] for record in records)
+            print(f"{path}: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(starttime))}, "
+                  f"{len(records)} records, {duration:.1f} s")
+        return
+    if args.action == "dump":
+        for path in files:
+            _, records = read_journal(path)
+            t = 0.0
+            for delta, status, d1, d2, value in records:
+                t += delta
+                if status == OSC_STATUS:
+                    path, nargs = OSC_COMMANDS[d1] if d1 < len(OSC_COMMANDS) else (str(d1), 2)
+                    print(f"{t:12.6f}  {path}  {' '.join(map(str, command_args(d2, value, nargs)))}")
+                else:
+                    print(f"{t:12.6f}  {status:3d} {d1:3d} {d2:3d}  (rtmidi: {value:.6f})")
+        return
+    records = [record for path in files for record in read_journal(path)[1]]
+    if not records:
+        parser.error("nothing to replay")
+    from . import core
+    from .session import temporary_session
+    # the replay is not journaled again, and leaves the state of the session alone
+    with temporary_session(session, prefix="zaehmungen-replay-") as tempsession:
+        keyb = core.MidiKeyb(openmidi=False, session=tempsession, journal=False)
+        done = threading.Event()
+        result = []
+
+        def run():
+            t0 = time.perf_counter()
+            result.append(replay(keyb, records, speed=args.speed))
+            result.append(time.perf_counter() - t0)
+            done.set()
+
+        threading.Thread(target=run, daemon=True).start()
+        try:
+            while not done.is_set():
+                keyb.tick(0.05)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            keyb.stop()
+            keyb._oscserver.free()
+    if result:
+        print(f"replayed {result[0]} records in {result[1]:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
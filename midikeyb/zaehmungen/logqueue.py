@@ -0,0 +1,83 @@
+"""
+Logging off the hot path
+
+A logger set up with these classes only creates a record and puts it in a
+queue in the calling thread. Formatting and the actual output (file,
+terminal) happen in the thread of a logging.handlers.QueueListener.
+
+Messages should use lazy formatting, logger.debug("note: %d", midinote),
+so that the string is built in the listener thread. The arguments are
+formatted later, do not pass objects which are modified afterwards.
+"""
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler which does not format the record in the calling thread
+    and drops records when the queue is full, instead of blocking or raising
+    """
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if record.exc_info:
+            # tracebacks are rendered now, while the frames are alive
+            return super().prepare(record)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limits each class of message (same level, logged from the same line)
+    to rate messages per second, allowing bursts of up to burst messages.
+    The first message let through after others were suppressed tells how
+    many were. Only the maxbuckets classes seen last are remembered, the
+    one idle the longest is forgotten first
+    """
+    def __init__(self, rate=20, burst=50, maxbuckets=256):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.maxbuckets = maxbuckets
+        self.suppressed = 0
+        # (pathname, lineno, levelno) -> [tokens, last time, suppressed], least recently used first
+        self._buckets = OrderedDict()
+        # the handler calls its filters outside of its lock
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno, record.levelno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now, 0]
+                if len(self._buckets) > self.maxbuckets:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                self.suppressed += 1
+                return False
+            bucket[0] = tokens - 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
@@ -0,0 +1,154 @@
+"""
+Event driven main loop
+
+Waits (without timeout) on the registered file descriptors (the OSC server
+socket) and on a wakeup pipe. Tasks posted from other threads write to the
+pipe and are run as soon as the loop wakes up. Timers (call_later) bound
+the wait. When idle, the loop sleeps.
+"""
+import os
+import heapq
+import itertools
+import selectors
+import time
+from collections import deque
+
+
+class TimerHandle:
+    __slots__ = ('when', 'func', 'args', 'cancelled')
+
+    def __init__(self, when, func, args):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class MainLoop:
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._tasks = deque()
+        self._timers = []
+        self._timerseq = itertools.count()
+        self._signaled = False
+        self._running = False
+        self.wakeups = 0
+        self.tasks_run = 0
+        self.task_latency_total = 0
+        self.task_latency_max = 0
+
+    def add_reader(self, fd, callback):
+        """
+        callback is called (without arguments) in the loop whenever fd is readable
+        """
+        self._selector.register(fd, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, fd):
+        self._selector.unregister(fd)
+
+    def post(self, func, args=()):
+        """
+        Run func(*args) in the loop. Can be called from any thread
+        """
+        self._tasks.append((time.perf_counter(), func, args))
+        if not self._signaled:
+            self._wakeup()
+
+    def _wakeup(self):
+        self._signaled = True
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            pass
+
+    def call_later(self, delay, func, args=()):
+        """
+        Run func(*args) in the loop after delay seconds. To be called from
+        within the loop. Returns a handle which can be cancelled
+        """
+        handle = TimerHandle(time.monotonic() + delay, func, args)
+        heapq.heappush(self._timers, (handle.when, next(self._timerseq), handle))
+        return handle
+
+    def pending(self):
+        return len(self._tasks)
+
+    def run_once(self, timeout=None):
+        timers = self._timers
+        if timers:
+            wait = max(0, timers[0][0] - time.monotonic())
+            if timeout is None or wait < timeout:
+                timeout = wait
+        events = self._selector.select(timeout)
+        self.wakeups += 1
+        for key, mask in events:
+            callback = key.data
+            if callback is None:
+                self._signaled = False
+                try:
+                    while os.read(self._wakeup_r, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+            else:
+                callback()
+        self._run_tasks()
+        if timers:
+            self._run_timers()
+
+    def _run_timers(self):
+        timers = self._timers
+        now = time.monotonic()
+        while timers and timers[0][0] <= now:
+            handle = heapq.heappop(timers)[2]
+            if not handle.cancelled:
+                handle.func(*handle.args)
+
+    def _run_tasks(self):
+        tasks = self._tasks
+        clock = time.perf_counter
+        while tasks:
+            posted, func, args = tasks.popleft()
+            latency = clock() - posted
+            self.tasks_run += 1
+            self.task_latency_total += latency
+            if latency > self.task_latency_max:
+                self.task_latency_max = latency
+            func(*args)
+
+    def run(self):
+        """
+        Run until stop is called. Exceptions raised by tasks or callbacks
+        propagate out of run
+        """
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self):
+        """
+        Can be called from any thread
+        """
+        self._running = False
+        self._wakeup()
+
+    def stats(self):
+        return {
+            'wakeups': self.wakeups,
+            'tasks': self.tasks_run,
+            'pending': len(self._tasks),
+            'task_latency_avg': self.task_latency_total / self.tasks_run if self.tasks_run else 0,
+            'task_latency_max': self.task_latency_max
+        }
+
+    def close(self):
+        self._selector.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
@@ -0,0 +1,134 @@
+"""
+Precomputed control mappings
+
+Each curve used to map a midi value (velocity or CC) to a parameter is
+compiled into a table of 128 entries, so that handling a midi event is a
+single lookup. ControlTables are never modified: a changed configuration
+produces a new instance, which replaces the old one in one assignment.
+
+To write the tables of the current configuration, for inspection or plotting:
+
+    $ python3 -m zaehmungen.mapping tables.csv
+"""
+from functools import lru_cache
+
+from .utils import db2amp, linlin
+
+# lower limit of the noteon sensibility CC (see cc_sensibility_change)
+SENSIBILITY_MIN_DB = -60
+
+TABLE_NAMES = ('velamp', 'gain', 'gainrel', 'ratefactor', 'mindb')
+
+# velocity tables kept. The sensibility CC selects one of 128 values of
+# mindb, a sweep builds each table once
+VELOCITY_TABLES_CACHED = 512
+
+
+@lru_cache(maxsize=VELOCITY_TABLES_CACHED)
+def velocity_table(mindb, maxdb):
+    """ velocity -> amplitude of the note """
+    return tuple(db2amp(mindb + (maxdb - mindb) * (velocity / 127)) for velocity in range(128))
+
+
+def gain_curve(factor, mingain_db, maxgain_db, curve):
+    """
+    factor: the relative position of the pedal (0-1)
+
+    Returns (amp, curved factor)
+    """
+    factor = factor ** curve
+    return db2amp(mingain_db + (maxgain_db - mingain_db) * factor), factor
+
+
+def gain_tables(mingain_db, maxgain_db, curve):
+    """
+    Returns (gain, gainrel), where gain maps CC -> amplitude and
+    gainrel maps CC -> the curved relative position of the pedal (0-1)
+    """
+    pairs = [gain_curve(value / 127, mingain_db, maxgain_db, curve) for value in range(128)]
+    return tuple(amp for amp, factor in pairs), tuple(factor for amp, factor in pairs)
+
+
+def ratefactor_table(ratefactor_min, ratefactor_max):
+    """ CC -> rate factor """
+    return tuple(ratefactor_min + (ratefactor_max - ratefactor_min) * (value / 127) for value in range(128))
+
+
+@lru_cache(maxsize=64)
+def mindb_table(maxdb):
+    """ CC -> min. dB of the noteon velocity curve """
+    return tuple(linlin(value, 0, 127, SENSIBILITY_MIN_DB, maxdb) for value in range(128))
+
+
+def ratefactor_range(config):
+    # "rategactor_min" is the misspelled key of older configuration files
+    ratefactor_min = config.get('ratefactor_min', config.get('rategactor_min', 0.5))
+    return ratefactor_min, config['ratefactor_max']
+
+
+class ControlTables:
+    __slots__ = TABLE_NAMES + ('noteon_min_db', 'noteon_max_db')
+
+    def __init__(self, velamp, gain, gainrel, ratefactor, mindb, noteon_min_db, noteon_max_db):
+        self.velamp = velamp
+        self.gain = gain
+        self.gainrel = gainrel
+        self.ratefactor = ratefactor
+        self.mindb = mindb
+        self.noteon_min_db = noteon_min_db
+        self.noteon_max_db = noteon_max_db
+
+    def with_sensibility(self, mindb, maxdb):
+        """
+        Returns new tables for a changed velocity range. The other
+        tables are shared
+        """
+        if mindb == self.noteon_min_db and maxdb == self.noteon_max_db:
+            return self
+        mindbs = self.mindb if maxdb == self.noteon_max_db else mindb_table(maxdb)
+        return ControlTables(velocity_table(mindb, maxdb), self.gain, self.gainrel,
+                             self.ratefactor, mindbs, mindb, maxdb)
+
+    def rows(self):
+        """
+        Returns a list of rows (midivalue, velamp, gain, gainrel, ratefactor, mindb)
+        """
+        return [(i, self.velamp[i], self.gain[i], self.gainrel[i], self.ratefactor[i], self.mindb[i])
+                for i in range(128)]
+
+
+def compile_tables(config, noteon_min_db=None, noteon_max_db=None):
+    """
+    Compile all tables from a configuration. noteon_min_db and noteon_max_db
+    default to the values in the config
+    """
+    if noteon_min_db is None:
+        noteon_min_db = config['noteon_min_db']
+    if noteon_max_db is None:
+        noteon_max_db = config['noteon_max_db']
+    gain, gainrel = gain_tables(config['mingain_db'], config['maxgain_db'], config['volpedal_curve'])
+    return ControlTables(velamp=velocity_table(noteon_min_db, noteon_max_db),
+                         gain=gain,
+                         gainrel=gainrel,
+                         ratefactor=ratefactor_table(*ratefactor_range(config)),
+                         mindb=mindb_table(noteon_max_db),
+                         noteon_min_db=noteon_min_db,
+                         noteon_max_db=noteon_max_db)
+
+
+def export_tables(tables, path):
+    """
+    Write the tables as CSV, one row per midi value
+    """
+    with open(path, 'w') as f:
+        f.write(",".join(('midivalue',) + TABLE_NAMES) + "\n")
+        for row in tables.rows():
+            f.write(",".join(str(x) for x in row) + "\n")
+
+
+if __name__ == '__main__':
+    import sys
+    from .state import config_load
+    outfile = sys.argv[1] if len(sys.argv) > 1 else "tables.csv"
+    export_tables(compile_tables(config_load()['config']), outfile)
+    print("tables written to", outfile)
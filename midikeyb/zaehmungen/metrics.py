@@ -0,0 +1,214 @@
+"""
+Counters and histograms for a running controller
+
+Updating a metric is a couple of dict / list operations, cheap enough to
+be left on during a performance. The values are read by rendering the
+registry, either as the Prometheus text format (written periodically to
+~/.zaehmungen/metrics.prom) or as a flat list of (name, value) samples
+(sent as a reply to /metrics/get).
+
+Labelled metrics hand out one child per combination of label values.
+Children used in the hot path should be looked up once and kept:
+
+    events = metrics.counter("midi_events_total", "MIDI events", ("kind",))
+    noteons = events.labels("noteon")
+    ...
+    noteons.inc()
+"""
+from bisect import bisect_left
+
+
+# in seconds, from 10 us to 1 s
+LATENCY_BUCKETS = (0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005,
+                   0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra is not None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _sample_name(name, labelnames, labelvalues):
+    """ name of a sample in the flat list: name or name:value1:value2 """
+    return ":".join((name,) + tuple(str(value) for value in labelvalues))
+
+
+class CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # the last slot counts the values above the highest bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimated quantile: the upper bound of the bucket holding it
+        """
+        if not self.count:
+            return 0
+        rank = q * self.count
+        accum = 0
+        for i, n in enumerate(self.counts):
+            accum += n
+            if accum >= rank:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return float('inf')
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *labelvalues):
+        child = self._children.get(labelvalues)
+        if child is None:
+            child = self._children[labelvalues] = self._new_child()
+        return child
+
+    def children(self):
+        return list(self._children.items())
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return CounterValue()
+
+    def inc(self, n=1):
+        self.labels().inc(n)
+
+    def render(self):
+        for labelvalues, child in self.children():
+            yield f"{self.name}{_format_labels(self.labelnames, labelvalues)} {child.value}"
+
+    def samples(self):
+        for labelvalues, child in self.children():
+            yield _sample_name(self.name, self.labelnames, labelvalues), child.value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def render(self):
+        for labelvalues, child in self.children():
+            accum = 0
+            for bound, n in zip(self.buckets + ('+Inf',), child.counts):
+                accum += n
+                labels = _format_labels(self.labelnames, labelvalues, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {accum}"
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f"{self.name}_sum{labels} {child.sum}"
+            yield f"{self.name}_count{labels} {child.count}"
+
+    def samples(self):
+        for labelvalues, child in self.children():
+            name = _sample_name(self.name, self.labelnames, labelvalues)
+            yield name + "_count", child.count
+            yield name + "_p50", child.quantile(0.5)
+            yield name + "_p99", child.quantile(0.99)
+
+
+class Gauge(_Metric):
+    """
+    A value read when rendering. func returns a number, or for a gauge
+    with labels a dict {labelvalues tuple: number}
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, func, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.func = func
+
+    def _values(self):
+        value = self.func()
+        return value.items() if self.labelnames else [((), value)]
+
+    def render(self):
+        for labelvalues, value in self._values():
+            yield f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}"
+
+    def samples(self):
+        for labelvalues, value in self._values():
+            yield _sample_name(self.name, self.labelnames, labelvalues), value
+
+
+class Metrics:
+    """
+    A registry of metrics. All names get the given prefix
+    """
+    def __init__(self, prefix="zaehmungen_"):
+        self.prefix = prefix
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(self.prefix + name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self.prefix + name, help, labelnames, buckets))
+
+    def gauge(self, name, help, func, labelnames=()):
+        return self._add(Gauge(self.prefix + name, help, func, labelnames))
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def samples(self):
+        """
+        Returns a list of (name, value). Histograms are summarized as
+        count, p50 and p99
+        """
+        out = []
+        for metric in self._metrics:
+            out.extend(metric.samples())
+        return out
@@ -0,0 +1,112 @@
+"""
+minimal reader for Standard MIDI Files (format 0 and 1)
+
+Only channel messages are returned, meta and sysex events are
+parsed to keep track of the tempo and otherwise skipped
+"""
+import struct
+
+
+DEFAULT_TEMPO = 500000    # microseconds per quarter note (120 bpm)
+
+# number of data bytes for each channel message kind
+_DATALEN = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2}
+
+
+class MidiFileError(Exception):
+    pass
+
+
+def _read_varlen(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, pos
+
+
+def _read_chunks(data):
+    pos = 0
+    while pos + 8 <= len(data):
+        kind, length = struct.unpack(">4sI", data[pos:pos+8])
+        pos += 8
+        yield kind, data[pos:pos+length]
+        pos += length
+
+
+def _parse_track(data):
+    """
+    Returns a list of (tick, msg, tempo), where msg is a list of ints
+    (a channel message) and tempo is None or the new tempo
+    """
+    events = []
+    pos = 0
+    tick = 0
+    status = None
+    while pos < len(data):
+        delta, pos = _read_varlen(data, pos)
+        tick += delta
+        byte = data[pos]
+        if byte == 0xFF:
+            metatype = data[pos+1]
+            length, pos = _read_varlen(data, pos + 2)
+            if metatype == 0x51 and length == 3:
+                tempo = (data[pos] << 16) | (data[pos+1] << 8) | data[pos+2]
+                events.append((tick, None, tempo))
+            pos += length
+            if metatype == 0x2F:
+                break
+            continue
+        if byte == 0xF0 or byte == 0xF7:
+            length, pos = _read_varlen(data, pos + 1)
+            pos += length
+            continue
+        if byte & 0x80:
+            status = byte
+            pos += 1
+        elif status is None:
+            raise MidiFileError("running status without a previous status byte")
+        datalen = _DATALEN.get(status & 0xF0)
+        if datalen is None:
+            raise MidiFileError("unexpected status byte: %d" % status)
+        msg = [status] + list(data[pos:pos+datalen])
+        pos += datalen
+        events.append((tick, msg, None))
+    return events
+
+
+def read_midifile(path):
+    """
+    Read a Standard MIDI File
+
+    Returns a list of (time, msg), sorted by time, where time is
+    the time in seconds since the beginning of the file and msg is
+    a list of ints, in the same format as passed by rtmidi2 to a callback
+    """
+    data = open(path, 'rb').read()
+    chunks = list(_read_chunks(data))
+    if not chunks or chunks[0][0] != b'MThd':
+        raise MidiFileError("%s is not a MIDI file" % path)
+    fmt, numtracks, division = struct.unpack(">HHH", chunks[0][1][:6])
+    if division & 0x8000:
+        raise MidiFileError("SMPTE time division is not supported")
+    merged = []
+    for kind, chunk in chunks[1:]:
+        if kind == b'MTrk':
+            merged.extend(_parse_track(chunk))
+    # tempo changes must be applied before channel events on the same tick
+    merged.sort(key=lambda ev: (ev[0], ev[1] is not None))
+    out = []
+    tempo = DEFAULT_TEMPO
+    lasttick = 0
+    now = 0.0
+    for tick, msg, newtempo in merged:
+        now += (tick - lasttick) * tempo / (division * 1000000)
+        lasttick = tick
+        if newtempo is not None:
+            tempo = newtempo
+        else:
+            out.append((now, msg))
+    return out
@@ -0,0 +1,150 @@
+"""
+Minimal OSC 1.0 encoding / decoding, used where liblo is not
+
+Arguments are encoded according to their python type (int -> 'i',
+float -> 'f', str -> 's', bytes -> 'b'). As in liblo, an argument can
+also be given as a tuple (typetag, value), for example ('d', 0.5)
+"""
+import struct
+
+
+class OscDecodeError(Exception):
+    pass
+
+
+def _pad(data):
+    return data + b'\0' * (4 - len(data) % 4)
+
+
+def _encode_string(s):
+    return _pad(s.encode('utf-8'))
+
+
+def _encode_arg(arg):
+    """
+    Returns (typetag, encoded data)
+    """
+    if isinstance(arg, tuple):
+        tag, value = arg
+    elif isinstance(arg, bool):
+        return ('T' if arg else 'F'), b''
+    elif isinstance(arg, int):
+        tag, value = 'i', arg
+    elif isinstance(arg, float):
+        tag, value = 'f', arg
+    elif isinstance(arg, str):
+        tag, value = 's', arg
+    elif isinstance(arg, (bytes, bytearray)):
+        tag, value = 'b', arg
+    elif arg is None:
+        return 'N', b''
+    else:
+        raise TypeError(f"can't encode {arg!r} as OSC argument")
+    if tag == 'i':
+        return tag, struct.pack('>i', int(value))
+    if tag == 'f':
+        return tag, struct.pack('>f', value)
+    if tag == 'd':
+        return tag, struct.pack('>d', value)
+    if tag == 'h':
+        return tag, struct.pack('>q', int(value))
+    if tag == 's':
+        return tag, _encode_string(value)
+    if tag == 'b':
+        return tag, struct.pack('>i', len(value)) + bytes(value) + b'\0' * ((4 - len(value) % 4) % 4)
+    if tag in 'TFNI':
+        return tag, b''
+    raise TypeError(f"OSC type {tag} not supported")
+
+
+def encode_message(path, *args):
+    tags = [',']
+    data = []
+    for arg in args:
+        tag, encoded = _encode_arg(arg)
+        tags.append(tag)
+        data.append(encoded)
+    return _encode_string(path) + _encode_string("".join(tags)) + b''.join(data)
+
+
+def encode_bundle(messages):
+    """
+    messages: a list of (path, args). The bundle is to be executed immediately
+    """
+    out = [b'#bundle\0', struct.pack('>Q', 1)]
+    for path, args in messages:
+        msg = encode_message(path, *args)
+        out.append(struct.pack('>i', len(msg)))
+        out.append(msg)
+    return b''.join(out)
+
+
+def _read_string(data, pos):
+    end = data.index(b'\0', pos)
+    s = data[pos:end].decode('utf-8')
+    return s, (end + 4) & ~3
+
+
+def _decode_message(data):
+    path, pos = _read_string(data, 0)
+    if pos >= len(data):
+        return path, '', []
+    tags, pos = _read_string(data, pos)
+    if not tags.startswith(','):
+        raise OscDecodeError(f"malformed type tags: {tags}")
+    tags = tags[1:]
+    args = []
+    for tag in tags:
+        if tag == 'i':
+            args.append(struct.unpack_from('>i', data, pos)[0])
+            pos += 4
+        elif tag == 'f':
+            args.append(struct.unpack_from('>f', data, pos)[0])
+            pos += 4
+        elif tag == 'd':
+            args.append(struct.unpack_from('>d', data, pos)[0])
+            pos += 8
+        elif tag == 'h':
+            args.append(struct.unpack_from('>q', data, pos)[0])
+            pos += 8
+        elif tag == 's' or tag == 'S':
+            s, pos = _read_string(data, pos)
+            args.append(s)
+        elif tag == 'b':
+            size = struct.unpack_from('>i', data, pos)[0]
+            pos += 4
+            args.append(data[pos:pos+size])
+            pos += (size + 3) & ~3
+        elif tag == 'T':
+            args.append(True)
+        elif tag == 'F':
+            args.append(False)
+        elif tag == 'N':
+            args.append(None)
+        elif tag == 'I':
+            args.append(float('inf'))
+        else:
+            raise OscDecodeError(f"OSC type {tag} not supported")
+    return path, tags, args
+
+
+def decode(data):
+    """
+    Decode an OSC packet (a message or a bundle)
+
+    Returns a list of (path, typetags, args). Bundles are flattened,
+    timetags are ignored
+    """
+    try:
+        if data.startswith(b'#bundle\0'):
+            out = []
+            pos = 16
+            while pos < len(data):
+                size = struct.unpack_from('>i', data, pos)[0]
+                pos += 4
+                out.extend(decode(data[pos:pos+size]))
+                pos += size
+            return out
+        return [_decode_message(data)]
+    except (ValueError, IndexError, struct.error, UnicodeDecodeError) as e:
+        raise OscDecodeError(str(e))
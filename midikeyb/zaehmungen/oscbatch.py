@@ -0,0 +1,100 @@
+"""
+Batching of outgoing OSC messages
+
+Messages sent while a batch is open are collected and sent, when the
+outermost batch is closed, as one OSC bundle per destination
+"""
+import threading
+from contextlib import contextmanager
+
+
+# A bundle is sent as soon as it holds this many messages, to stay well
+# below the max. size of an UDP packet
+MAX_BUNDLE_MESSAGES = 64
+
+
+def destination_key(dest):
+    """
+    dest: a port number, a tuple (hostname, port) or an address object
+          with hostname and port
+    """
+    if isinstance(dest, int):
+        return ('localhost', dest)
+    if isinstance(dest, tuple):
+        return dest
+    return (dest.hostname, dest.port)
+
+
+class OscBatch:
+    """
+    flush: a function (dest, messages), called when the messages for a
+           destination reach maxsize
+    """
+    def __init__(self, flush, maxsize=MAX_BUNDLE_MESSAGES):
+        self.depth = 0
+        self.maxsize = maxsize
+        self._flush = flush
+        # destination key -> (dest, list of (path, args))
+        self.messages = {}
+
+    def add(self, dest, path, args):
+        key = destination_key(dest)
+        entry = self.messages.get(key)
+        if entry is None:
+            self.messages[key] = (dest, [(path, args)])
+        else:
+            messages = entry[1]
+            messages.append((path, args))
+            if len(messages) >= self.maxsize:
+                del self.messages[key]
+                self._flush(dest, messages)
+
+
+class OscBatcher:
+    """
+    Holds the open batch of each thread
+
+    send: a function (dest, path, *args) to send a single message
+    send_bundle: a function (dest, messages) to send a list of (path, args)
+                 as one bundle
+    """
+    def __init__(self, send, send_bundle):
+        self._send = send
+        self._send_bundle = send_bundle
+        self._local = threading.local()
+        self.bundles_sent = 0
+        self.messages_batched = 0
+
+    def current(self):
+        """
+        Returns the open batch of the calling thread, or None
+        """
+        return getattr(self._local, 'batch', None)
+
+    @contextmanager
+    def batch(self):
+        local = self._local
+        batch = getattr(local, 'batch', None)
+        if batch is None:
+            batch = local.batch = OscBatch(self._send_messages)
+        batch.depth += 1
+        try:
+            yield batch
+        finally:
+            batch.depth -= 1
+            if batch.depth == 0:
+                local.batch = None
+                self._flush(batch)
+
+    def _flush(self, batch):
+        for dest, messages in batch.messages.values():
+            self._send_messages(dest, messages)
+
+    def _send_messages(self, dest, messages):
+        if len(messages) == 1:
+            path, args = messages[0]
+            self._send(dest, path, *args)
+        else:
+            self._send_bundle(dest, messages)
+            self.bundles_sent += 1
+            self.messages_batched += len(messages)
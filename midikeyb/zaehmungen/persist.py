@@ -0,0 +1,136 @@
+"""
+Write-behind persistence of the last state
+
+The controller hands a snapshot of the state to the StateWriter whenever
+a state key changes. Snapshots equal to the last written one are dropped,
+a burst of changes (a CC sweep) is coalesced into one write, and the
+writing itself (atomic, see utils.json_dump_atomic) happens in a
+background thread.
+"""
+import threading
+import time
+import traceback
+
+from .utils import json_dump_atomic
+
+
+class StateWriter:
+    """
+    path: the file to write
+    delay: time in seconds to wait after a change before writing, so that
+           further changes are written together
+    written: the state already on disk, if known
+    """
+    def __init__(self, path, delay=1.0, written=None):
+        self.path = path
+        self.delay = delay
+        self.writes = 0
+        self.updates = 0
+        self.errors = 0
+        self.write_time_total = 0
+        self.write_time_max = 0
+        self._written = written
+        self._pending = None
+        self._flushing = False
+        self._writing = False
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="StateWriter", daemon=True)
+        self._thread.start()
+
+    def update(self, state):
+        """
+        state: a dict with the current state. Never blocks on io, can be
+               called from any thread. The dict must not be modified afterwards
+        """
+        with self._cond:
+            self.updates += 1
+            if self._pending is None and state == self._written:
+                return
+            self._pending = state
+            self._cond.notify()
+
+    def dirty(self):
+        with self._cond:
+            return self._pending is not None and self._pending != self._written
+
+    def flush(self, timeout=2):
+        """
+        Write the pending state now and wait until it is written
+        """
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                state, self._pending = self._pending, None
+                if state is not None:
+                    self._write(state)
+                return
+            self._flushing = True
+            self._cond.notify()
+            self._cond.wait_for(lambda: self._pending is None and not self._writing, timeout)
+            self._flushing = False
+
+    def stop(self):
+        self.flush()
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(1)
+
+    def stats(self):
+        return {
+            'updates': self.updates,
+            'writes': self.writes,
+            'errors': self.errors,
+            'write_time_avg': self.write_time_total / self.writes if self.writes else 0,
+            'write_time_max': self.write_time_max
+        }
+
+    def _run(self):
+        cond = self._cond
+        with cond:
+            while self._running:
+                if self._pending is None:
+                    cond.wait()
+                    continue
+                if not self._flushing:
+                    # gather further changes
+                    deadline = time.monotonic() + self.delay
+                    while self._running and not self._flushing:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        cond.wait(remaining)
+                state, self._pending = self._pending, None
+                if state is None:
+                    continue
+                # io happens outside of the lock, update never waits for the disk
+                self._writing = True
+                cond.release()
+                try:
+                    self._write(state)
+                finally:
+                    cond.acquire()
+                    self._writing = False
+                cond.notify_all()
+
+    def _write(self, state):
+        if state == self._written:
+            return
+        t0 = time.perf_counter()
+        try:
+            json_dump_atomic(state, self.path)
+        except OSError:
+            self.errors += 1
+            traceback.print_exc()
+            return
+        elapsed = time.perf_counter() - t0
+        self._written = state
+        self.writes += 1
+        self.write_time_total += elapsed
+        if elapsed > self.write_time_max:
+            self.write_time_max = elapsed
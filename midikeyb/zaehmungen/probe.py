@@ -0,0 +1,132 @@
+"""
+Round-trip latency probe for the engine
+
+The probe sends /ping with a sequence number to csound at regular
+intervals. The PINGBACK instrument echoes the number in /pingback, so
+each reply can be matched to the time its ping was sent. Pings not
+answered within timeout are counted as lost.
+
+From the round-trip times and the losses of the last pings the state of
+the engine is graded:
+
+    ok
+    degraded:   rtt above degraded, or a ping lost
+    overloaded: rtt above overloaded, or more than maxloss of the pings lost
+    dead:       no reply for dead seconds
+"""
+from collections import deque
+
+
+GRADES = ('ok', 'degraded', 'overloaded', 'dead')
+
+
+class LatencyProbe:
+    """
+    send: a function (seq), sending a ping
+    interval: time between pings, in seconds
+    timeout: a ping not answered within this time is lost
+    window: number of pings considered for grading
+    degraded, overloaded: rtt thresholds in seconds, compared with the
+                          90th percentile of the window
+    maxloss: ratio of lost pings within the window to grade as overloaded
+    dead: time without replies to grade as dead, in seconds
+    """
+    def __init__(self, send, interval=0.25, timeout=1.0, window=20,
+                 degraded=0.02, overloaded=0.05, maxloss=0.2, dead=1.5):
+        self.send = send
+        self.interval = interval
+        self.timeout = timeout
+        self.degraded = degraded
+        self.overloaded = overloaded
+        self.maxloss = maxloss
+        self.dead = dead
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+        self.late = 0
+        self.grade = 'ok'
+        self._seq = 0
+        self._pending = {}                  # seq -> time sent
+        self._results = deque(maxlen=window)   # rtt of each ping, None if lost
+        self._lastreply = None
+        self._firstping = None
+
+    def ping(self, now):
+        """
+        Send a ping, expire unanswered pings. Returns the grade
+        """
+        self._expire(now)
+        self._seq += 1
+        self._pending[self._seq] = now
+        if self._firstping is None:
+            self._firstping = now
+        self.sent += 1
+        self.send(self._seq)
+        return self.update_grade(now)
+
+    def reply(self, seq, now):
+        """
+        A /pingback arrived. Returns the round-trip time, or None if the
+        ping is unknown or was already counted as lost
+        """
+        sent = self._pending.pop(seq, None)
+        self._lastreply = now
+        if sent is None:
+            self.late += 1
+            return None
+        rtt = now - sent
+        self.received += 1
+        self._results.append(rtt)
+        return rtt
+
+    def _expire(self, now):
+        pending = self._pending
+        deadline = now - self.timeout
+        for seq in [seq for seq, sent in pending.items() if sent < deadline]:
+            del pending[seq]
+            self.lost += 1
+            self._results.append(None)
+
+    def percentile(self, q):
+        rtts = sorted(rtt for rtt in self._results if rtt is not None)
+        if not rtts:
+            return None
+        return rtts[min(len(rtts) - 1, int(q * len(rtts)))]
+
+    def update_grade(self, now):
+        lastreply = self._lastreply if self._lastreply is not None else self._firstping
+        if lastreply is not None and now - lastreply > self.dead:
+            grade = 'dead'
+        else:
+            results = self._results
+            lost = sum(1 for rtt in results if rtt is None)
+            rtt = self.percentile(0.9)
+            if (rtt is not None and rtt > self.overloaded) or (results and lost / len(results) > self.maxloss):
+                grade = 'overloaded'
+            elif (rtt is not None and rtt > self.degraded) or lost:
+                grade = 'degraded'
+            else:
+                grade = 'ok'
+        self.grade = grade
+        return grade
+
+    def reset(self):
+        """
+        Forget the pending pings and the results, for a restarted engine
+        """
+        self._pending.clear()
+        self._results.clear()
+        self._lastreply = None
+        self._firstping = None
+        self.grade = 'ok'
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'received': self.received,
+            'lost': self.lost,
+            'late': self.late,
+            'rtt_p50': self.percentile(0.5),
+            'rtt_p90': self.percentile(0.9),
+            'grade': self.grade
+        }
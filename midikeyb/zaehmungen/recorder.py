@@ -0,0 +1,75 @@
+"""
+Recording what the controller sends to the engine
+
+A recording is the stream of messages sent to csound (/noteon, /noteoff,
+/rate, /gain, ...) with the time they were sent. It starts with the
+state at the moment the recording started, so it can be rendered on its
+own (see render.py).
+
+The file is JSON lines: a header, then one [time, path, args] per message
+
+    {"version": 1, "started": "2024-05-01T20:15:03"}
+    [0.0, "/gain", [0.5]]
+    [0.25, "/noteon", [60, 0.25, 0.4]]
+"""
+import json
+import os
+import threading
+import time
+
+from .state import USERFOLDER
+
+
+RECORDING_VERSION = 1
+RECORDINGS_DIR = "recordings"
+RECORDINGS_FOLDER = os.path.join(USERFOLDER, RECORDINGS_DIR)
+
+
+class EventRecorder:
+    """
+    clock: returns the time in seconds. A recording of a scenario can use
+           the time of the scenario instead of the time of the machine
+           (see regress.py)
+    """
+    def __init__(self, clock=time.perf_counter):
+        self.events = []
+        self.started = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self._clock = clock
+        self._t0 = clock()
+        self._lock = threading.Lock()
+
+    def record(self, path, args):
+        t = self._clock() - self._t0
+        with self._lock:
+            self.events.append((t, path, list(args)))
+
+    def __len__(self):
+        return len(self.events)
+
+    def save(self, path):
+        with self._lock:
+            events = list(self.events)
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(path, "w") as f:
+            f.write(json.dumps({'version': RECORDING_VERSION, 'started': self.started}) + "\n")
+            for event in events:
+                f.write(json.dumps(event) + "\n")
+
+
+def load_events(path):
+    """
+    Returns a list of (time, path, args), sorted by time
+    """
+    events = []
+    with open(path) as f:
+        header = json.loads(f.readline())
+        if header.get('version') != RECORDING_VERSION:
+            raise ValueError(f"{path}: unsupported recording version {header.get('version')}")
+        for line in f:
+            if line.strip():
+                t, oscpath, args = json.loads(line)
+                events.append((t, oscpath, args))
+    events.sort(key=lambda event: event[0])
+    return events
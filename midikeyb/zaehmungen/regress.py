@@ -0,0 +1,350 @@
+"""
+Audio regression tests
+
+Fixed MIDI scenarios are fed to the controller (as bench.py does, without
+MIDI ports), the messages it sends to the engine are recorded and
+rendered offline, either by csound (bounce.py, catches changes to
+midikeyb.csd and to the controller) or by the NumPy renderer (render.py,
+catches changes to the controller only). Each render is compared with a
+golden render of the same scenario:
+
+    spectral_db    RMS difference of the long-term spectra, in dB
+    envelope_db    mean difference of the RMS envelopes (STFT frames), in dB
+    peak_db        difference of the peaks, in dB
+    length_s       difference of the durations, in seconds
+    time_ratio     render time relative to the render time of the golden
+
+A scenario fails when any metric is above its tolerance (TOLERANCES).
+The renders are deterministic (csound's default seeds, a fixed seed for
+NumPy): the tolerances absorb numeric differences, not different grains.
+Golden renders are machine specific (the render time) and are not part of
+the repository: create them with --update on the reference machine, after
+checking by ear that they are right.
+
+Run from the midikeyb folder:
+
+    $ python3 -m zaehmungen.regress --update
+    $ python3 -m zaehmungen.regress
+    $ python3 -m zaehmungen.regress --engine numpy chords tables
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from . import core, csoundtools
+from .bench import NOTEON, NOTEOFF, CC, chord_bursts
+from .recorder import EventRecorder
+from .sndfiles import WavReader
+from .utils import json_load, json_dump_atomic
+
+
+GOLDEN_FOLDER = "regress/golden"
+
+STFT_SIZE = 2048
+STFT_HOP = 512
+# the RMS envelope is averaged over this many frames (~ 0.2 s), single grains
+# should not count
+ENVELOPE_FRAMES = 16
+# levels more than this below the loudest frame (or bin) are not compared
+RANGE_DB = 50
+
+TOLERANCES = {
+    'spectral_db': 1.5,
+    'envelope_db': 1.5,
+    'peak_db': 1.0,
+    'length_s': 0.05,
+    'time_ratio': 1.5,
+}
+
+# renders faster than this are not checked for time regressions, their
+# render time is mostly noise
+MIN_RENDER_TIME = 0.5
+
+
+def _note(events, t, midinote, velocity, dur):
+    events.append((t, [NOTEON, midinote, velocity]))
+    events.append((t + dur, [NOTEOFF, midinote, 0]))
+
+
+def _keys(events, t, *midinotes, dur=0.05):
+    """
+    Presses the keys of the control octave together, the first one first
+    """
+    for i, midinote in enumerate(midinotes):
+        events.append((t + i * 0.01, [NOTEON, midinote, 64]))
+    for midinote in midinotes:
+        events.append((t + dur, [NOTEOFF, midinote, 0]))
+
+
+def scenario_chords(config):
+    return chord_bursts(numchords=12, chordsize=4, dur=0.4, sustain=config['CC_sustain'])
+
+
+def scenario_gainsweep(config):
+    events = []
+    _note(events, 0.1, core.C4, 90, 5.5)
+    _note(events, 0.1, core.C4 + 7, 70, 5.5)
+    cc = config['CC_gainchange']
+    values = list(range(127, -1, -2)) + list(range(0, 128, 2))
+    events.extend((0.5 + i * 0.035, [CC, cc, value]) for i, value in enumerate(values))
+    return events
+
+
+def scenario_tables(config):
+    events = []
+    _note(events, 0.1, core.C4, 90, 5.8)
+    for i, key in enumerate((core.E2, core.D2, core.F2)):
+        _keys(events, 1.5 + i * 1.5, core.C2, key)
+    return events
+
+
+def scenario_grains(config):
+    """
+    Grain rates (rate keys), grain durations (C2 + F#2..B2) and speeds
+    (C#2 + key)
+    """
+    events = []
+    _note(events, 0.1, core.C3 + 5, 100, 7.8)
+    t = 0.5
+    for key in (core.D2, core.F2, core.Fx2 + 3):
+        _keys(events, t, key, dur=0.6)
+        t += 0.8
+    for key in (core.Fx2, core.Fx2 + 2, core.B2):
+        _keys(events, t, core.C2, key)
+        t += 0.8
+    for key in (core.C3 + 4, core.C3 + 16):
+        _keys(events, t, core.Cx2, key)
+        t += 0.8
+    return events
+
+
+def scenario_randomness(config):
+    events = []
+    for i in range(6):
+        _note(events, 0.1 + i * 0.9, core.C3 + 12 + i * 5, 60 + i * 10, 1.2)
+    for cc, start in ((config['CC_randomness'], 0.2), (config['CC_compressor'], 3.0)):
+        events.extend((start + i * 0.02, [CC, cc, value]) for i, value in enumerate(range(0, 128, 4)))
+    return events
+
+
+SCENARIOS = {
+    'chords': scenario_chords,
+    'gainsweep': scenario_gainsweep,
+    'tables': scenario_tables,
+    'grains': scenario_grains,
+    'randomness': scenario_randomness,
+}
+
+
+def record_scenario(keyb, midievents):
+    """
+    Feeds the MIDI events to keyb and returns the messages it sends to the
+    engine, as (time, path, args), timed by the scenario. The events are
+    handled in the dispatcher, one after the other
+    """
+    now = [0.0]
+    recorder = EventRecorder(clock=lambda: now[0])
+    done = threading.Event()
+    errors = []
+
+    def run():
+        try:
+            keyb.reset()
+            # every CC value reaches the engine, as the scenario has it
+            keyb._ccfilter.configure(period=0)
+            keyb._recorder = recorder
+            keyb.dump_state()
+            for t, msg in sorted(midievents, key=lambda event: event[0]):
+                now[0] = t
+                keyb._midi_handle(msg, t)
+            keyb.panic()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            keyb._recorder = None
+            done.set()
+
+    keyb.run_in_dispatcher(run)
+    if not done.wait(10):
+        raise RuntimeError("the dispatcher did not run the scenario")
+    if errors:
+        raise errors[0]
+    return list(recorder.events)
+
+
+class Renderer:
+    """
+    Renders recordings with csound (engine='csound') or NumPy ('numpy')
+    """
+    def __init__(self, engine, sr=44100, ksmps=64, seed=0):
+        self.engine = engine
+        self.sr = sr
+        self.seed = seed
+        if engine == 'csound':
+            from . import bounce
+            self._bounce = bounce
+            with open(bounce.CSDPATH) as f:
+                self._csdtext = f.read()
+            self._options = bounce.csound_options(sr, ksmps)
+        else:
+            from . import render
+            self._render = render
+            self._tables = render.load_tables(sr)
+
+    def render(self, events, outpath):
+        """
+        Returns the time it took, in seconds
+        """
+        t0 = time.perf_counter()
+        if self.engine == 'numpy':
+            self._render.render(events, outpath, sr=self.sr, tables=self._tables, seed=self.seed)
+            return time.perf_counter() - t0
+        with tempfile.TemporaryDirectory() as tmp:
+            recording = os.path.join(tmp, "scenario.jsonl")
+            recorder = EventRecorder()
+            recorder.events = events
+            recorder.save(recording)
+            result = self._bounce.bounce_one({'recording': recording, 'output': outpath,
+                                              'csdtext': self._csdtext, 'options': self._options})
+        if result['error']:
+            raise RuntimeError(f"csound failed: {result['error']}")
+        return result['elapsed']
+
+
+def read_mono(path):
+    with WavReader(path) as reader:
+        data = np.concatenate([block for block in reader.blocks()])
+        return data.mean(axis=1), reader.sr
+
+
+def _db(x):
+    return 10 * np.log10(np.maximum(x, 1e-20))
+
+
+def _peak_db(x):
+    return float(_db(np.abs(x).max() ** 2)) if len(x) else float(_db(0))
+
+
+def stft_frames(x, size=STFT_SIZE, hop=STFT_HOP):
+    if len(x) < size:
+        x = np.concatenate([x, np.zeros(size - len(x))])
+    return sliding_window_view(x, size)[::hop]
+
+
+def compare(reference, test, sr):
+    """
+    Returns the metrics (see the module docstring) of test against
+    reference, both mono arrays at sr. All frames are analysed at once
+    """
+    n = min(len(reference), len(test))
+    length = abs(len(reference) - len(test)) / sr
+    ref, tst = stft_frames(reference[:n]), stft_frames(test[:n])
+    window = np.hanning(STFT_SIZE)
+    refspec = np.abs(np.fft.rfft(ref * window, axis=1)) ** 2
+    tstspec = np.abs(np.fft.rfft(tst * window, axis=1)) ** 2
+    # long-term spectra
+    refmean, tstmean = _db(refspec.mean(axis=0)), _db(tstspec.mean(axis=0))
+    loudest = np.maximum(refmean, tstmean)
+    bins = loudest > loudest.max() - RANGE_DB
+    spectral = float(np.sqrt(np.mean((refmean[bins] - tstmean[bins]) ** 2)))
+    # RMS envelopes
+    kernel = np.ones(ENVELOPE_FRAMES) / ENVELOPE_FRAMES
+    refenv = _db(np.convolve((ref ** 2).mean(axis=1), kernel, mode='same'))
+    tstenv = _db(np.convolve((tst ** 2).mean(axis=1), kernel, mode='same'))
+    floor = max(refenv.max(), tstenv.max()) - RANGE_DB
+    refenv, tstenv = np.maximum(refenv, floor), np.maximum(tstenv, floor)
+    frames = np.maximum(refenv, tstenv) > floor
+    envelope = float(np.abs(refenv[frames] - tstenv[frames]).mean()) if frames.any() else 0.0
+    peak = abs(_peak_db(reference) - _peak_db(test))
+    return {'spectral_db': spectral, 'envelope_db': envelope, 'peak_db': peak, 'length_s': length}
+
+
+def check(metrics, tolerances=TOLERANCES):
+    """
+    Returns a list of the metrics above their tolerance
+    """
+    return [name for name, value in metrics.items()
+            if name in tolerances and value is not None and value > tolerances[name]]
+
+
+def run(names, engine, update=False, golden=GOLDEN_FOLDER, sr=44100, log=print):
+    """
+    Renders the scenarios and compares them with the golden renders (or
+    writes them, if update). Returns a dict name -> result
+    """
+    folder = os.path.join(golden, engine)
+    os.makedirs(folder, exist_ok=True)
+    manifestpath = os.path.join(folder, "manifest.json")
+    manifest = json_load(manifestpath) if os.path.exists(manifestpath) else {}
+    renderer = Renderer(engine, sr=sr)
+    keyb = core.MidiKeyb(openmidi=False, journal=False)
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in names:
+                events = record_scenario(keyb, SCENARIOS[name](keyb.config))
+                outpath = os.path.join(tmp, name + ".wav")
+                rendertime = renderer.render(events, outpath)
+                goldenpath = os.path.join(folder, name + ".wav")
+                if update:
+                    shutil.copyfile(outpath, goldenpath)
+                    manifest[name] = {'render_time': rendertime, 'sr': sr, 'messages': len(events)}
+                    results[name] = {'updated': True, 'render_time': rendertime}
+                    log(f"{name}: golden written ({rendertime:.2f} s)")
+                    continue
+                if not os.path.exists(goldenpath) or name not in manifest:
+                    results[name] = {'failed': ['golden'], 'render_time': rendertime}
+                    log(f"{name}: FAILED, no golden render (run with --update)")
+                    continue
+                reference, refsr = read_mono(goldenpath)
+                test, _ = read_mono(outpath)
+                if refsr != sr:
+                    raise ValueError(f"{goldenpath} is at {refsr} Hz, rendering at {sr} Hz")
+                metrics = compare(reference, test, sr)
+                goldentime = manifest[name]['render_time']
+                metrics['time_ratio'] = (rendertime / goldentime
+                                         if max(rendertime, goldentime) >= MIN_RENDER_TIME else None)
+                failed = check(metrics)
+                results[name] = {'failed': failed, 'metrics': metrics, 'render_time': rendertime}
+                ratio = metrics['time_ratio']
+                log(f"{name}: {'FAILED (' + ', '.join(failed) + ')' if failed else 'ok'}  "
+                    f"spectral: {metrics['spectral_db']:.2f} dB, envelope: {metrics['envelope_db']:.2f} dB, "
+                    f"peak: {metrics['peak_db']:.2f} dB, length: {metrics['length_s']:.3f} s, "
+                    f"render: {rendertime:.2f} s{'' if ratio is None else f' ({ratio:.2f}x golden)'}")
+    finally:
+        keyb._dispatcher.stop()
+        keyb._mainloop.stop()
+        keyb._oscserver.free()
+    if update:
+        json_dump_atomic(manifest, manifestpath)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare renders of fixed scenarios with golden renders")
+    parser.add_argument("scenarios", nargs="*", help=f"scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--engine", choices=["csound", "numpy"],
+                        help="renderer (default: csound if installed, otherwise numpy)")
+    parser.add_argument("--update", action="store_true", help="write the golden renders")
+    parser.add_argument("--golden", default=GOLDEN_FOLDER)
+    parser.add_argument("--sr", type=int, default=44100)
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    engine = args.engine or ("csound" if csoundtools.find_csound() else "numpy")
+    results = run(args.scenarios or list(SCENARIOS), engine, update=args.update, golden=args.golden, sr=args.sr)
+    failed = [name for name, result in results.items() if result.get('failed')]
+    if failed:
+        print(f"{len(failed)} of {len(results)} scenarios failed: {', '.join(failed)}")
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
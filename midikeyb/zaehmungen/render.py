@@ -0,0 +1,413 @@
+"""
+Offline rendering of a recording, without csound
+
+Renders a recording (see recorder.py) to a wav file with NumPy, following
+instr PARTIKKEL and instr MASTER of midikeyb.csd closely enough for
+listening: rehearsal, comparisons and tests on machines without audio
+hardware or csound.
+
+What is modelled:
+
+* the parameters, with the lag (port) of the OSC instrument
+* per note: a grain stream at gk_rate * RATEMULT with the scattering of
+  idist, grains of gk_dur ms shaped by giWin (kaiser), read from the
+  note position with the random offset (linrand) and transposition
+  (rand) scaled by gk_rnd, a random channel mask, the linenr envelope
+  (attack, exponential release) and the gain of the note
+* retrigger, /noteoff and /panic release the notes
+* MASTER: the gain, then the soft knee compressor
+
+Grains are not rendered one by one: the grains starting within a chunk of
+time are rendered in batches, as one flat vector of samples (table
+reads, window, envelopes), summed into the output with np.bincount.
+
+Run from the midikeyb folder:
+
+    $ python3 -m zaehmungen.render ~/.zaehmungen/recordings/20240501-201503.jsonl -o take1.wav
+"""
+import argparse
+import math
+import time
+
+import numpy as np
+
+from .recorder import load_events
+from .sndfiles import SNDFILE_NAMES, WavReader, WavWriter, prepare_sndfiles
+
+
+# from midikeyb.csd
+LAG_GLOBAL = 0.005
+LAG_RATE = 0.005
+LAG_SPEED = 0.1
+ATTACK = 0.002
+RELEASE = 0.02
+RELEASE_LEVEL = 0.01        # linenr iatdec
+RATEMULT = 1.05
+RANDOM_MULT = 2
+POSRAND_MS = 30             # p8
+CENTRAND = 30               # p9
+DISTRIBUTION = 0.1          # p11
+WINDOW_SIZE = 8192          # giWin, GEN20 type 7 (kaiser), opt 2
+WINDOW_BETA = 2
+KSMPS = 64
+
+COMP_THRESH = 0.2
+COMP_LOKNEE = 48
+COMP_HIKNEE = 66
+COMP_ATTACK = 0.001
+COMP_RELEASE = 0.17
+COMP_LOOKAHEAD = 0.005
+# compress measures levels in dB with 0dbfs at 90 dB
+COMP_DB_OFFSET = 90
+
+# the initial values of instr OSC
+INITIAL = {'rate': 8.0, 'speed': 1.0, 'dur': 100.0, 'gain': 1.0, 'compress': 1.0, 'random': 0.0, 'table': 0}
+
+# samples rendered at once: the grains of a chunk are split in batches of
+# at most BATCH_SAMPLES samples
+CHUNK_SECONDS = 5
+BATCH_SAMPLES = 1 << 22
+
+# time rendered after the last event, in seconds
+TAIL = 1.0
+
+
+class Timeline:
+    """
+    A parameter set at given times. With a halftime it follows its value
+    as csound's port does, exponentially
+    """
+    def __init__(self, initial, halftime=0.0):
+        self.halftime = halftime
+        self._events = [(0.0, initial)]
+
+    def set(self, t, value):
+        self._events.append((t, value))
+
+    def freeze(self):
+        events = sorted(self._events, key=lambda event: event[0])
+        self.times = np.array([t for t, _ in events])
+        self.values = np.array([v for _, v in events], dtype=float)
+        # the level at the start of each segment
+        starts = self.values.copy()
+        if self.halftime > 0:
+            for i in range(1, len(starts)):
+                dt = self.times[i] - self.times[i-1]
+                starts[i] = self.values[i-1] + (starts[i-1] - self.values[i-1]) * 2 ** (-dt / self.halftime)
+        self.starts = starts
+        return self
+
+    def at(self, t):
+        t = np.asarray(t, dtype=float)
+        i = np.maximum(np.searchsorted(self.times, t, side='right') - 1, 0)
+        target = self.values[i]
+        if self.halftime <= 0:
+            return target
+        return target + (self.starts[i] - target) * np.exp2(-(t - self.times[i]) / self.halftime)
+
+
+class Note:
+    def __init__(self, start, pos, gain):
+        self.start = start
+        self.pos = pos
+        self.gain = gain
+        self.release = None         # the time its release starts
+
+    def envelope(self, t):
+        """
+        linenr: linear attack, exponential release down to RELEASE_LEVEL
+        """
+        start, release_at = self.start, self.release
+        env = np.clip((t - start) / ATTACK, 0, 1)
+        if release_at is not None:
+            level = min(1.0, (release_at - start) / ATTACK)
+            after = t >= release_at
+            dt = t[after] - release_at
+            env[after] = np.where(dt < RELEASE, level * RELEASE_LEVEL ** (dt / RELEASE), 0)
+        return env * self.gain
+
+
+def parse_events(events, duration=None):
+    """
+    Builds the parameter timelines and the notes from the messages of a
+    recording. Returns (params, notes, end), end is the time when the
+    rendering stops (the last event plus TAIL, or duration)
+    """
+    params = {
+        'rate': Timeline(INITIAL['rate'], LAG_RATE),
+        'speed': Timeline(INITIAL['speed'], LAG_SPEED),
+        'dur': Timeline(INITIAL['dur'], LAG_GLOBAL),
+        'gain': Timeline(INITIAL['gain'], LAG_GLOBAL),
+        'compress': Timeline(INITIAL['compress'], LAG_GLOBAL),
+        'random': Timeline(INITIAL['random']),
+        'table': Timeline(INITIAL['table']),
+    }
+    notes = []
+    sounding = {}       # midinote -> Note
+    end = None
+    for t, path, args in events:
+        name = path[1:]
+        if name in params:
+            params[name].set(t, args[0])
+        elif path == '/noteon':
+            midinote, pos, gain = args
+            old = sounding.pop(midinote, None)
+            if old is not None:
+                old.release = t
+            note = sounding[midinote] = Note(t, pos, gain)
+            notes.append(note)
+        elif path == '/noteoff':
+            note = sounding.pop(args[0], None)
+            if note is not None:
+                note.release = t
+        elif path == '/panic':
+            for note in sounding.values():
+                note.release = t
+            sounding.clear()
+        elif path == '/stop':
+            end = t
+            break
+    if end is None:
+        end = (events[-1][0] if events else 0) + TAIL
+    if duration is not None:
+        end = duration
+    for note in notes:
+        if note.release is None or note.release > end:
+            note.release = end
+    return {name: timeline.freeze() for name, timeline in params.items()}, notes, end
+
+
+def grain_onsets(note, rategrid, phase, dt, rng):
+    """
+    The onsets of the grains of a note. phase is the running integral of
+    the grain rate over the control grid (rategrid, steps of dt)
+    """
+    end = note.release + RELEASE
+    t0 = note.start
+    p0 = np.interp(t0, np.arange(len(phase)) * dt, phase)
+    p1 = np.interp(end, np.arange(len(phase)) * dt, phase)
+    count = int(math.floor(p1 - p0)) + 1
+    onsets = np.interp(p0 + np.arange(count), phase, np.arange(len(phase)) * dt)
+    # idist: each grain is displaced by a random fraction of the period
+    rates = rategrid[np.minimum((onsets / dt).astype(int), len(rategrid) - 1)]
+    onsets += rng.random(count) * DISTRIBUTION / rates
+    return onsets[onsets < end]
+
+
+class GranularRenderer:
+    """
+    tables: a list of mono arrays, the sound files (VL, VLA, VC) at sr
+    """
+    def __init__(self, tables, sr=44100, seed=0):
+        self.tables = [np.ascontiguousarray(table, dtype=np.float64) for table in tables]
+        self.sr = sr
+        self.rng = np.random.default_rng(seed)
+        self.window = np.kaiser(WINDOW_SIZE, WINDOW_BETA)
+
+    def grains(self, params, notes, end):
+        """
+        Computes all grains. Returns a dict of arrays, one entry per grain,
+        sorted by onset
+        """
+        sr, rng = self.sr, self.rng
+        dt = KSMPS / sr
+        grid = np.arange(int(end / dt) + 2) * dt
+        rategrid = np.maximum(params['rate'].at(grid) * RATEMULT, 1e-3)
+        phase = np.concatenate([[0], np.cumsum(rategrid[:-1] * dt)])
+        onsets, noteidx = [], []
+        for i, note in enumerate(notes):
+            t = grain_onsets(note, rategrid, phase, dt, rng)
+            onsets.append(t)
+            noteidx.append(np.full(len(t), i))
+        onset = np.concatenate(onsets) if onsets else np.zeros(0)
+        noteidx = np.concatenate(noteidx).astype(int) if noteidx else np.zeros(0, dtype=int)
+        order = np.argsort(onset, kind='stable')
+        onset, noteidx = onset[order], noteidx[order]
+        n = len(onset)
+        reflen = len(self.tables[0])
+        table = np.clip(params['table'].at(onset).astype(int), 0, len(self.tables) - 1)
+        tablelen = np.array([len(t) for t in self.tables])[table]
+        rnd = params['random'].at(onset) * RANDOM_MULT
+        notepos = np.array([note.pos for note in notes])[noteidx]
+        # linrand: linear distribution, favouring small values
+        posrand = (POSRAND_MS * rnd) / 1000 / (reflen / sr)
+        pos = notepos + np.minimum(rng.random(n), rng.random(n)) * posrand
+        cents = (rng.random(n) * 2 - 1) * CENTRAND * rnd
+        # the file is read at gk_speed for the length of VL (iorig), transposed
+        increment = params['speed'].at(onset) * 2 ** (cents / 1200) * tablelen / reflen
+        length = np.maximum((params['dur'].at(onset) / 1000 * sr).astype(int), 1)
+        return {
+            'onset': np.round(onset * sr).astype(np.int64),
+            'note': noteidx,
+            'table': table,
+            'start': pos * tablelen,
+            'increment': increment,
+            'length': length,
+            # the share of the left channel, only aL is used
+            'amp': 1 - rng.random(n),
+        }
+
+    def _render_batch(self, grains, sel, notes, out, outstart):
+        """
+        Renders the grains sel, summing them into out (which begins at
+        sample outstart)
+        """
+        sr = self.sr
+        lengths = grains['length'][sel]
+        total = int(lengths.sum())
+        if total == 0:
+            return
+        first = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        g = np.repeat(np.arange(len(sel)), lengths)
+        offset = np.arange(total) - first[g]
+        gsel = sel[g]
+        window = self.window[(offset * (WINDOW_SIZE - 1)) // lengths[g]]
+        signal = np.empty(total)
+        for tableidx, table in enumerate(self.tables):
+            mask = grains['table'][gsel] == tableidx
+            if not mask.any():
+                continue
+            gs = gsel[mask]
+            readpos = grains['start'][gs] + offset[mask] * grains['increment'][gs]
+            size = len(table)
+            i0 = np.floor(readpos)
+            frac = readpos - i0
+            i0 = i0.astype(np.int64) % size
+            signal[mask] = table[i0] + (table[(i0 + 1) % size] - table[i0]) * frac
+        outidx = grains['onset'][gsel] + offset
+        t = outidx / sr
+        env = np.empty(total)
+        noteidx = grains['note'][gsel]
+        for i in np.unique(grains['note'][sel]):
+            mask = noteidx == i
+            env[mask] = notes[i].envelope(t[mask])
+        out += np.bincount(outidx - outstart, weights=signal * window * env * grains['amp'][gsel],
+                           minlength=len(out))[:len(out)]
+
+    def render_bus(self, params, notes, end):
+        """
+        Yields the sum of the notes (gaL), chunk by chunk
+        """
+        grains = self.grains(params, notes, end)
+        onsets, lengths = grains['onset'], grains['length']
+        totalframes = int(round(end * self.sr))
+        chunksize = CHUNK_SECONDS * self.sr
+        maxlen = int(lengths.max()) if len(lengths) else 0
+        carry = np.zeros(0)
+        for chunkstart in range(0, totalframes, chunksize):
+            chunkend = min(chunkstart + chunksize, totalframes)
+            out = np.zeros(chunkend - chunkstart + maxlen)
+            out[:len(carry)] += carry
+            lo, hi = np.searchsorted(onsets, [chunkstart, chunkend])
+            start = lo
+            while start < hi:
+                # as many grains as fit in a batch, at least one
+                stop = start + int(np.searchsorted(np.cumsum(lengths[start:hi]), BATCH_SAMPLES)) + 1
+                stop = min(stop, hi)
+                self._render_batch(grains, np.arange(start, stop), notes, out, chunkstart)
+                start = stop
+            yield out[:chunkend - chunkstart]
+            carry = out[chunkend - chunkstart:]
+
+
+class Master:
+    """
+    instr MASTER: gain and compressor, processing the bus block by block
+    """
+    def __init__(self, params, sr):
+        self.params = params
+        self.sr = sr
+        self.frame = 0
+        self.lookahead = int(COMP_LOOKAHEAD * sr)
+        self._delay = np.zeros(self.lookahead)
+        self._level = 0.0
+        self._attack = math.exp(-KSMPS / (COMP_ATTACK * sr))
+        self._release = math.exp(-KSMPS / (COMP_RELEASE * sr))
+
+    def _reduction(self, leveldb, ratio):
+        """
+        The gain reduction in dB: none below the low knee, a soft knee up
+        to the high knee, the full ratio above it
+        """
+        width = COMP_HIKNEE - COMP_LOKNEE
+        slope = 1 - 1 / ratio
+        over = leveldb - COMP_LOKNEE
+        return np.where(leveldb <= COMP_LOKNEE, 0,
+                        np.where(leveldb < COMP_HIKNEE, slope * over * over / (2 * width),
+                                 slope * (leveldb - (COMP_LOKNEE + COMP_HIKNEE) / 2)))
+
+    def process(self, bus):
+        n = len(bus)
+        t = (self.frame + np.arange(n)) / self.sr
+        x = bus * self.params['gain'].at(t)
+        # the level follows the signal lookahead seconds ahead of the output
+        delayed = np.concatenate([self._delay, x])
+        self._delay = delayed[n:]
+        numblocks = -(-n // KSMPS)
+        padded = np.zeros(numblocks * KSMPS)
+        padded[:n] = np.abs(x)
+        peaks = padded.reshape(numblocks, KSMPS).max(axis=1)
+        levels = np.empty(numblocks)
+        level, attack, release = self._level, self._attack, self._release
+        for i, peak in enumerate(peaks):
+            coef = attack if peak > level else release
+            level = peak + (level - peak) * coef
+            levels[i] = level
+        self._level = level
+        leveldb = 20 * np.log10(np.maximum(levels, 1e-9)) + COMP_DB_OFFSET
+        blocktimes = (self.frame + np.arange(numblocks) * KSMPS) / self.sr
+        ratio = 1 + self.params['compress'].at(blocktimes) * 2
+        gaindb = -self._reduction(leveldb, ratio)
+        gaindb[leveldb < COMP_THRESH] = -np.inf
+        gains = np.repeat(10 ** (gaindb / 20), KSMPS)[:n]
+        self.frame += n
+        return delayed[:n] * gains
+
+
+def load_tables(sr, log=print):
+    paths = prepare_sndfiles(sr, log=log)
+    tables = []
+    for name in SNDFILE_NAMES:
+        with WavReader(paths[name]) as reader:
+            tables.append(np.concatenate([block[:, 0] for block in reader.blocks()]))
+    return tables
+
+
+def render(events, outpath, sr=44100, tables=None, seed=0, duration=None, log=print):
+    """
+    Render the events of a recording to outpath (stereo, float). Returns
+    a dict with the duration rendered and the time it took
+    """
+    t0 = time.perf_counter()
+    if tables is None:
+        tables = load_tables(sr, log=log)
+    params, notes, end = parse_events(events, duration=duration)
+    renderer = GranularRenderer(tables, sr=sr, seed=seed)
+    master = Master(params, sr)
+    writer = WavWriter(outpath, sr, 2)
+    try:
+        for bus in renderer.render_bus(params, notes, end):
+            out = master.process(bus)
+            writer.write(np.column_stack([out, out]))
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - t0
+    return {'duration': end, 'elapsed': elapsed, 'notes': len(notes)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a recording to a wav file, without csound")
+    parser.add_argument("recording", help="a recording (.jsonl), see /record/start")
+    parser.add_argument("-o", "--output", default="render.wav")
+    parser.add_argument("--sr", type=int, default=44100)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the grain randomness")
+    parser.add_argument("--duration", type=float, help="seconds to render (default: until the last event)")
+    args = parser.parse_args()
+    result = render(load_events(args.recording), args.output, sr=args.sr, seed=args.seed,
+                    duration=args.duration)
+    print(f"{args.output}: {result['duration']:.1f} s, {result['notes']} notes, rendered in "
+          f"{result['elapsed']:.2f} s ({result['duration'] / max(result['elapsed'], 1e-9):.1f}x realtime)")
+
+
+if __name__ == '__main__':
+    main()
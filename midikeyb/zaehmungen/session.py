@@ -0,0 +1,165 @@
+"""
+Keyboard sessions
+
+The piece has three players. A Session is what distinguishes one keyboard
+from the others when several run in one controller process (see host.py):
+
+    ports:   each session uses three consecutive ports from its port base:
+             csound listens on portbase, the controller on portbase+1 and
+             the gui on portbase+2
+    midi:    the MIDI port patterns of the keyboard (default: midiports of
+             its config)
+    folder:  the config, the last state, the journal, the recordings and
+             the metrics. The default session uses ~/.zaehmungen, a named
+             session ~/.zaehmungen/sessions/<name>
+    engine:  the host the csound of the session listens on
+
+The default session (no name, port base 7770) is the single keyboard of
+zaehmungenkeyb.py, nothing changes for it.
+
+    sessions = make_sessions(["vl", "vla", "vc"])     # ports 7770, 7780, 7790
+
+The tools (bench, replay of the journal) run in a temporary session, see
+temporary_session, so that they leave the state of the user alone.
+"""
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from .state import USERFOLDER, CONFIGFILE_USER
+
+
+DEFAULT_PORTBASE = 7770
+# the ports of a session: csound, controller, gui
+PORT_CSD = 0
+PORT_CORE = 1
+PORT_INFO = 2
+# distance between the port bases of consecutive sessions
+PORT_STRIDE = 10
+
+SESSIONS_FOLDER = os.path.join(USERFOLDER, "sessions")
+
+
+class Session:
+    """
+    name: None for the default session
+    portbase: the first of the ports of the session
+    midiports: a list of MIDI port patterns, overriding the config
+    engine_host: the host where the csound of this session listens
+    gui: False if no gui is connected to this session. Its heartbeat
+         is then not expected
+    folder: overrides the folder of the session (the tools use a
+            temporary one, to leave the state of the user alone)
+    """
+    def __init__(self, name=None, portbase=DEFAULT_PORTBASE, midiports=None, engine_host="127.0.0.1", gui=True,
+                 folder=None):
+        self.name = name
+        self.portbase = portbase
+        self.midiports = list(midiports) if midiports else None
+        self.engine_host = engine_host
+        self.gui = gui
+        self._folder = folder
+
+    def __repr__(self):
+        return f"Session({self.name!r}, portbase={self.portbase})"
+
+    @property
+    def csd_port(self):
+        return self.portbase + PORT_CSD
+
+    @property
+    def core_port(self):
+        return self.portbase + PORT_CORE
+
+    @property
+    def info_port(self):
+        return self.portbase + PORT_INFO
+
+    @property
+    def folder(self):
+        if self._folder is not None:
+            return self._folder
+        if self.name is None:
+            return USERFOLDER
+        return os.path.join(SESSIONS_FOLDER, self.name)
+
+    def path(self, filename):
+        """
+        The path of filename within the folder of this session
+        """
+        return os.path.join(self.folder, filename)
+
+    @property
+    def label(self):
+        return self.name or "default"
+
+    @property
+    def clientname(self):
+        """
+        The name of the MIDI and jack clients. None for the default session
+        """
+        return None if self.name is None else f"zaehmungen-{self.name}"
+
+    def csound_options(self):
+        """
+        The options telling the csd (see midikeyb.csd) the ports of this
+        session and the name of its jack client
+        """
+        options = [f"--omacro:OSCPORT={self.csd_port}",
+                   f"--omacro:HEARTPORT={self.core_port}",
+                   f"--omacro:INFOPORT={self.core_port}"]
+        if self.clientname is not None:
+            options.append(f"-+jack_client={self.clientname}")
+        return options
+
+
+def make_sessions(specs, portbase=DEFAULT_PORTBASE, stride=PORT_STRIDE):
+    """
+    specs: a list of names, or of dicts with the arguments of Session
+           (name, midiports, engine_host, gui). A dict can set its
+           own portbase
+    Returns a list of sessions with consecutive port bases. Only the
+    first one has a gui, unless a spec says otherwise
+    """
+    sessions = []
+    for i, spec in enumerate(specs):
+        if isinstance(spec, str):
+            spec = {'name': spec}
+        spec = dict(spec)
+        spec.setdefault('portbase', portbase + i * stride)
+        spec.setdefault('gui', i == 0)
+        sessions.append(Session(**spec))
+    ports = [port for session in sessions for port in (session.csd_port, session.core_port, session.info_port)]
+    if len(set(ports)) != len(ports):
+        raise ValueError(f"the ports of the sessions overlap: {sessions}")
+    names = [session.name for session in sessions]
+    if len(set(names)) != len(names):
+        raise ValueError(f"session names must be unique: {names}")
+    return sessions
+
+
+@contextmanager
+def temporary_session(base=None, prefix="zaehmungen-", **kws):
+    """
+    A session like base (default: the default session) in a temporary
+    folder with a copy of the user config of base. The last state, the
+    journal and the metrics written meanwhile are removed afterwards.
+    kws override the arguments of Session (portbase, gui, ...)
+
+        with temporary_session(prefix="zaehmungen-bench-", gui=False) as session:
+            keyb = MidiKeyb(openmidi=False, session=session, journal=False)
+    """
+    if base is None:
+        base = Session()
+    folder = tempfile.mkdtemp(prefix=prefix)
+    try:
+        userconfig = base.path(CONFIGFILE_USER)
+        if os.path.exists(userconfig):
+            shutil.copy(userconfig, folder)
+        args = dict(name=base.name, portbase=base.portbase, midiports=base.midiports,
+                    engine_host=base.engine_host, gui=base.gui)
+        args.update(kws)
+        yield Session(folder=folder, **args)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
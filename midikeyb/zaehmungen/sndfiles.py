@@ -0,0 +1,324 @@
+"""
+Preparing the source sound files for the engine
+
+The grains are read from VL.wav, VLA.wav and VC.wav (GEN01 in
+midikeyb.csd). The playback speed assumes that the sample rate of the
+files is the sample rate of the engine, which is set by the launcher (SR).
+This module converts the recorded files (assets/sndfiles48/NOTNORMALIZED)
+to the rate of the engine and normalizes them, streaming the files in
+blocks. The results are cached in ~/.zaehmungen/sndcache, named after a hash
+of the source contents, the rate and the processing, so that a file is only
+processed again when its source or the rate changes. The launcher passes
+the paths to csound as macros (SNDFILE_VL, ...).
+
+Run from the midikeyb folder:
+
+    $ python3 -m zaehmungen.sndfiles --sr 44100
+"""
+import argparse
+import hashlib
+import math
+import os
+import struct
+import time
+
+import numpy as np
+
+from .state import USERFOLDER
+from .utils import json_load, json_dump_atomic
+
+
+SNDFILE_NAMES = ('VL', 'VLA', 'VC')
+SOURCE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "assets", "sndfiles48",
+                             "NOTNORMALIZED")
+CACHE_FOLDER = os.path.join(USERFOLDER, "sndcache")
+
+# peak of a normalized file
+NORMALIZE_PEAK = 1.0
+
+# frames read per block
+BLOCKSIZE = 65536
+
+# bump when the processing changes, to invalidate the cache
+PIPELINE_VERSION = 1
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+class WavReader:
+    """
+    Reads a PCM (16, 24, 32 bits) or float (32, 64 bits) wav file in blocks
+    of float64 frames, shape (frames, channels)
+    """
+    def __init__(self, path):
+        self.path = path
+        self._f = f = open(path, 'rb')
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError(f"{path} is not a wav file")
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f"{path}: no data chunk")
+            chunkid, size = struct.unpack('<4sI', header)
+            if chunkid == b'fmt ':
+                fmt = f.read(size)
+                if size & 1:
+                    f.read(1)
+            elif chunkid == b'data':
+                break
+            else:
+                f.seek(size + (size & 1), 1)
+        if fmt is None:
+            raise ValueError(f"{path}: data before fmt chunk")
+        tag, self.channels, self.sr, _, blockalign, self.bits = struct.unpack_from('<HHIIHH', fmt)
+        if tag == WAVE_FORMAT_EXTENSIBLE:
+            tag = struct.unpack_from('<H', fmt, 24)[0]
+        self.framesize = blockalign
+        self.frames = size // blockalign
+        self._datastart = f.tell()
+        if tag == WAVE_FORMAT_IEEE_FLOAT and self.bits in (32, 64):
+            self._dtype = np.dtype(f'<f{self.bits // 8}')
+        elif tag == WAVE_FORMAT_PCM and self.bits in (16, 24, 32):
+            self._dtype = None
+        else:
+            raise ValueError(f"{path}: format {tag} with {self.bits} bits is not supported")
+
+    def _decode(self, data):
+        if self._dtype is not None:
+            return data.view(self._dtype).astype(np.float64)
+        bits = self.bits
+        if bits == 24:
+            raw = data.reshape(-1, 3)
+            ints = (raw[:, 0].astype(np.int32) | (raw[:, 1].astype(np.int32) << 8) |
+                    (raw[:, 2].astype(np.int8).astype(np.int32) << 16))
+        else:
+            ints = data.view(f'<i{bits // 8}')
+        return ints.astype(np.float64) / (1 << (bits - 1))
+
+    def blocks(self, blocksize=BLOCKSIZE):
+        f = self._f
+        f.seek(self._datastart)
+        remaining = self.frames
+        while remaining > 0:
+            n = min(blocksize, remaining)
+            data = np.frombuffer(f.read(n * self.framesize), dtype=np.uint8)
+            n = len(data) // self.framesize
+            if n == 0:
+                break
+            remaining -= n
+            yield self._decode(data[:n * self.framesize]).reshape(n, self.channels)
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class WavWriter:
+    """
+    Writes a float32 wav file, block by block. The sizes in the header are
+    written on close
+    """
+    def __init__(self, path, sr, channels):
+        self.path = path
+        self.channels = channels
+        self.frames = 0
+        self._f = f = open(path, 'wb')
+        f.write(struct.pack('<4sI4s', b'RIFF', 0, b'WAVE'))
+        f.write(struct.pack('<4sIHHIIHH', b'fmt ', 16, WAVE_FORMAT_IEEE_FLOAT, channels, sr,
+                            sr * channels * 4, channels * 4, 32))
+        f.write(struct.pack('<4sI', b'data', 0))
+
+    def write(self, block):
+        self._f.write(np.ascontiguousarray(block, dtype='<f4').tobytes())
+        self.frames += len(block)
+
+    def close(self):
+        f = self._f
+        datasize = self.frames * self.channels * 4
+        f.seek(4)
+        f.write(struct.pack('<I', 36 + datasize))
+        f.seek(40)
+        f.write(struct.pack('<I', datasize))
+        f.close()
+
+
+class Resampler:
+    """
+    Streaming band-limited resampler (windowed sinc, polyphase)
+
+    zerocrossings: zero crossings of the sinc at each side, the quality
+    rolloff: cutoff relative to the lower nyquist frequency
+    """
+    def __init__(self, sr_in, sr_out, channels=1, zerocrossings=32, rolloff=0.95, beta=8.6):
+        g = math.gcd(sr_in, sr_out)
+        self.up = up = sr_out // g
+        self.down = down = sr_in // g
+        # cutoff in cycles per input sample
+        fc = 0.5 * rolloff * min(1.0, up / down)
+        self.half = half = int(math.ceil(zerocrossings / (2 * fc)))
+        self.offsets = offsets = np.arange(-half + 1, half + 1)
+        # one filter per fractional position
+        frac = np.arange(up)[:, None] / up
+        t = frac - offsets[None, :]
+        x = np.clip(t / half, -1, 1)
+        window = np.i0(beta * np.sqrt(1 - x * x)) / np.i0(beta)
+        taps = np.sinc(2 * fc * t) * window
+        self.taps = taps / taps.sum(axis=1, keepdims=True)
+        self.channels = channels
+        # the input not consumed yet, starting with half frames of silence
+        self._buf = np.zeros((half, channels))
+        self._bufstart = -half     # input index of _buf[0]
+        self._inframes = 0
+        self._outframes = 0
+
+    def _compute(self, available):
+        """
+        Returns the output frames whose input (incl. lookahead) is in the
+        buffer, up to the input index available
+        """
+        up, down = self.up, self.down
+        n0 = self._outframes
+        # the outputs n with (n*down)//up + half <= available - 1
+        n1 = -(-(available - self.half) * up // down)
+        if n1 <= n0:
+            return np.zeros((0, self.channels))
+        n = np.arange(n0, n1)
+        base = (n * down) // up
+        phase = (n * down) % up
+        index = base[:, None] + self.offsets[None, :] - self._bufstart
+        frames = self._buf[index]                          # (n, taps, channels)
+        out = np.einsum('ntc,nt->nc', frames, self.taps[phase])
+        self._outframes = n1
+        # drop the input which no further output needs
+        drop = (n1 * down) // up - self.half + 1 - self._bufstart
+        if drop > 0:
+            self._buf = self._buf[drop:]
+            self._bufstart += drop
+        return out
+
+    def process(self, block):
+        self._buf = np.concatenate([self._buf, block])
+        self._inframes += len(block)
+        return self._compute(self._inframes)
+
+    def flush(self):
+        """
+        Returns the remaining output, the end of the input is padded with silence
+        """
+        total = -(-self._inframes * self.up // self.down)
+        self._buf = np.concatenate([self._buf, np.zeros((self.half + 1, self.channels))])
+        out = self._compute(self._inframes + self.half + 1)
+        return out[:max(0, total - (self._outframes - len(out)))]
+
+
+def file_peak(path):
+    with WavReader(path) as reader:
+        return max((float(np.abs(block).max()) for block in reader.blocks()), default=0.0)
+
+
+def convert(src, dst, sr, normalize=True):
+    """
+    Resample src to sr and normalize it (if normalize), writing dst.
+    Returns the gain applied
+    """
+    gain = 1.0
+    if normalize:
+        peak = file_peak(src)
+        if peak > 0:
+            gain = NORMALIZE_PEAK / peak
+    with WavReader(src) as reader:
+        writer = WavWriter(dst, sr, reader.channels)
+        try:
+            if reader.sr == sr:
+                for block in reader.blocks():
+                    writer.write(block * gain)
+            else:
+                resampler = Resampler(reader.sr, sr, reader.channels)
+                for block in reader.blocks():
+                    writer.write(resampler.process(block) * gain)
+                writer.write(resampler.flush() * gain)
+        finally:
+            writer.close()
+    return gain
+
+
+def _source_digest(path, manifest):
+    """
+    The sha1 of the contents of path. It is computed again only if
+    the size or the modification time changed
+    """
+    st = os.stat(path)
+    entry = manifest.get(path)
+    if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+        return entry['sha1']
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    manifest[path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': digest}
+    return digest
+
+
+def prepare_sndfiles(sr, normalize=True, source=SOURCE_FOLDER, cachedir=CACHE_FOLDER, force=False,
+                     log=print):
+    """
+    Make sure that there is a processed version of each sound file in the
+    cache. Returns a dict name -> path of the cached file
+    """
+    os.makedirs(cachedir, exist_ok=True)
+    manifestpath = os.path.join(cachedir, "manifest.json")
+    manifest = json_load(manifestpath) if os.path.exists(manifestpath) else {}
+    paths = {}
+    for name in SNDFILE_NAMES:
+        src = os.path.abspath(os.path.join(source, name + ".wav"))
+        key = hashlib.sha1(f"{_source_digest(src, manifest)}:{sr}:{normalize}:{PIPELINE_VERSION}"
+                           .encode()).hexdigest()[:12]
+        prefix = f"{name}-{sr}-"
+        dst = os.path.join(cachedir, f"{prefix}{key}.wav")
+        if force or not os.path.exists(dst):
+            t0 = time.perf_counter()
+            tmp = dst + ".tmp"
+            gain = convert(src, tmp, sr, normalize=normalize)
+            os.replace(tmp, dst)
+            log(f"{name}: {src} -> {dst} (gain {gain:.4g}, {time.perf_counter() - t0:.2f} s)")
+        # files for the same rate made from an older source are not needed anymore
+        for entry in os.listdir(cachedir):
+            if entry.startswith(prefix) and entry.endswith(".wav") and os.path.join(cachedir, entry) != dst:
+                os.remove(os.path.join(cachedir, entry))
+        paths[name] = dst
+    json_dump_atomic(manifest, manifestpath)
+    return paths
+
+
+def csound_macros(paths):
+    """
+    The command line options defining the macros of midikeyb.csd for the
+    sound files
+    """
+    return [f'--omacro:SNDFILE_{name}="{path}"' for name, path in paths.items()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resample and normalize the sound files for the engine")
+    parser.add_argument("--sr", type=int, default=44100, help="sample rate of the engine")
+    parser.add_argument("--source", default=SOURCE_FOLDER, help="folder with VL.wav, VLA.wav and VC.wav")
+    parser.add_argument("--no-normalize", action="store_true")
+    parser.add_argument("--force", action="store_true", help="process the files even if cached")
+    args = parser.parse_args()
+    paths = prepare_sndfiles(args.sr, normalize=not args.no_normalize, source=args.source, force=args.force)
+    for name, path in paths.items():
+        print(f"{name}: {path}")
+
+
+if __name__ == '__main__':
+    main()
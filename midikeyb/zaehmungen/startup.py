@@ -0,0 +1,124 @@
+"""
+Startup orchestration for zaehmungenkeyb.py
+
+Instead of sleeping a fixed time between steps, the startup waits for the
+peers to signal that they are ready. MidiKeyb marks each readiness event
+(see MidiKeyb.ready) when the first message arrives:
+
+    engine:    the first /heart from csound
+    gui:       the first /gui/heart from puredata
+    roundtrip: the first /pingback from csound (OSC works in both directions)
+
+The state is sent to each peer as soon as it is ready. The time of each
+phase is collected in a StartupReport and printed once all peers are
+ready or have timed out.
+"""
+import os
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+
+# readiness event -> timeout in seconds
+DEFAULT_TIMEOUTS = {
+    'engine': 10,
+    'gui': 10,
+    'roundtrip': 12
+}
+
+
+class StartupReport:
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        # list of (name, start, end, status). Times are relative to t0
+        self.phases = []
+
+    def add(self, name, start, end, status="ok"):
+        self.phases.append((name, start - self.t0, end - self.t0, status))
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        status = "failed"
+        try:
+            yield
+            status = "ok"
+        finally:
+            self.add(name, start, time.perf_counter(), status)
+
+    def render(self):
+        lines = ["startup:"]
+        for name, start, end, status in self.phases:
+            lines.append(f"    {name:<24} {start*1000:8.0f} ms -> {end*1000:8.0f} ms  "
+                         f"({(end-start)*1000:.0f} ms) {status}")
+        total = max((end for _, _, end, _ in self.phases), default=0)
+        lines.append(f"    total: {total*1000:.0f} ms")
+        return "\n".join(lines)
+
+
+def procs_named(name):
+    try:
+        out = subprocess.check_output(["pgrep", "-x", name])
+        return [int(pid) for pid in out.splitlines()]
+    except subprocess.CalledProcessError:
+        return []
+
+
+def kill_stale(name, timeout=1.0):
+    """
+    Kill the processes called name (as killall) and wait until they are
+    gone. Returns the number of processes killed. Raises RuntimeError if
+    they are still alive after timeout
+    """
+    pids = procs_named(name)
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    deadline = time.perf_counter() + timeout
+    for pid in pids:
+        while True:
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                break
+            if time.perf_counter() > deadline:
+                raise RuntimeError(f"could not kill {name} (pid {pid})")
+            time.sleep(0.005)
+    return len(pids)
+
+
+def watch_readiness(keyb, report, timeouts=None, on_done=print):
+    """
+    Wait (in a thread) for the readiness events of keyb, add a phase per
+    event to report and call on_done with the rendered report once all
+    events are set or timed out. Returns the thread
+
+    keyb: a MidiKeyb, or a list of them (the sessions of a KeyboardHost,
+          their phases are prefixed with the name of the session)
+    """
+    timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+    keybs = list(keyb) if not hasattr(keyb, 'ready') else [keyb]
+
+    def wait():
+        start = time.perf_counter()
+        for keyb in keybs:
+            prefix = f"{keyb.session.label}: " if len(keybs) > 1 else ""
+            for name, timeout in timeouts.items():
+                event = keyb.ready.get(name)
+                if event is None:
+                    # a session without gui
+                    continue
+                remaining = start + timeout - time.perf_counter()
+                if event.wait(max(0, remaining)):
+                    report.add(prefix + name, start, keyb.ready_times[name])
+                else:
+                    report.add(prefix + name, start, time.perf_counter(), f"timed out after {timeout} s")
+        on_done(report.render())
+
+    thread = threading.Thread(target=wait, name="StartupWatcher", daemon=True)
+    thread.start()
+    return thread
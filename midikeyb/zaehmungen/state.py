@@ -5,8 +5,11 @@ import logging
 import logging.handlers
 import shutil
 import json
+import queue
+import atexit
 
 from .utils import *
+from .logqueue import LazyQueueHandler, RateLimitFilter
 
 CONFIGFILE_USER = 'userconfig.json'
 CONFIGFILE_DEFAULT = 'defaultconfig.json'
@@ -23,7 +26,7 @@ FALLBACK_CONFIG = {
     "CC_randomness": 82,
     "CC_sustain": 64,
     "ratefactor_max": 5,
-    "rategactor_min": 0.5,
+    "ratefactor_min": 0.5,
     "mingain_db": -80,
     "maxgain_db": 0,
     "noteon_max_db": 0,
@@ -33,7 +36,18 @@ FALLBACK_CONFIG = {
     "save_last_state": True,
     "compression": 0.2,
     "randomness": 0.35,
-    "volpedal_curve": 0.4
+    "volpedal_curve": 0.4,
+    "cc_control_period_ms": 20,
+    "cc_deadband": 0,
+    "gui_echo_period_ms": 50,
+    "max_polyphony": 24,
+    "voice_steal_policy": "oldest",
+    "governor_enabled": True,
+    "governor_high_load": 0.85,
+    "governor_low_load": 0.6,
+    "governor_min_factor": 0.25,
+    "journal_enabled": True,
+    "journal_files": 8
 }
 
 STATE_KEYS = "compression randomness noteon_max_db noteon_min_db gain speed rate".split()
@@ -42,6 +56,10 @@ USERFOLDER = os.path.expanduser("~/.zaehmungen")
 
 LOGPATH = os.path.join(USERFOLDER, 'zaehmungen.log')
 LOGGERS = {}
+# records waiting to be written. Beyond this, records are dropped
+LOG_QUEUE_SIZE = 10000
+# max. messages per second of the same kind, max. burst
+LOG_RATE_LIMIT = (20, 50)
 env = {'prepared': False}
 
 
@@ -54,18 +72,28 @@ def prepare():
     if env['prepared']:
         print("environment already prepared!")
         return True
-    userpath = USERFOLDER
+    prepare_folder(USERFOLDER)
+    env['prepared'] = True
+    return True
+
+
+def prepare_folder(userpath):
+    """
+    Creates userpath with an empty userconfig, if needed
+    """
     if not os.path.exists(userpath):
         print("prepare: creating userpath at %s" % userpath)
-        os.mkdir(userpath)
+        os.makedirs(userpath)
     if not os.path.exists(os.path.join(userpath, CONFIGFILE_USER)):
         print("prepare: creating empty userconfig")
         shutil.copy(os.path.join("assets", CONFIGFILE_USER), os.path.join(userpath, CONFIGFILE_USER))
-    env['prepared'] = True
-    return True
     
 
 def new_logger():
+    """
+    Returns a logger which only enqueues its records. The file and the
+    terminal are written in a listener thread (see logqueue)
+    """
     if not env['prepared']:
         prepare()
     logger = logging.getLogger('zaehmungen')
@@ -79,7 +107,16 @@ def new_logger():
     except IOError:
         handler = logging.handlers.SysLogHandler()
     handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
-    logger.addHandler(handler)
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter('%(message)s'))
+    queuehandler = LazyQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queuehandler.addFilter(RateLimitFilter(*LOG_RATE_LIMIT))
+    logger.addHandler(queuehandler)
+    listener = logging.handlers.QueueListener(queuehandler.queue, handler, console,
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    LOGGERS['CONSOLE'] = console
     return logger
 
 
@@ -91,12 +128,24 @@ def get_logger():
     return logger
 
 
+def log_to_console(enabled):
+    """
+    Enable or disable printing the log to the terminal
+    """
+    get_logger()
+    LOGGERS['CONSOLE'].setLevel(logging.NOTSET if enabled else logging.CRITICAL + 1)
+
+
 def _debug(msg):
     logger = get_logger()
-    logger.debug(msg)
+    logger.debug(msg, stacklevel=2)
 
 
-def config_load():
+def config_load(folder=USERFOLDER):
+    """
+    folder: the folder with the user config and the last state (each
+            keyboard session has its own, see session.py)
+    """
     defaultconfig = os.path.join("assets", CONFIGFILE_DEFAULT)
     error = None
     if os.path.exists(defaultconfig):
@@ -108,7 +157,7 @@ def config_load():
             error = "ParseError:Default"
     else:
         config = FALLBACK_CONFIG
-    userconfig = os.path.join(USERFOLDER, CONFIGFILE_USER)
+    userconfig = os.path.join(folder, CONFIGFILE_USER)
     if os.path.exists(userconfig):
         try:
             _debug(f"loading user config: {userconfig}")
@@ -120,11 +169,14 @@ def config_load():
             _debug(sys.exc_info())
             error = "ParseError:User"
     else:
-        prepare()
+        if folder == USERFOLDER:
+            prepare()
+        else:
+            prepare_folder(folder)
         if not os.path.exists(userconfig):
             _debug("WTF?!")
             sys.exit(0)
-    last_state = state_load()
+    last_state = state_load(folder)
     if last_state:
         config.update(last_state)
     for key, value in sorted(config.items()):
@@ -132,9 +184,9 @@ def config_load():
     return {'config': config, 'defaultconfig': defaultconfig, 'userconfig': userconfig, 'error':error}
 
 
-def state_load():
+def state_load(folder=USERFOLDER):
     _debug("state_load: loading")
-    path = os.path.join(USERFOLDER, CONFIGFILE_LASTSTATE)
+    path = state_path(folder)
     laststate = {}
     if os.path.exists(path):
         try:
@@ -143,11 +195,23 @@ def state_load():
         except IOError:
             _debug("state_load: configfile not found, laststate is %s" % str(laststate))
             pass
+        except ValueError:
+            _debug("state_load: could not parse %s, ignoring the last state" % path)
     return laststate
 
 
-def state_save(config):
-    path = os.path.join(USERFOLDER, CONFIGFILE_LASTSTATE)
+def state_path(folder=USERFOLDER):
+    return os.path.join(folder, CONFIGFILE_LASTSTATE)
+
+
+def state_snapshot(config):
+    """
+    The part of the config which is saved as last state
+    """
+    return {key:config[key] for key in STATE_KEYS if config.get(key) is not None}
+
+
+def state_save(config, folder=USERFOLDER):
+    path = state_path(folder)
     _debug("state_save: saving to %s" % path)
-    state = {key:config[key] for key in STATE_KEYS if config.get(key) is not None}
-    json.dump(state, open(path, 'w'))
+    json_dump_atomic(state_snapshot(config), path)
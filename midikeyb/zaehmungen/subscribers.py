@@ -0,0 +1,224 @@
+"""
+Subscribers to the information sent by the controller
+
+Besides the puredata gui, any number of OSC clients (a tablet, a
+monitoring tool) can subscribe to what the controller reports. Each
+subscriber chooses
+
+    topics:   levels (/soundlevel), status (/status, /connectedports,
+              /throttle, /print) and parameters (everything else: /gain,
+              /speed, /table, ...)
+    maxrate:  the max. number of updates per second of each message (0:
+              no limit). Faster updates are coalesced, the last value is
+              sent once the period is over (see coalesce.py)
+
+A subscriber has to renew its subscription (/subscriber/heart or
+/subscribe again) within the timeout, otherwise it is removed. The
+levels of csound are only relayed while someone subscribes to them.
+
+    /subscribe [port or "host:port"] [topics: "levels,status"] [maxrate]
+    /subscriber/heart [port or "host:port"]
+    /unsubscribe [port or "host:port"]
+"""
+import threading
+
+from .coalesce import Coalescer
+from .oscbatch import destination_key
+
+
+TOPICS = ('levels', 'parameters', 'status')
+
+TOPIC_PATHS = {
+    '/soundlevel': 'levels',
+    '/status': 'status',
+    '/connectedports': 'status',
+    '/throttle': 'status',
+    '/print': 'status',
+}
+
+# a subscriber which does not renew its subscription within this time is removed, in seconds
+SUBSCRIBER_TIMEOUT = 5.0
+MAX_SUBSCRIBERS = 16
+
+
+def topic_of(path):
+    return TOPIC_PATHS.get(path, 'parameters')
+
+
+def parse_topics(topics):
+    """
+    topics: a comma separated string, "all" or "" for all topics. Raises
+    ValueError for an unknown topic
+    """
+    if not topics or topics == "all":
+        return set(TOPICS)
+    out = {topic.strip() for topic in topics.split(",") if topic.strip()}
+    unknown = out - set(TOPICS)
+    if unknown:
+        raise ValueError(f"unknown topics: {', '.join(sorted(unknown))}")
+    return out
+
+
+class Subscriber:
+    """
+    dest: where to send, as accepted by MidiKeyb._send
+    topics: a set of TOPICS
+    maxrate: max. updates per second of each message, 0 for no limit
+    throttled: the paths which are coalesced, None for all of them
+    permanent: never expires (the puredata gui, whose connection is
+               watched by its own heartbeat, /gui/heart)
+    """
+    def __init__(self, dest, topics, maxrate, now, throttled=None, permanent=False):
+        self.dest = dest
+        self.key = destination_key(dest)
+        self.topics = set(topics)
+        self.throttled = throttled
+        self.permanent = permanent
+        self.lastseen = now
+        self.filter = Coalescer()
+        # info is called from the main loop, the dispatcher and the scheduler
+        self.lock = threading.Lock()
+        self.configure(maxrate)
+
+    def configure(self, maxrate):
+        with self.lock:
+            self.maxrate = maxrate
+            self.filter.configure(period=1 / maxrate if maxrate > 0 else 0)
+
+    def offer(self, path, args, now):
+        """
+        True if path should be sent now, otherwise it is coalesced
+        """
+        if self.throttled is not None and path not in self.throttled:
+            return True
+        with self.lock:
+            return self.filter.feed(path, args, now)
+
+    def due(self, now):
+        """
+        Returns (messages due, time of the next one or None)
+        """
+        with self.lock:
+            return self.filter.due(now), self.filter.next_deadline()
+
+    def stats(self):
+        with self.lock:
+            return self.filter.stats()
+
+    def __repr__(self):
+        return f"Subscriber({self.key[0]}:{self.key[1]}, topics={sorted(self.topics)}, maxrate={self.maxrate})"
+
+
+class SubscriberRegistry:
+    """
+    send: a function (dest, path, *args)
+    timeout: subscribers not renewed within this time are removed by expire
+    maxsubscribers: further subscriptions are refused
+    """
+    def __init__(self, send, timeout=SUBSCRIBER_TIMEOUT, maxsubscribers=MAX_SUBSCRIBERS):
+        self.send = send
+        self.timeout = timeout
+        self.maxsubscribers = maxsubscribers
+        self.expired = 0
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribers(self):
+        with self._lock:
+            return list(self._subscribers.values())
+
+    def subscribe(self, dest, topics, maxrate, now, throttled=None, permanent=False):
+        """
+        Add a subscriber, or renew and reconfigure it. A renewed subscriber
+        gets every value again. Returns the subscriber. Raises ValueError
+        if there are too many subscribers
+        """
+        key = destination_key(dest)
+        with self._lock:
+            subscriber = self._subscribers.get(key)
+            if subscriber is None and len(self._subscribers) >= self.maxsubscribers:
+                raise ValueError(f"too many subscribers ({self.maxsubscribers})")
+            subscriber = Subscriber(dest, topics, maxrate, now, throttled=throttled, permanent=permanent)
+            self._subscribers[key] = subscriber
+        return subscriber
+
+    def unsubscribe(self, dest):
+        """
+        Returns the subscriber removed, or None
+        """
+        with self._lock:
+            return self._subscribers.pop(destination_key(dest), None)
+
+    def renew(self, dest, now):
+        """
+        Returns False if dest is not subscribed
+        """
+        subscriber = self._subscribers.get(destination_key(dest))
+        if subscriber is None:
+            return False
+        subscriber.lastseen = now
+        return True
+
+    def expire(self, now):
+        """
+        Remove the subscribers which were not renewed in time. Returns them
+        """
+        with self._lock:
+            expired = [subscriber for subscriber in self._subscribers.values()
+                       if not subscriber.permanent and now - subscriber.lastseen > self.timeout]
+            for subscriber in expired:
+                del self._subscribers[subscriber.key]
+        self.expired += len(expired)
+        return expired
+
+    def wants(self, topic):
+        """
+        True if anyone subscribes to topic
+        """
+        return any(topic in subscriber.topics for subscriber in self.subscribers())
+
+    def publish(self, path, args, now):
+        """
+        Send path with args to the subscribers of its topic, as far as
+        their max. rate allows. Coalesced values are sent by flush
+        """
+        topic = topic_of(path)
+        send = self.send
+        for subscriber in self.subscribers():
+            if topic not in subscriber.topics:
+                continue
+            if subscriber.offer(path, args, now):
+                send(subscriber.dest, path, *args)
+
+    def flush(self, now):
+        """
+        Send the coalesced values whose period is over. Returns the time at
+        which the next one is due, or None
+        """
+        send = self.send
+        deadlines = []
+        for subscriber in self.subscribers():
+            messages, deadline = subscriber.due(now)
+            for path, args in messages:
+                send(subscriber.dest, path, *args)
+            if deadline is not None:
+                deadlines.append(deadline)
+        return min(deadlines) if deadlines else None
+
+    def stats(self):
+        """
+        The counters of the coalescing, summed over the subscribers
+        (received, forwarded, suppressed, pending), the number of
+        subscribers and of expired subscriptions
+        """
+        out = {'received': 0, 'forwarded': 0, 'suppressed': 0, 'pending': 0}
+        subscribers = self.subscribers()
+        for subscriber in subscribers:
+            for key, value in subscriber.stats().items():
+                out[key] += value
+        out['subscribers'] = len(subscribers)
+        out['expired'] = self.expired
+        return out
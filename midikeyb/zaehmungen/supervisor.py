@@ -0,0 +1,95 @@
+"""
+Supervision of the csound subprocess
+
+The supervisor owns the csound process, so that the controller can restart
+the engine alone when it dies or hangs: MIDI ports, the gui connection and
+the state of the controller stay alive. Once the new engine sends its
+first /heart the controller replays the state and the sounding notes
+(see MidiKeyb._engine_connected).
+
+Each process is waited for in a thread, so that an unexpected exit is
+reported at once, without waiting for the heartbeat to time out.
+"""
+import subprocess
+import threading
+import time
+
+
+class EngineSupervisor:
+    """
+    args: the command line to start csound
+    on_exit: a function (returncode), called from the waiting thread when
+             the process exits unexpectedly (not by restart or stop)
+    killtimeout: time to wait for a killed process to exit, in seconds
+    """
+    # csound runs as a separate process, controlled via OSC (see embedded.py)
+    embedded = False
+
+    def __init__(self, args, on_exit=None, killtimeout=1.0):
+        self.args = list(args)
+        self.on_exit = on_exit
+        self.killtimeout = killtimeout
+        self.proc = None
+        self.restarts = 0
+        self.last_start = None
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    @property
+    def pid(self):
+        proc = self.proc
+        return proc.pid if proc is not None else None
+
+    def running(self):
+        proc = self.proc
+        return proc is not None and proc.poll() is None
+
+    def start(self):
+        with self._lock:
+            self._stopping = False
+            self._spawn()
+
+    def _spawn(self):
+        self.proc = proc = subprocess.Popen(self.args)
+        self.last_start = time.perf_counter()
+        threading.Thread(target=self._wait, args=(proc,), name="EngineWatcher", daemon=True).start()
+
+    def _wait(self, proc):
+        returncode = proc.wait()
+        with self._lock:
+            expected = proc is not self.proc or self._stopping
+        if not expected and self.on_exit is not None:
+            self.on_exit(returncode)
+
+    def _kill(self, proc):
+        proc.kill()
+        try:
+            proc.wait(self.killtimeout)
+        except subprocess.TimeoutExpired:
+            raise RuntimeError(f"could not kill csound (pid {proc.pid})")
+
+    def restart(self):
+        """
+        Kill the engine (if still running) and start it again
+        """
+        with self._lock:
+            proc, self.proc = self.proc, None
+            if proc is not None and proc.poll() is None:
+                self._kill(proc)
+            self._stopping = False
+            self._spawn()
+            self.restarts += 1
+
+    def stop(self, timeout=2.0):
+        """
+        Wait for the engine to exit (after /stop), kill it after timeout
+        """
+        with self._lock:
+            self._stopping = True
+            proc = self.proc
+        if proc is None:
+            return
+        try:
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self._kill(proc)
@@ -0,0 +1,247 @@
+"""
+Latency tuning
+
+Finds the lowest latency at which csound runs without xruns on this
+machine. The sample rate and the period of jack are detected, then
+midikeyb.csd is run for a few seconds with each candidate ksmps and
+buffer size (-b, -B), from the lowest latency up, while the engine plays
+notes (at gain 0, nothing is heard). A trial is stable when csound
+reports no xruns and its heartbeat arrives on time. The first stable
+candidate is written to ~/.zaehmungen/tuning.json, which the launcher
+uses instead of SR and KSMPS (see USE_TUNING in zaehmungenkeyb.py).
+
+Run from the midikeyb folder, with jack running and zaehmungenkeyb.py not:
+
+    $ python3 -m zaehmungen.tune
+    $ python3 -m zaehmungen.tune --all --duration 10
+"""
+import argparse
+import os
+import re
+import socket
+import subprocess
+import threading
+import time
+
+from . import csoundtools
+from .core import CSD_OSCPORT, CORE_OSCPORT, HEARTBEAT_PERIOD, C3
+from .osc import encode_message, decode, OscDecodeError
+from .state import USERFOLDER
+from .utils import json_load, json_dump_atomic
+
+
+CSDPATH = "assets/midikeyb.csd"
+TUNING_PATH = os.path.join(USERFOLDER, "tuning.json")
+
+KSMPS_CANDIDATES = (16, 32, 64, 128)
+# the software buffer (-b) as multiples of the jack period. The hardware
+# buffer (-B) is twice the software buffer
+BUFFER_FACTORS = (1, 2, 4)
+# used if the period of jack can't be determined
+DEFAULT_PERIOD = 256
+
+TRIAL_DURATION = 6
+TRIAL_NOTES = 12
+# max. deviation of a heartbeat interval from HEARTBEAT_PERIOD, in seconds
+JITTER_MAX = 0.05
+
+XRUN_PATTERN = re.compile(r"xrun|underrun|overrun", re.IGNORECASE)
+
+
+def candidates(sr, period):
+    """
+    Returns a list of dicts (ksmps, buffer, hwbuffer, latency), sorted by
+    latency. The latency (in seconds) is that of the hardware buffer plus
+    one control period
+    """
+    out = []
+    for factor in BUFFER_FACTORS:
+        buffer = period * factor
+        for ksmps in KSMPS_CANDIDATES:
+            if ksmps > buffer or buffer % ksmps:
+                continue
+            out.append({'ksmps': ksmps, 'buffer': buffer, 'hwbuffer': buffer * 2,
+                        'latency': (buffer * 2 + ksmps) / sr})
+    out.sort(key=lambda c: c['latency'])
+    return out
+
+
+def buffer_options(tuning):
+    return [f"-b{tuning['buffer']}", f"-B{tuning['hwbuffer']}"]
+
+
+class Trial:
+    """
+    Runs csound with the given settings for duration seconds, counting the
+    xruns it reports and the timing of its heartbeat
+    """
+    def __init__(self, sr, ksmps, buffer, hwbuffer, duration=TRIAL_DURATION, numnotes=TRIAL_NOTES,
+                 csdpath=CSDPATH):
+        self.args = ["csound", "-+rtaudio=jack", "-odac", f"--sample-rate={sr}", f"--ksmps={ksmps}",
+                     f"-b{buffer}", f"-B{hwbuffer}", os.path.abspath(csdpath)]
+        self.duration = duration
+        self.numnotes = numnotes
+        self.xruns = []        # time of each xrun reported
+        self.hearts = []
+        self.cpu = []
+
+    def _read_stderr(self, proc):
+        for line in proc.stderr:
+            if XRUN_PATTERN.search(line):
+                self.xruns.append(time.perf_counter())
+
+    def _send(self, sock, path, *args):
+        sock.sendto(encode_message(path, *args), ("127.0.0.1", CSD_OSCPORT))
+
+    def _receive(self, sock, until):
+        clock = time.perf_counter
+        while clock() < until:
+            sock.settimeout(max(0.001, until - clock()))
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                break
+            now = clock()
+            try:
+                messages = decode(data)
+            except OscDecodeError:
+                continue
+            for path, _, args in messages:
+                if path == '/heart':
+                    self.hearts.append(now)
+                elif path == '/info' and len(args) > 2:
+                    self.cpu.append(args[2])
+
+    def run(self, starttimeout=10):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind(("", CORE_OSCPORT))
+        except OSError:
+            sock.close()
+            raise RuntimeError(f"port {CORE_OSCPORT} is in use, is zaehmungenkeyb.py running?")
+        proc = subprocess.Popen(self.args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        threading.Thread(target=self._read_stderr, args=(proc,), daemon=True).start()
+        clock = time.perf_counter
+        try:
+            deadline = clock() + starttimeout
+            while not self.hearts and clock() < deadline and proc.poll() is None:
+                self._receive(sock, min(deadline, clock() + 0.1))
+            if not self.hearts:
+                return self._result(started=False)
+            # load the engine as when playing, but silently
+            for path, value in (('/gain', 0.0), ('/rate', 40.0), ('/dur', 100), ('/speed', 1.0)):
+                self._send(sock, path, value)
+            for i in range(self.numnotes):
+                self._send(sock, '/noteon', C3 + i * 3, i / self.numnotes, 0.5)
+            # xruns and heartbeats while starting up are not counted
+            self._receive(sock, clock() + 0.5)
+            self.hearts.clear()
+            self.cpu.clear()
+            start = clock()
+            self._receive(sock, start + self.duration)
+            return self._result(started=True, start=start)
+        finally:
+            self._send(sock, '/stop', 1.0)
+            try:
+                proc.wait(2)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+            sock.close()
+
+    def _result(self, started, start=None):
+        hearts = self.hearts
+        jitter = max((abs(b - a - HEARTBEAT_PERIOD) for a, b in zip(hearts, hearts[1:])), default=None)
+        xruns = sum(1 for t in self.xruns if start is not None and t >= start)
+        expected = self.duration / HEARTBEAT_PERIOD
+        stable = (started and xruns == 0 and len(hearts) >= int(expected * 0.8)
+                  and jitter is not None and jitter <= JITTER_MAX)
+        return {
+            'started': started,
+            'xruns': xruns,
+            'heartbeats': len(hearts),
+            'jitter_max': jitter,
+            'cpu_max': max(self.cpu, default=None),
+            'stable': stable
+        }
+
+
+def tune(duration=TRIAL_DURATION, runall=False, path=TUNING_PATH, log=print):
+    """
+    Run the trials and write the lowest latency stable settings to path.
+    Returns the settings written, or None if no candidate was stable
+    """
+    if not csoundtools.detect_jack():
+        raise RuntimeError("jack is not running")
+    sr = csoundtools.jack_samplerate()
+    if sr is None:
+        raise RuntimeError("could not determine the sample rate of jack")
+    period = csoundtools.jack_period()
+    if period is None:
+        log(f"could not determine the period of jack, assuming {DEFAULT_PERIOD}")
+        period = DEFAULT_PERIOD
+    log(f"jack: sr={sr}, period={period}")
+    trials = []
+    best = None
+    for candidate in candidates(sr, period):
+        label = (f"ksmps={candidate['ksmps']:<4} -b{candidate['buffer']:<5} -B{candidate['hwbuffer']:<5} "
+                 f"({candidate['latency']*1000:.1f} ms)")
+        result = Trial(sr, candidate['ksmps'], candidate['buffer'], candidate['hwbuffer'],
+                       duration=duration).run()
+        trials.append(dict(candidate, **result))
+        jitter = result['jitter_max']
+        log(f"{label}: {'stable' if result['stable'] else 'UNSTABLE'}, xruns: {result['xruns']}, "
+            f"heartbeat jitter: {'-' if jitter is None else f'{jitter*1000:.1f} ms'}")
+        if result['stable'] and best is None:
+            best = candidate
+            if not runall:
+                break
+    if best is None:
+        log("no stable configuration found")
+        return None
+    tuning = {'sr': sr, 'period': period, 'ksmps': best['ksmps'], 'buffer': best['buffer'],
+              'hwbuffer': best['hwbuffer'], 'latency': best['latency'], 'trials': trials}
+    json_dump_atomic(tuning, path)
+    log(f"written to {path}: sr={sr}, ksmps={best['ksmps']}, {' '.join(buffer_options(tuning))}")
+    return tuning
+
+
+def load_tuning(sr, period=None, path=TUNING_PATH, log=None):
+    """
+    sr: the sample rate of jack. The settings depend on it: if it is None
+        (unknown) they are not used
+    period: the period of jack, None if unknown
+    Returns the settings written by tune, or None if there are none or
+    they were found for another sample rate or period
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        tuning = json_load(path)
+    except ValueError:
+        return None
+    reason = None
+    if sr is None:
+        reason = "the sample rate of jack is unknown"
+    elif tuning.get('sr') != sr:
+        reason = f"they were found for sr={tuning.get('sr')}, jack runs at {sr}"
+    elif period is not None and tuning.get('period') != period:
+        reason = f"they were found for a period of {tuning.get('period')}, jack uses {period}"
+    if reason is not None:
+        if log is not None:
+            log(f"not using the tuned settings: {reason}. Run tune.py again")
+        return None
+    return tuning
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the lowest latency settings without xruns")
+    parser.add_argument("--duration", type=float, default=TRIAL_DURATION, help="duration of each trial, in seconds")
+    parser.add_argument("--all", action="store_true", help="run all candidates, not only up to the first stable one")
+    args = parser.parse_args()
+    tune(duration=args.duration, runall=args.all)
+
+
+if __name__ == '__main__':
+    main()
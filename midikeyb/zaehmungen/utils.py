@@ -1,5 +1,6 @@
 from math import pow, log10
 import json
+import os
 import re
 
 
@@ -56,6 +57,30 @@ def json_load(path):
     s = json_remove_all(s)
     return json.loads(s)
 
+def write_atomic(path, text):
+    """
+    Write text to path, replacing it atomically: the text is written to a
+    temporary file, synced and renamed over path, so that path holds
+    either the old or the new content, also after a crash
+    """
+    tmppath = path + ".tmp"
+    with open(tmppath, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmppath, path)
+    folder = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(folder)
+    finally:
+        os.close(folder)
+
+def json_dump_atomic(obj, path):
+    """
+    Write obj as json to path, atomically (see write_atomic)
+    """
+    write_atomic(path, json.dumps(obj))
+
 def json_minify(json, strip_space=True):
     """
     strip comments and remove space from string
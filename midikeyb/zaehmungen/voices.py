@@ -0,0 +1,90 @@
+"""
+Voice allocation
+
+Each sounding note is an instance of the PARTIKKEL instrument in csound,
+identified by its midinote (instr PARTIKKEL + midinote/128). The allocator
+keeps track of the sounding notes and enforces a max. polyphony: when a
+note is started and all voices are in use, a voice is stolen according
+to the policy:
+
+    oldest:   the note started first
+    quietest: the note with the lowest amplitude
+    lowest:   the lowest note
+"""
+import itertools
+
+
+STEAL_POLICIES = ('oldest', 'quietest', 'lowest')
+
+
+class Voice:
+    __slots__ = ('midinote', 'amp', 'order')
+
+    def __init__(self, midinote, amp, order):
+        self.midinote = midinote
+        self.amp = amp
+        self.order = order
+
+
+def _steal_key(policy):
+    if policy == 'oldest':
+        return lambda voice: voice.order
+    if policy == 'quietest':
+        return lambda voice: (voice.amp, voice.order)
+    if policy == 'lowest':
+        return lambda voice: (voice.midinote, voice.order)
+    raise ValueError(f"steal policy should be one of {STEAL_POLICIES}, got {policy}")
+
+
+class VoiceAllocator:
+    """
+    maxvoices: max. number of sounding notes, 0 for no limit
+    policy: one of 'oldest', 'quietest', 'lowest'
+    """
+    def __init__(self, maxvoices=0, policy='oldest'):
+        self.voices = {}        # midinote -> Voice
+        self.stolen = 0
+        self._counter = itertools.count()
+        self.configure(maxvoices, policy)
+
+    def configure(self, maxvoices=None, policy=None):
+        if maxvoices is not None:
+            self.maxvoices = maxvoices
+        if policy is not None:
+            self._stealkey = _steal_key(policy)
+            self.policy = policy
+
+    def __len__(self):
+        return len(self.voices)
+
+    def __contains__(self, midinote):
+        return midinote in self.voices
+
+    def start(self, midinote, amp):
+        """
+        Allocate a voice for midinote. Returns a list of the midinotes
+        whose voices have to be stopped first: the note itself, if it was
+        still sounding, and the stolen voices
+        """
+        voices = self.voices
+        stopped = []
+        if midinote in voices:
+            del voices[midinote]
+            stopped.append(midinote)
+        if self.maxvoices > 0:
+            while len(voices) >= self.maxvoices:
+                victim = min(voices.values(), key=self._stealkey)
+                del voices[victim.midinote]
+                stopped.append(victim.midinote)
+                self.stolen += 1
+        voices[midinote] = Voice(midinote, amp, next(self._counter))
+        return stopped
+
+    def release(self, midinote):
+        """
+        Returns True if midinote was sounding
+        """
+        return self.voices.pop(midinote, None) is not None
+
+    def clear(self):
+        self.voices.clear()
@@ -0,0 +1,170 @@
+"""
+Watching the user configuration
+
+InotifyWatcher is notified by the kernel when the file is written or
+replaced. It watches the directory, not the file, so that editors which
+save by writing a temporary file and renaming it over the original
+(which replaces the inode) are followed. Where inotify is not available
+FileModificationWatcher polls the modification time.
+
+The diffing functions determine which parts of the running state depend
+on the keys which changed, so that a reload only re-applies those.
+"""
+import os
+import struct
+import ctypes
+import ctypes.util
+
+
+class FileModificationWatcher(object):
+    def __init__(self, path, callback, time_threshold=0.5):
+        """
+        time_threshold: the difference in time that will trigger a callback
+        """
+        self.path = path
+        self.callback = callback
+        self.last_modified = os.stat(path).st_mtime
+        self.threshold = time_threshold
+
+    def tick(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime - self.last_modified > self.threshold:
+            self.callback()
+            self.last_modified = mtime
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class InotifyWatcher:
+    """
+    Reports changes to path. The owner registers fileno() with its event loop
+    and calls read() when it is readable; read returns True if path was
+    written, created or replaced. Saving a file produces several events,
+    debouncing them is left to the owner
+
+    Raises OSError if inotify is not available
+    """
+    def __init__(self, path):
+        libc = _load_libc()
+        if libc is None:
+            raise OSError("inotify not available")
+        self.path = os.path.abspath(path)
+        self.folder, filename = os.path.split(self.path)
+        self.filename = os.fsencode(filename)
+        self.events = 0
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(fd, os.fsencode(self.folder), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, os.strerror(errno))
+        self._fd = fd
+
+    def fileno(self):
+        return self._fd
+
+    def read(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, size = _EVENT_HEADER.unpack_from(data, pos)
+                pos += _EVENT_HEADER.size
+                name = data[pos:pos+size].rstrip(b'\0')
+                pos += size
+                if mask & IN_Q_OVERFLOW or name == self.filename:
+                    self.events += 1
+                    changed = True
+        return changed
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+# config key -> the part of the state which depends on it.
+# Keys not listed here trigger a full reload
+CONFIG_SUBSYSTEMS = {
+    'midichannel': 'midichannel',
+    'midiports': 'midiports',
+    'CC_gainchange': 'controllers',
+    'CC_sustain': 'controllers',
+    'CC_sensibility': 'controllers',
+    'CC_ratefactor': 'controllers',
+    'CC_compressor': 'controllers',
+    'CC_randomness': 'controllers',
+    'cc_control_period_ms': 'controllers',
+    'cc_deadband': 'controllers',
+    'gui_echo_period_ms': 'controllers',
+    'mingain_db': 'tables',
+    'maxgain_db': 'tables',
+    'volpedal_curve': 'tables',
+    'ratefactor_min': 'tables',
+    'rategactor_min': 'tables',
+    'ratefactor_max': 'tables',
+    'noteon_min_db': 'sensibility',
+    'noteon_max_db': 'sensibility',
+    'compression': 'compression',
+    'randomness': 'randomness',
+    'max_polyphony': 'voices',
+    'voice_steal_policy': 'voices',
+    'governor_enabled': 'governor',
+    'governor_high_load': 'governor',
+    'governor_low_load': 'governor',
+    'governor_min_factor': 'governor',
+    'journal_enabled': 'journal',
+    'journal_files': 'journal',
+    'allow_kbd_rate_factor_change': 'flags',
+    'default_midichannel': None,
+    'save_last_state': None,
+}
+
+
+def config_diff(old, new):
+    """
+    Returns a dict key -> new value of the keys in new which are not in old
+    or have a different value
+    """
+    return {key: value for key, value in new.items()
+            if key not in old or old[key] != value}
+
+
+def config_subsystems(keys):
+    """
+    Returns the set of subsystems affected by a change of the given keys.
+    'all' is included if any key is unknown
+    """
+    subsystems = set()
+    for key in keys:
+        subsystem = CONFIG_SUBSYSTEMS.get(key, 'all')
+        if subsystem is not None:
+            subsystems.add(subsystem)
+    return subsystems
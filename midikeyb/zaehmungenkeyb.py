@@ -5,6 +5,10 @@ import sys
 import shutil
 import subprocess
 from zaehmungen import core
+from zaehmungen import startup
+from zaehmungen.supervisor import EngineSupervisor
+from zaehmungen.session import Session, make_sessions
+from zaehmungen.host import KeyboardHost
 import zaehmungen
 
 
@@ -14,6 +18,35 @@ import zaehmungen
 SR = 44100
 KSMPS = 64
 
+# Run the controller within one asyncio event loop (see zaehmungen/aiocore.py)
+USE_ASYNCIO = False
+
+# How csound is run: "osc" (a separate process, controlled via OSC) or
+# "embedded" (inside the controller, via ctcsound. See zaehmungen/embedded.py)
+ENGINE = "osc"
+
+# Resample and normalize the sound files to SR before starting (needs numpy,
+# see zaehmungen/sndfiles.py). If False, the 48 kHz files in assets are used
+PREPARE_SNDFILES = True
+
+# Use the ksmps and buffer sizes found by the latency tuner, if it was run
+# (python3 -m zaehmungen.tune). They override SR and KSMPS, unless the
+# sample rate of jack changed since
+USE_TUNING = True
+
+# The keyboards run by this controller, one per player (see zaehmungen/session.py).
+# Empty: one keyboard. Otherwise a list of names, or of dicts with the keys
+# name, midiports, portbase, engine_host, gui. For example:
+#     SESSIONS = [{'name': 'vl', 'midiports': ['Keystation*']},
+#                 {'name': 'vc', 'midiports': ['Oxygen*']}]
+# Each session has its own ports (7770-7772, 7780-7782, ...), config folder
+# (~/.zaehmungen/sessions/<name>) and csound. The gui shows the first one
+SESSIONS = []
+
+# Max. time in seconds to wait for each peer at startup, see zaehmungen/startup.py
+# Keys: engine, gui, roundtrip
+STARTUP_TIMEOUTS = {}
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 # check installation
@@ -57,52 +90,78 @@ if os.path.exists(configfile):
     print("reading configuration")
     exec(open(configfile).read())
 
-def killmatching(pattern):
-    os.system(f'killall -9 "{pattern}"')
-    timeout = 1
-    while timeout > 0:
-        procs = procsmatching(pattern)
-        if not procs:
-            return True
-        time.sleep(0.1)
-        timeout -= 0.1
-    raise RuntimeError(f"could not kill {pattern}")
+bufferoptions = []
+if USE_TUNING:
+    from zaehmungen import tune, csoundtools
+    tuning = tune.load_tuning(csoundtools.jack_samplerate(), csoundtools.jack_period(), log=print)
+    if tuning:
+        SR, KSMPS = tuning['sr'], tuning['ksmps']
+        bufferoptions = tune.buffer_options(tuning)
+        print(f"using tuned settings: sr={SR}, ksmps={KSMPS}, {' '.join(bufferoptions)}")
 
-def procsmatching(pattern):
-    try:
-        out = subprocess.check_output(["pgrep", "-f", pattern])
-        return [int(pid) for pid in out.splitlines()]
-    except subprocess.CalledProcessError:
-        return None
+# Nothing waits a fixed time: csound, puredata and the controller start in
+# parallel and the state is sent to each peer when it signals that it is up
 
-killmatching("csound")
+report = startup.StartupReport()
 
-# puredata gui
+with report.phase("kill stale csound"):
+    startup.kill_stale("csound")
 
 pdpatch = os.path.abspath("assets/zaehmungen.pd")
 assert os.path.exists(pdpatch)
-pdproc = subprocess.Popen(['pd', '-noaudio', '-nomidi', pdpatch])
 
 csoundpatch = os.path.abspath("assets/midikeyb.csd")
 assert os.path.exists(csoundpatch)
-csoundargs = [
-    "csound",
+csoundoptions = [
     "-+rtaudio=jack",
     "-odac",
     f"--sample-rate={SR}",
     f"--ksmps={KSMPS}",
-    "-m", "0",
-    csoundpatch
-]
-
-# csound engine
-
-print(csoundargs)
-csoundproc = subprocess.Popen(csoundargs)
+    "--messagelevel=0"
+] + bufferoptions
+
+if PREPARE_SNDFILES:
+    with report.phase("prepare sndfiles"):
+        try:
+            from zaehmungen import sndfiles
+        except ImportError:
+            print("numpy not found, using the sndfiles in assets/sndfiles48")
+        else:
+            csoundoptions += sndfiles.csound_macros(sndfiles.prepare_sndfiles(SR))
+
+sessions = make_sessions(SESSIONS) if SESSIONS else [Session()]
+
+with report.phase("launch pd + csound"):
+    pdproc = subprocess.Popen(['pd', '-noaudio', '-nomidi', pdpatch])
+    # each session has its own csound, owned by a supervisor: the controller
+    # restarts it if it dies
+    engines = []
+    for session in sessions:
+        options = csoundoptions + session.csound_options()
+        if ENGINE == "embedded":
+            from zaehmungen.embedded import EmbeddedCsound
+            engine = EmbeddedCsound(csoundpatch, options)
+        else:
+            csoundargs = ["csound"] + options + [csoundpatch]
+            print(csoundargs)
+            engine = EngineSupervisor(csoundargs)
+        engine.start()
+        engines.append(engine)
 
 # controler
 
-keyb = core.MidiKeyb()
+with report.phase("controller"):
+    if len(sessions) > 1:
+        if USE_ASYNCIO:
+            print("several sessions run in one main loop, USE_ASYNCIO is ignored")
+        keyb = KeyboardHost(sessions, engines)
+    elif USE_ASYNCIO:
+        from zaehmungen import aiocore
+        keyb = aiocore.AsyncMidiKeyb(engine=engines[0], session=sessions[0])
+    else:
+        keyb = core.MidiKeyb(engine=engines[0], session=sessions[0])
+
+startup.watch_readiness(keyb, report, STARTUP_TIMEOUTS)
 
 try:
     keyb.start()
@@ -110,10 +169,12 @@ except KeyboardInterrupt:
     print("Keyboard interrupt: exiting")
 except zaehmungen.error.GuiConnectionError:
     print("GuiConnectionError")
+except zaehmungen.error.CsoundConnectionError as e:
+    print(f"CsoundConnectionError: {e}")
 
 print("exiting")
-time.sleep(2)
+for engine in engines:
+    engine.stop(timeout=2)
 
 print("killing subprocesses")
-csoundproc.kill()
 pdproc.kill()